@@ -0,0 +1,413 @@
+# async_packet_holder.py
+# Description: This file contains the AsyncPacketHolder class, which holds
+# packets like PacketHolder but serves any number of client connections on one
+# asyncio event loop.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import asyncio
+import itertools
+from threading import Thread
+import time
+
+from hold_queue import HoldQueue
+from packet_holder import HoldingRule
+from packet_holder import PacketHolder
+from release_scheduler import DelayLine
+from release_scheduler import ReleaseScheduler
+from session_recorder import EVENT_HOLD
+from session_recorder import EVENT_RELEASE
+from traffic_logger import DIRECTION_FROM_SERVER
+from traffic_logger import DIRECTION_TO_SERVER
+from traffic_logger import KIND_DELAYED
+from traffic_logger import KIND_HOLDING
+from traffic_logger import KIND_PASS_THROUGH
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# AsyncSession
+# ------------------------------------------------------------------------------
+# One accepted client and its own upstream connection. Each session has its own
+# hold queue, so packets held for one client are never released to another.
+class AsyncSession:
+    def __init__(self, holder, session_id, client_reader, client_writer):
+        self.holder = holder
+        self.session_id = session_id
+        self.client_reader = client_reader
+        self.client_writer = client_writer
+        self.client_address = client_writer.get_extra_info('peername')
+        self.server_reader = None
+        self.server_writer = None
+        self.hold_queue = HoldQueue(holder.hold_memory_limit, holder.spill_dir, self._on_packet_released)
+        # Timed releases and the delay lines run on the event loop's own
+        # timers, so every write still happens on the loop thread.
+        loop = asyncio.get_running_loop()
+        self.release_scheduler = ReleaseScheduler(loop.call_later, self.hold_queue, self._send_released_packets)
+        latency_ms, jitter_ms = holder.impairment
+        self.delay_lines = {
+            DIRECTION_TO_SERVER: DelayLine(loop.call_at, self._write_to_server, latency_ms, jitter_ms),
+            DIRECTION_FROM_SERVER: DelayLine(loop.call_at, self._write_to_client, latency_ms, jitter_ms),
+        }
+        # Every write to a peer goes through its outgoing queue and writer
+        # task (see _write_packets()), also the ones from timer callbacks.
+        self.outgoing = {
+            DIRECTION_TO_SERVER: asyncio.Queue(),
+            DIRECTION_FROM_SERVER: asyncio.Queue(),
+        }
+        self.writer_tasks = {}
+
+    async def run(self):
+        print(f"[Session {self.session_id}] Accepted {self.client_address}")
+        if not await self._connect_to_server():
+            self.client_writer.close()
+            return
+        self.writer_tasks[DIRECTION_TO_SERVER] = asyncio.ensure_future(
+            self._write_packets(self.server_writer, self.outgoing[DIRECTION_TO_SERVER], "server"))
+        self.writer_tasks[DIRECTION_FROM_SERVER] = asyncio.ensure_future(
+            self._write_packets(self.client_writer, self.outgoing[DIRECTION_FROM_SERVER], "client"))
+        # A half-close of one peer is forwarded to the other one and the
+        # opposite direction keeps running. The session ends when both
+        # directions have ended, or at once when one of them fails.
+        pending = {
+            asyncio.ensure_future(self._handle_client_to_server()),
+            asyncio.ensure_future(self._handle_server_to_client()),
+        }
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if not all(task.result() for task in done):
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+            self.close()
+            print(f"[Session {self.session_id}] Closed {self.client_address}")
+
+    def close(self):
+        for task in self.writer_tasks.values():
+            task.cancel()
+        self.client_writer.close()
+        if self.server_writer is not None:
+            self.server_writer.close()
+        self.hold_queue.close()
+
+    def set_impairment(self, latency_ms=0, jitter_ms=0):
+        for delay_line in self.delay_lines.values():
+            delay_line.set_impairment(latency_ms, jitter_ms)
+
+    def send_all_holding_packets(self):
+        self._send_released_packets(self.hold_queue.pop_all())
+
+    def _send_released_packets(self, packets):
+        for packet in packets:
+            self._pass_through_client_to_server_delayed(packet)
+
+    async def _connect_to_server(self, retry_count=PacketHolder.RETRY_COUNT, retry_interval=PacketHolder.RETRY_INTERBAL):
+        for i in range(retry_count):
+            try:
+                self.server_reader, self.server_writer = await asyncio.open_connection(*self.holder.server_address)
+                return True
+            except (TimeoutError, ConnectionRefusedError) as e:
+                if i < retry_count - 1:
+                    print(f"[Session {self.session_id}] An error occurred while connecting to {self.holder.server_address}: retrying {str(i+1)} times ...")
+                    await asyncio.sleep(retry_interval)
+                else:
+                    print(f"[Session {self.session_id}] connect_to_server() is Failed. error: {str(e)}")
+            except Exception as e:
+                print(f"[Session {self.session_id}] connect_to_server() is Failed. error: {str(e)}")
+                break
+        return False
+
+    # Returns True when the client closed its side and the end of the stream
+    # has been forwarded to the server, False on an error.
+    async def _handle_client_to_server(self):
+        framer = self.holder.framer_factory()
+        while True:
+            try:
+                packet = await self.client_reader.read(self.holder.recv_size)
+            except Exception as e:
+                print(f"[Session {self.session_id}] recv() from client is failed due to an error: {str(e)}")
+                return False
+            if not packet:
+                print(f"[Session {self.session_id}] recv() from client is failed")
+                break
+            received_at = time.perf_counter_ns()
+            self.holder._record_data(DIRECTION_TO_SERVER, packet, self.session_id)
+            framer, frames = self.holder._split_frames(framer, packet, f"client of session {self.session_id}")
+            for frame in frames:
+                self._handle_client_packet(frame)
+            self.holder.metrics.record_forward(DIRECTION_TO_SERVER, len(packet), time.perf_counter_ns() - received_at)
+            await self.outgoing[DIRECTION_TO_SERVER].join()
+        remaining = framer.flush()
+        if remaining:
+            self._send_to_server(remaining)
+        # The end of the stream goes through the delay line as well, so it
+        # is not forwarded before the data still waiting there.
+        self._send_to_server(None)
+        return await self.writer_tasks[DIRECTION_TO_SERVER]
+
+    def _handle_client_packet(self, packet):
+        holding_rule = self.holder._find_holding_rule(packet)
+        if holding_rule is not None:
+            seq = self.hold_queue.put(packet, holding_rule)
+            if seq is not None:
+                self.holder.metrics.record_hold(holding_rule, len(packet))
+                self.holder._record_event(EVENT_HOLD, len(packet), self.session_id)
+                self.release_scheduler.on_hold(holding_rule, seq)
+                self._log_packet(DIRECTION_TO_SERVER, KIND_HOLDING, packet)
+                return
+            print(f"[Session {self.session_id}] Holding limit of the rule is reached, the packet is passed through: {holding_rule}")
+        if not self.holder.output_only_holding_packets:
+            self._log_packet(DIRECTION_TO_SERVER, KIND_PASS_THROUGH, packet)
+        self._send_to_server(packet)
+        for released in self.hold_queue.pop_released(HoldingRule.RELEASE_TYPE_FROM_CLIENT, packet):
+            self._pass_through_client_to_server_delayed(released)
+
+    # Returns True when the server closed its side and the end of the stream
+    # has been forwarded to the client, False on an error.
+    async def _handle_server_to_client(self):
+        framer = self.holder.framer_factory()
+        while True:
+            try:
+                packet = await self.server_reader.read(self.holder.recv_size)
+            except Exception as e:
+                print(f"[Session {self.session_id}] recv() from server is failed due to an error: {str(e)}")
+                return False
+            if not packet:
+                print(f"[Session {self.session_id}] recv() from server is failed")
+                break
+            received_at = time.perf_counter_ns()
+            self.holder._record_data(DIRECTION_FROM_SERVER, packet, self.session_id)
+            framer, frames = self.holder._split_frames(framer, packet, f"server of session {self.session_id}")
+            for frame in frames:
+                self._handle_server_packet(frame)
+            self.holder.metrics.record_forward(DIRECTION_FROM_SERVER, len(packet), time.perf_counter_ns() - received_at)
+            await self.outgoing[DIRECTION_FROM_SERVER].join()
+            await self.outgoing[DIRECTION_TO_SERVER].join()
+        remaining = framer.flush()
+        if remaining:
+            self._send_to_client(remaining)
+        self._send_to_client(None)
+        return await self.writer_tasks[DIRECTION_FROM_SERVER]
+
+    def _handle_server_packet(self, packet):
+        if not self.holder.output_only_holding_packets:
+            self._log_packet(DIRECTION_FROM_SERVER, KIND_PASS_THROUGH, packet)
+        self._send_to_client(packet)
+        for released in self.hold_queue.pop_released(HoldingRule.RELEASE_TYPE_FROM_SERVER, packet):
+            self._pass_through_client_to_server_delayed(released)
+
+    # Writes are issued from the event loop thread only, so the order of
+    # pass-through and delayed packets is kept without a lock.
+    def _pass_through_client_to_server_delayed(self, packet):
+        self._log_packet(DIRECTION_TO_SERVER, KIND_DELAYED, packet)
+        self._send_to_server(packet)
+
+    def _send_to_server(self, packet):
+        self.delay_lines[DIRECTION_TO_SERVER].submit(packet)
+
+    def _send_to_client(self, packet):
+        self.delay_lines[DIRECTION_FROM_SERVER].submit(packet)
+
+    def _write_to_server(self, packet):
+        self._queue_packet(DIRECTION_TO_SERVER, packet)
+
+    def _write_to_client(self, packet):
+        self._queue_packet(DIRECTION_FROM_SERVER, packet)
+
+    # Packets for a peer whose writer task has ended (after the end of the
+    # stream or a failed write) are dropped.
+    def _queue_packet(self, direction, packet):
+        writer_task = self.writer_tasks.get(direction)
+        if writer_task is not None and not writer_task.done():
+            self.outgoing[direction].put_nowait(packet)
+
+    # Writes the queued packets to one peer in order and waits for the
+    # transport to drain after each of them. None forwards the end of the
+    # stream with write_eof() and ends the task. Returns False when writing
+    # failed.
+    async def _write_packets(self, writer, queue, peer):
+        try:
+            while True:
+                packet = await queue.get()
+                try:
+                    if packet is None:
+                        if writer.can_write_eof():
+                            writer.write_eof()
+                        return True
+                    writer.write(packet)
+                    await writer.drain()
+                finally:
+                    queue.task_done()
+        except Exception as e:
+            print(f"[Session {self.session_id}] send() to {peer} is failed due to an error: {str(e)}")
+            return False
+        finally:
+            # Nothing is written any more, do not keep join() waiting
+            while not queue.empty():
+                queue.get_nowait()
+                queue.task_done()
+
+    def _log_packet(self, direction, kind, packet):
+        self.holder._log_packet(direction, kind, packet, self.session_id)
+
+    def _on_packet_released(self, holding_rule, size, hold_duration_ns):
+        self.holder.metrics.record_release(holding_rule, size, hold_duration_ns)
+        self.holder._record_event(EVENT_RELEASE, size, self.session_id)
+
+
+# ------------------------------------------------------------------------------
+# AsyncPacketHolder
+# ------------------------------------------------------------------------------
+# Same API and HoldingRule semantics as PacketHolder, but accepts any number of
+# clients. Every client gets its own upstream connection and hold queue, and
+# all sessions are served by one event loop running in a background thread
+# (or in the calling thread with wait=True).
+class AsyncPacketHolder(PacketHolder):
+    LISTEN_BACKLOG = 128
+
+    def __init__(self, num_of_rules=1):
+        super().__init__(num_of_rules)
+        self.loop = None
+        self.serve_task = None
+        self.listening_server = None
+        self.sessions = {}
+        self.session_ids = itertools.count(1)
+        self.loop_thread = None
+        self.listening_socket = None
+        self.reuse_port = False
+
+    def start(self, packet_holder_ip, packet_holder_port, server_ip, server_port, wait=False):
+        if self.started:
+            print("Process is already started")
+            return
+        self.started = True
+        self.bind_address = (packet_holder_ip, packet_holder_port)
+        self.server_address = (server_ip, server_port)
+        # Start with the rules set so far
+        self.wait_for_rule_set()
+        if self.traffic_logger is not None:
+            self.traffic_logger.start()
+        if wait:
+            try:
+                asyncio.run(self._serve())
+            except KeyboardInterrupt:
+                pass
+            finally:
+                if self.traffic_logger is not None:
+                    self.traffic_logger.stop()
+                self.started = False
+        else:
+            self.loop_thread = Thread(target=lambda: asyncio.run(self._serve()))
+            self.loop_thread.start()
+
+    def stop(self):
+        if not self.started:
+            print("Process is already stopped")
+            return
+        print("Stopping the packet holder ...")
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stop_serving)
+        if self.loop_thread is not None:
+            self.loop_thread.join()
+            self.loop_thread = None
+        if self.traffic_logger is not None:
+            self.traffic_logger.stop()
+        self.started = False
+        print("Packet holder is stopped successfully.")
+
+    # Accept the clients on an already bound socket instead of binding to
+    # packet_holder_ip/port in start(), e.g. one shared by several processes.
+    def set_listening_socket(self, listening_socket):
+        self.listening_socket = listening_socket
+
+    # Bind with SO_REUSEPORT, so that several processes can listen on the same
+    # port and the kernel spreads the connections over them.
+    def set_reuse_port(self, status):
+        self.reuse_port = bool(status)
+
+    def send_all_holding_packets(self):
+        if not self.started or self.loop is None:
+            print("Process is not started")
+            return
+        self.loop.call_soon_threadsafe(self._send_all_holding_packets)
+
+    # Applies to the sessions already running as well as to new ones
+    def set_impairment(self, latency_ms=0, jitter_ms=0):
+        super().set_impairment(latency_ms, jitter_ms)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._set_impairment_of_sessions, latency_ms, jitter_ms)
+
+    def get_session_count(self):
+        return len(self.sessions)
+
+    def _get_held_packet_count(self):
+        return sum(len(session.hold_queue) for session, _ in list(self.sessions.values()))
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.serve_task = asyncio.current_task()
+        print("Creating the proxy server for Packet holding ...")
+        try:
+            if self.listening_socket is not None:
+                self.listening_server = await asyncio.start_server(
+                    self._handle_session, sock=self.listening_socket, backlog=self.LISTEN_BACKLOG)
+            else:
+                self.listening_server = await asyncio.start_server(
+                    self._handle_session, *self.bind_address, backlog=self.LISTEN_BACKLOG, reuse_port=self.reuse_port or None)
+        except Exception as e:
+            print(f"An error occurred while listening on {self.bind_address}, error: {str(e)}")
+            self.loop = None
+            return
+        print(f"Listening on {self.bind_address} ...")
+        try:
+            async with self.listening_server:
+                await self.listening_server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for session, task in list(self.sessions.values()):
+                task.cancel()
+                session.close()
+            self.loop = None
+            self.serve_task = None
+
+    def _stop_serving(self):
+        if self.listening_server is not None:
+            self.listening_server.close()
+        if self.serve_task is not None:
+            self.serve_task.cancel()
+
+    async def _handle_session(self, client_reader, client_writer):
+        session_id = next(self.session_ids)
+        session = AsyncSession(self, session_id, client_reader, client_writer)
+        self.sessions[session_id] = (session, asyncio.current_task())
+        try:
+            await session.run()
+        except asyncio.CancelledError:
+            # The holder is stopping
+            pass
+        finally:
+            self.sessions.pop(session_id, None)
+
+    def _set_impairment_of_sessions(self, latency_ms, jitter_ms):
+        for session, _ in self.sessions.values():
+            session.set_impairment(latency_ms, jitter_ms)
+
+    def _send_all_holding_packets(self):
+        for session, _ in self.sessions.values():
+            session.send_all_holding_packets()
+
+
+# ------------------------------------------------------------------------------
+# Main (for sample usage)
+# ------------------------------------------------------------------------------
+if __name__ == "__main__":
+    packet_holder_ip = "localhost"
+    packet_holder_port = 16000
+    real_server_ip = "localhost"
+    real_server_port = 6000
+    packet_holder = AsyncPacketHolder()
+    packet_holder.set_holding_rule(index=0, holding_keyword="333", enable=True)
+    packet_holder.start(packet_holder_ip, packet_holder_port, real_server_ip, real_server_port, wait=True)
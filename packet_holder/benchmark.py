@@ -0,0 +1,501 @@
+# benchmark.py
+# Description: This file contains the load test of the PacketHolder. Clients
+# send fixed size messages through the holder to an in-process echo server and
+# the throughput, the latency added by the holder and the CPU time per GB are
+# reported, optionally as JSON which can be compared with a previous run.
+#
+# Usage:
+#   python benchmark.py --mode pass-through holding --clients 1 8 --sizes 64 4096
+#   python benchmark.py --json new.json --compare old.json --tolerance 0.2
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import argparse
+import json
+import platform
+import socket
+import struct
+import sys
+from threading import Lock
+from threading import Thread
+import time
+
+from async_packet_holder import AsyncPacketHolder
+from framers import FixedSizeFramer
+from holder_metrics import LatencyHistogram
+from packet_holder import HoldingRule
+from packet_holder import PacketHolder
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------------
+MODE_PASS_THROUGH = "pass-through"
+MODE_HOLDING = "holding"
+MODE_RELEASE_STORM = "release-storm"
+MODES = (MODE_PASS_THROUGH, MODE_HOLDING, MODE_RELEASE_STORM)
+
+HOLDER_ASYNC = "async"
+HOLDER_THREAD = "thread"
+
+HOLD_KEYWORD = "HOLD"
+MARKER_HOLD = HOLD_KEYWORD.encode()
+MARKER_PASS = b"PASS"
+
+# Every message starts with a 4 byte marker and its send time
+# (perf_counter_ns) and is padded to the message size.
+MESSAGE_HEADER = struct.Struct("<4sq")
+PADDING = b"."
+
+CLIENT_TIMEOUT = 30.0
+CONNECT_TIMEOUT = 5.0
+HOLD_WAIT_TIMEOUT = 30.0
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# EchoServer
+# ------------------------------------------------------------------------------
+# Echoes everything back on every accepted connection, one thread per
+# connection. recv_into() a reused buffer keeps the cost of the server itself
+# low, since it is included in the measured CPU time.
+class EchoServer:
+    def __init__(self, host="127.0.0.1", port=0, recv_size=65536):
+        self.address = (host, port)
+        self.recv_size = recv_size
+        self.listening_socket = None
+        self.connections = []
+        self.lock = Lock()
+        self.thread = None
+
+    def start(self):
+        self.listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listening_socket.bind(self.address)
+        self.listening_socket.listen(128)
+        self.address = self.listening_socket.getsockname()
+        self.thread = Thread(target=self._accept_loop, daemon=True)
+        self.thread.start()
+
+    def get_address(self):
+        return self.address
+
+    def stop(self):
+        _close_socket(self.listening_socket)
+        with self.lock:
+            for connection in self.connections:
+                _close_socket(connection)
+            self.connections = []
+        self.thread.join()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                connection, _ = self.listening_socket.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections.append(connection)
+            Thread(target=self._echo, args=(connection,), daemon=True).start()
+
+    def _echo(self, connection):
+        buffer = bytearray(self.recv_size)
+        view = memoryview(buffer)
+        while True:
+            try:
+                size = connection.recv_into(buffer)
+                if size == 0:
+                    return
+                connection.sendall(view[:size])
+            except OSError:
+                return
+
+
+# ------------------------------------------------------------------------------
+# BenchmarkClient
+# ------------------------------------------------------------------------------
+# Sends count messages of size bytes and records the round trip of each echo
+# in a LatencyHistogram. With rate 0 the next message is sent when the echo of
+# the previous one arrived (closed loop); otherwise messages are sent at rate
+# messages/sec regardless of the echoes and received on a second thread.
+class BenchmarkClient:
+    def __init__(self, address, size, count, rate=0, marker=MARKER_PASS):
+        self.address = address
+        self.size = size
+        self.count = count
+        self.rate = rate
+        self.message = bytearray(PADDING * size)
+        MESSAGE_HEADER.pack_into(self.message, 0, marker, 0)
+        self.receive_buffer = bytearray(size)
+        self.histogram = LatencyHistogram()
+        self.socket = None
+        self.since_ns = None
+        self.error = None
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.socket = socket.create_connection(self.address, timeout=CLIENT_TIMEOUT)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.socket is not None:
+            _close_socket(self.socket)
+            self.socket = None
+
+    def run(self):
+        try:
+            if self.rate > 0:
+                self._run_paced()
+            else:
+                self._run_closed_loop()
+        except OSError as e:
+            self.error = str(e)
+
+    # Sends every message without waiting for the echoes (release storm).
+    def send_messages(self):
+        for _ in range(self.count):
+            self._send_message()
+
+    # Receives every echo. When since_ns is set by the time an echo arrives,
+    # the latency is measured from since_ns instead of the send time.
+    def receive_messages(self):
+        try:
+            for _ in range(self.count):
+                self._receive_message()
+        except OSError as e:
+            self.error = str(e)
+
+    def _run_closed_loop(self):
+        for _ in range(self.count):
+            self._send_message()
+            self._receive_message()
+
+    def _run_paced(self):
+        receiver = Thread(target=self.receive_messages)
+        receiver.start()
+        interval = 1.0 / self.rate
+        next_send_at = time.monotonic()
+        for _ in range(self.count):
+            delay = next_send_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._send_message()
+            next_send_at += interval
+        receiver.join()
+
+    def _send_message(self):
+        struct.pack_into("<q", self.message, 4, time.perf_counter_ns())
+        self.socket.sendall(self.message)
+
+    def _receive_message(self):
+        view = memoryview(self.receive_buffer)
+        received = 0
+        while received < self.size:
+            size = self.socket.recv_into(view[received:])
+            if size == 0:
+                raise ConnectionResetError("Connection closed before all echoes were received")
+            received += size
+        now = time.perf_counter_ns()
+        _, sent_at = MESSAGE_HEADER.unpack_from(self.receive_buffer)
+        since_ns = self.since_ns if self.since_ns is not None else sent_at
+        self.histogram.record(now - since_ns)
+
+
+# ------------------------------------------------------------------------------
+# Benchmark
+# ------------------------------------------------------------------------------
+# Runs one scenario per (mode, clients, size):
+#   pass-through:  no holding rule, so the holder only forwards (the fast path
+#                  is used unless it is disabled).
+#   holding:       every message is held by a RELEASE_TYPE_AFTER_DELAY rule and
+#                  released after hold_delay_ms.
+#   release-storm: every client sends all its messages, which are all held;
+#                  then send_all_holding_packets() releases them at once and
+#                  the latency is measured from that call.
+# For pass-through and holding the same load is first run directly against
+# the echo server, and the difference is reported as the added latency and
+# CPU time. CPU time is the process CPU time (clients and echo server
+# included) per GB of messages sent by the clients.
+class Benchmark:
+    def __init__(self, holder_type=HOLDER_ASYNC, fast_path=True, log=False, host="127.0.0.1"):
+        self.holder_type = holder_type
+        self.fast_path = fast_path
+        self.log = log
+        self.host = host
+
+    def run_scenario(self, mode, clients, size, count, rate=0, hold_delay_ms=0):
+        result = {
+            "mode": mode, "holder": self.holder_type, "clients": clients, "size": size,
+            "messages": count, "rate": rate, "hold_delay_ms": hold_delay_ms, "fast_path": self.fast_path,
+        }
+        if size < MESSAGE_HEADER.size:
+            result["error"] = f"size must be at least {MESSAGE_HEADER.size} bytes"
+            return result
+        if self.holder_type == HOLDER_THREAD and clients > 1:
+            result["error"] = "PacketHolder accepts only one client, use --holder async"
+            return result
+        try:
+            result.update(self._run_scenario(mode, clients, size, count, rate, hold_delay_ms))
+        except Exception as e:
+            print(f"An error occurred while running {mode} with {clients} clients: {str(e)}")
+            result["error"] = str(e)
+        return result
+
+    def _run_scenario(self, mode, clients, size, count, rate, hold_delay_ms):
+        echo_server = EchoServer(self.host)
+        echo_server.start()
+        try:
+            baseline = None
+            if mode != MODE_RELEASE_STORM:
+                baseline = self._run_load(echo_server.get_address(), clients, size, count, rate, MARKER_PASS)
+            holder = self._create_holder(mode, size, hold_delay_ms)
+            holder_address = (self.host, _find_free_port(self.host))
+            holder.start(holder_address[0], holder_address[1], *echo_server.get_address())
+            try:
+                if mode == MODE_RELEASE_STORM:
+                    measured = self._run_release_storm(holder, holder_address, clients, size, count)
+                else:
+                    marker = MARKER_HOLD if mode == MODE_HOLDING else MARKER_PASS
+                    measured = self._run_load(holder_address, clients, size, count, rate, marker)
+                holder_metrics = holder.get_metrics()
+            finally:
+                holder.stop()
+        finally:
+            echo_server.stop()
+        summary = self._summarize(measured, baseline, clients * count * size)
+        summary["holder_directions"] = holder_metrics["directions"]
+        return summary
+
+    def _create_holder(self, mode, size, hold_delay_ms):
+        holder = AsyncPacketHolder() if self.holder_type == HOLDER_ASYNC else PacketHolder()
+        if not self.log:
+            holder.set_traffic_logger(None)
+        holder.set_fast_path(self.fast_path)
+        if mode == MODE_HOLDING:
+            holder.set_holding_rule(index=0, holding_keyword=HOLD_KEYWORD, release_type=HoldingRule.RELEASE_TYPE_AFTER_DELAY,
+                                    release_delay_ms=hold_delay_ms, enable=True)
+        elif mode == MODE_RELEASE_STORM:
+            holder.set_holding_rule(index=0, holding_keyword=HOLD_KEYWORD, enable=True)
+        if mode != MODE_PASS_THROUGH:
+            # One frame per message, so every message is matched on its own
+            holder.set_framer(lambda: FixedSizeFramer(size))
+        return holder
+
+    # Returns (histogram, elapsed seconds, cpu seconds, errors).
+    def _run_load(self, address, clients, size, count, rate, marker):
+        benchmark_clients = [BenchmarkClient(address, size, count, rate, marker) for _ in range(clients)]
+        try:
+            for client in benchmark_clients:
+                client.connect()
+            threads = [Thread(target=client.run) for client in benchmark_clients]
+            cpu_started_at = time.process_time()
+            started_at = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started_at
+            cpu = time.process_time() - cpu_started_at
+        finally:
+            for client in benchmark_clients:
+                client.close()
+        return self._collect(benchmark_clients, elapsed, cpu)
+
+    def _run_release_storm(self, holder, address, clients, size, count):
+        benchmark_clients = [BenchmarkClient(address, size, count, 0, MARKER_HOLD) for _ in range(clients)]
+        try:
+            for client in benchmark_clients:
+                client.connect()
+            for client in benchmark_clients:
+                client.send_messages()
+            deadline = time.monotonic() + HOLD_WAIT_TIMEOUT
+            while holder.get_metrics()["queue_depth"] < clients * count:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("Messages were not held in time")
+                time.sleep(0.01)
+            threads = [Thread(target=client.receive_messages) for client in benchmark_clients]
+            for thread in threads:
+                thread.start()
+            cpu_started_at = time.process_time()
+            released_at = time.perf_counter_ns()
+            for client in benchmark_clients:
+                client.since_ns = released_at
+            holder.send_all_holding_packets()
+            for thread in threads:
+                thread.join()
+            elapsed = (time.perf_counter_ns() - released_at) / 1e9
+            cpu = time.process_time() - cpu_started_at
+        finally:
+            for client in benchmark_clients:
+                client.close()
+        return self._collect(benchmark_clients, elapsed, cpu)
+
+    @staticmethod
+    def _collect(benchmark_clients, elapsed, cpu):
+        histogram = LatencyHistogram()
+        errors = []
+        for client in benchmark_clients:
+            histogram.merge(client.histogram)
+            if client.error is not None:
+                errors.append(client.error)
+        return (histogram, elapsed, cpu, errors)
+
+    @staticmethod
+    def _summarize(measured, baseline, total_bytes):
+        histogram, elapsed, cpu, errors = measured
+        gigabytes = total_bytes / 1e9
+        summary = {
+            "duration_sec": elapsed,
+            "throughput_msgs_per_sec": histogram.count / elapsed if elapsed > 0 else 0.0,
+            "throughput_mb_per_sec": total_bytes / elapsed / 1e6 if elapsed > 0 else 0.0,
+            "latency_ns": histogram.snapshot(),
+            "cpu_sec": cpu,
+            "cpu_sec_per_gb": cpu / gigabytes,
+            "baseline_latency_ns": None,
+            "added_latency_ns": None,
+            "baseline_cpu_sec_per_gb": None,
+            "added_cpu_sec_per_gb": None,
+        }
+        if baseline is not None:
+            baseline_histogram, _, baseline_cpu, baseline_errors = baseline
+            errors = errors + baseline_errors
+            baseline_latency = baseline_histogram.snapshot()
+            summary["baseline_latency_ns"] = baseline_latency
+            summary["added_latency_ns"] = {
+                key: summary["latency_ns"][key] - baseline_latency[key]
+                for key in ("p50", "p99")
+                if summary["latency_ns"][key] is not None and baseline_latency[key] is not None
+            }
+            summary["baseline_cpu_sec_per_gb"] = baseline_cpu / gigabytes
+            summary["added_cpu_sec_per_gb"] = (cpu - baseline_cpu) / gigabytes
+        if errors:
+            summary["error"] = "; ".join(errors)
+        return summary
+
+
+# ------------------------------------------------------------------------------
+# Regression check
+# ------------------------------------------------------------------------------
+def _scenario_key(result):
+    return (result["mode"], result["holder"], result["clients"], result["size"], result["rate"], result.get("fast_path", True))
+
+# Returns a message for every scenario whose throughput dropped or whose p99
+# latency grew by more than tolerance compared with previous_results.
+def find_regressions(results, previous_results, tolerance):
+    previous = {_scenario_key(result): result for result in previous_results}
+    regressions = []
+    for result in results:
+        old = previous.get(_scenario_key(result))
+        if old is None or "error" in result or "error" in old:
+            continue
+        name = f"{result['mode']} clients={result['clients']} size={result['size']}"
+        if result["throughput_msgs_per_sec"] < old["throughput_msgs_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {old['throughput_msgs_per_sec']:.0f} -> {result['throughput_msgs_per_sec']:.0f} msgs/sec")
+        old_p99 = old["latency_ns"]["p99"]
+        new_p99 = result["latency_ns"]["p99"]
+        if old_p99 and new_p99 and new_p99 > old_p99 * (1 + tolerance):
+            regressions.append(f"{name}: p99 latency {old_p99 / 1000:.1f} -> {new_p99 / 1000:.1f} us")
+    return regressions
+
+
+def format_result(result):
+    name = f"{result['mode']:<13} clients={result['clients']:<3} size={result['size']:<6}"
+    if "latency_ns" not in result:
+        return f"{name} error: {result['error']}"
+    latency = result["latency_ns"]
+    text = (f"{name} {result['throughput_msgs_per_sec']:>9.0f} msgs/s {result['throughput_mb_per_sec']:>8.2f} MB/s"
+            f"  p50={_format_us(latency['p50'])} p99={_format_us(latency['p99'])}")
+    added = result["added_latency_ns"]
+    if added:
+        text += f"  added p50={_format_us(added.get('p50'))} p99={_format_us(added.get('p99'))}"
+    text += f"  cpu={result['cpu_sec_per_gb']:.1f}s/GB"
+    if result["added_cpu_sec_per_gb"] is not None:
+        text += f" (added {result['added_cpu_sec_per_gb']:.1f}s/GB)"
+    if "error" in result:
+        text += f"  error: {result['error']}"
+    return text
+
+
+def _format_us(value_ns):
+    if value_ns is None:
+        return "-"
+    return f"{value_ns / 1000:.1f}us"
+
+
+def _find_free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def _close_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+# ------------------------------------------------------------------------------
+# Main
+# ------------------------------------------------------------------------------
+def main(argv):
+    parser = argparse.ArgumentParser(description="Load test of the PacketHolder")
+    parser.add_argument("--mode", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--holder", choices=(HOLDER_ASYNC, HOLDER_THREAD), default=HOLDER_ASYNC)
+    parser.add_argument("--clients", nargs="+", type=int, default=[1])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[64, 1024, 16384])
+    parser.add_argument("--messages", type=int, default=2000, help="messages per client")
+    parser.add_argument("--rate", type=float, default=0, help="messages/sec per client, 0 for closed loop")
+    parser.add_argument("--hold-delay-ms", type=int, default=0, help="release delay of the holding mode")
+    parser.add_argument("--no-fast-path", action="store_true")
+    parser.add_argument("--log", action="store_true", help="keep the traffic log of the holder on")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="previous results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(args.holder, fast_path=not args.no_fast_path, log=args.log)
+    results = []
+    for mode in args.mode:
+        for clients in args.clients:
+            for size in args.sizes:
+                result = benchmark.run_scenario(mode, clients, size, args.messages, args.rate, args.hold_delay_ms)
+                results.append(result)
+    print()
+    for result in results:
+        print(format_result(result))
+
+    if args.json:
+        report = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results are written to {args.json}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            previous_results = json.load(file)["results"]
+        regressions = find_regressions(results, previous_results, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print("No regression found.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+# direct_forwarder.py
+# Description: This file contains the DirectForwarder class, which moves data
+# from one socket to another without creating Python bytes objects. It is used
+# by PacketHolder when nothing needs to look at the data of a direction.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import os
+import select
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import termios
+except ImportError:
+    termios = None
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# DirectForwarder
+# ------------------------------------------------------------------------------
+# On Linux the data is moved kernel-to-kernel with os.splice() through a pipe.
+# Elsewhere (or if the pipe can not be created) it falls back to recv_into() a
+# reused bytearray and sendall() of a memoryview, which avoids the allocation
+# and copy of a new bytes object per chunk.
+class DirectForwarder:
+    def __init__(self, src_socket, dst_socket, chunk_size, send_lock=None, use_splice=True):
+        self.src_socket = src_socket
+        self.dst_socket = dst_socket
+        self.chunk_size = chunk_size
+        self.send_lock = send_lock
+        self.pipe = None
+        self.buffer = None
+        self.view = None
+        if use_splice and hasattr(os, 'splice'):
+            try:
+                self.pipe = os.pipe()
+            except OSError:
+                self.pipe = None
+            else:
+                self._grow_pipe()
+        if self.pipe is None:
+            self.buffer = bytearray(chunk_size)
+            self.view = memoryview(self.buffer)
+
+    def is_splice(self):
+        return self.pipe is not None
+
+    # Blocks until the source socket has data or is at EOF, and returns the
+    # number of bytes that can be read without blocking (0 at EOF). None is
+    # returned when the platform can not tell the number of bytes. The caller
+    # can check whether the data still may be forwarded uninspected and then
+    # forward only these bytes, so nothing received after the check is
+    # forwarded without being checked.
+    def wait_readable(self):
+        select.select([self.src_socket], [], [])
+        if fcntl is None or termios is None or not hasattr(termios, 'FIONREAD'):
+            return None
+        try:
+            available = bytearray(4)
+            fcntl.ioctl(self.src_socket.fileno(), termios.FIONREAD, available)
+        except OSError:
+            return None
+        return int.from_bytes(available, byteorder=sys.byteorder, signed=True)
+
+    # Forwards one chunk of at most limit bytes (chunk_size when limit is
+    # None). Returns the number of bytes forwarded, 0 at EOF.
+    # OSError is raised as it is.
+    def forward(self, limit=None):
+        size = self.chunk_size if limit is None else min(limit, self.chunk_size)
+        if self.pipe is not None:
+            return self._forward_splice(size)
+        return self._forward_copy(size)
+
+    def close(self):
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+
+    # A pipe holds 64KB by default; grow it so one splice can move a whole
+    # chunk. Failing to grow it only means more splice calls.
+    def _grow_pipe(self):
+        if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+            return
+        try:
+            fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, self.chunk_size)
+        except OSError:
+            pass
+
+    def _forward_splice(self, size):
+        if size == 0:
+            return 0
+        pipe_read, pipe_write = self.pipe
+        size = os.splice(self.src_socket.fileno(), pipe_write, size)
+        if size == 0:
+            return 0
+        if self.send_lock is not None:
+            with self.send_lock:
+                self._drain_pipe(pipe_read, size)
+        else:
+            self._drain_pipe(pipe_read, size)
+        return size
+
+    def _drain_pipe(self, pipe_read, size):
+        dst_fd = self.dst_socket.fileno()
+        remaining = size
+        while remaining > 0:
+            remaining -= os.splice(pipe_read, dst_fd, remaining)
+
+    def _forward_copy(self, size):
+        if size == 0:
+            return 0
+        size = self.src_socket.recv_into(self.buffer, size)
+        if size == 0:
+            return 0
+        if self.send_lock is not None:
+            with self.send_lock:
+                self.dst_socket.sendall(self.view[:size])
+        else:
+            self.dst_socket.sendall(self.view[:size])
+        return size
@@ -0,0 +1,113 @@
+# framers.py
+# Description: This file contains the framers which split a TCP byte stream
+# into application messages, so that holding rules are applied to whole
+# messages instead of to whatever one recv() happened to return.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Framers
+# ------------------------------------------------------------------------------
+# All framers share the same small interface:
+#   feed(data) -> list of complete frames (bytes), the rest is kept buffered
+#   flush()    -> the buffered bytes of an incomplete frame (and clears them)
+#   pending()  -> the number of buffered bytes
+# Frames keep their header/delimiter, so forwarding the frames one after
+# another sends exactly the bytes that were received.
+# A framer raises FramingError when the stream cannot be framed any more
+# (for example a length header larger than max_frame_size).
+# ------------------------------------------------------------------------------
+class FramingError(Exception):
+    pass
+
+
+# Every recv() result is one frame. This is the original PacketHolder behavior.
+class RawFramer:
+    def feed(self, data):
+        return [data]
+
+    def flush(self):
+        return b""
+
+    def pending(self):
+        return 0
+
+
+class BufferedFramer:
+    def __init__(self, max_frame_size):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        start = 0
+        while True:
+            end = self._frame_end(start)
+            if end is None:
+                break
+            frames.append(bytes(self.buffer[start:end]))
+            start = end
+        if start:
+            del self.buffer[:start]
+        if len(self.buffer) > self.max_frame_size:
+            raise FramingError(f"Frame exceeds {self.max_frame_size} bytes")
+        return frames
+
+    def flush(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    def pending(self):
+        return len(self.buffer)
+
+    # Returns the end offset of the frame starting at start, or None if the
+    # frame is not complete yet.
+    def _frame_end(self, start):
+        raise NotImplementedError
+
+
+# [header_size bytes: payload length][payload], as used by
+# packet_size_checking/client.py (4-byte big-endian length).
+class LengthPrefixedFramer(BufferedFramer):
+    def __init__(self, header_size=4, byteorder='big', max_frame_size=16 * 1024 * 1024):
+        super().__init__(max_frame_size)
+        self.header_size = header_size
+        self.byteorder = byteorder
+
+    def _frame_end(self, start):
+        header_end = start + self.header_size
+        if len(self.buffer) < header_end:
+            return None
+        length = int.from_bytes(self.buffer[start:header_end], self.byteorder)
+        if length + self.header_size > self.max_frame_size:
+            raise FramingError(f"Frame length {length} exceeds {self.max_frame_size} bytes")
+        end = header_end + length
+        if len(self.buffer) < end:
+            return None
+        return end
+
+
+# Frames end with delimiter (b"\n" by default), which is kept in the frame.
+class DelimiterFramer(BufferedFramer):
+    def __init__(self, delimiter=b"\n", max_frame_size=1024 * 1024):
+        super().__init__(max_frame_size)
+        self.delimiter = delimiter
+
+    def _frame_end(self, start):
+        index = self.buffer.find(self.delimiter, start)
+        if index < 0:
+            return None
+        return index + len(self.delimiter)
+
+
+# Every frame is exactly size bytes.
+class FixedSizeFramer(BufferedFramer):
+    def __init__(self, size):
+        super().__init__(size)
+        self.size = size
+
+    def _frame_end(self, start):
+        end = start + self.size
+        if len(self.buffer) < end:
+            return None
+        return end
@@ -0,0 +1,266 @@
+# hold_queue.py
+# Description: This file contains the HoldQueue class, which keeps the packets
+# held by the PacketHolder, indexed by the way they are going to be released.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import collections
+import heapq
+import itertools
+import mmap
+import tempfile
+from threading import Lock
+import time
+
+from rule_matcher import KeywordMatcher
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# SpillSegment
+# ------------------------------------------------------------------------------
+# An append-only temporary file for held packets which do not fit in memory.
+# Packets are appended with unbuffered writes and read back through a
+# read-only mmap, which is re-mapped when it does not cover the file any more.
+# When every spilled packet has been read back the file is truncated, so the
+# disk usage does not grow over several hold/release cycles.
+class SpillSegment:
+    def __init__(self, spill_dir=None):
+        self.file = tempfile.TemporaryFile(prefix="packet_holder_spill_", dir=spill_dir, buffering=0)
+        self.lock = Lock()
+        self.size = 0
+        self.live = 0
+        self.map = None
+
+    def append(self, packet):
+        with self.lock:
+            offset = self.size
+            self.file.write(packet)
+            self.size += len(packet)
+            self.live += 1
+        return (offset, len(packet))
+
+    def read(self, location):
+        offset, length = location
+        with self.lock:
+            if length == 0:
+                packet = b""
+            else:
+                if self.map is None or len(self.map) < offset + length:
+                    self._remap()
+                packet = self.map[offset:offset + length]
+            self.live -= 1
+            if self.live == 0:
+                self._reset()
+        return packet
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.close()
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _reset(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.truncate(0)
+        self.file.seek(0)
+        self.size = 0
+
+
+# ------------------------------------------------------------------------------
+# HoldQueue
+# ------------------------------------------------------------------------------
+# Held packets are bucketed by HoldingRule.get_release_key(), i.e.
+# (release_type, release_keyword) for keyword releases. Each bucket is a
+# deque in hold order and every entry carries a global sequence number, so the
+# original order can be restored when several buckets are released together.
+# For each release type one KeywordMatcher is compiled over the distinct
+# release keywords, so checking an incoming packet costs one match per distinct
+# keyword instead of one per held packet.
+#
+# With memory_limit (bytes) set, packets which would exceed it are spilled to a
+# SpillSegment and only their (offset, length) is kept in the bucket. Released
+# packets are read back before the pop returns: the accounting of the popped
+# packets is already removed, so a spilled packet left unread by a caller which
+# stopped early would be lost and the spill file would never be truncated.
+# A rule's max_held_packets/max_held_bytes limit is checked in put(); put()
+# returns the sequence number of the held packet, or None when the packet can
+# not be held any more.
+# release_callback(holding_rule, size, hold_duration_ns) is called for every
+# popped packet, with the lock held.
+class HoldQueue:
+    def __init__(self, memory_limit=None, spill_dir=None, release_callback=None):
+        self.lock = Lock()
+        self.buckets = {}
+        self.release_matchers = {}
+        self.sequence = itertools.count()
+        self.count = 0
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.memory_bytes = 0
+        self.spilled_packets = 0
+        self.spill_segment = None
+        self.rule_usage = {}
+        self.release_callback = release_callback
+
+    def __len__(self):
+        return self.count
+
+    def set_memory_limit(self, memory_limit, spill_dir=None):
+        with self.lock:
+            self.memory_limit = memory_limit
+            self.spill_dir = spill_dir
+
+    def get_usage(self):
+        with self.lock:
+            return {"packets": self.count, "memory_bytes": self.memory_bytes, "spilled_packets": self.spilled_packets}
+
+    def put(self, packet, holding_rule):
+        key = holding_rule.get_release_key()
+        size = len(packet)
+        with self.lock:
+            usage = self.rule_usage.get(holding_rule, (0, 0))
+            if not self._is_within_rule_limits(holding_rule, usage, size):
+                return None
+            self.rule_usage[holding_rule] = (usage[0] + 1, usage[1] + size)
+            if self.memory_limit is not None and self.memory_bytes + size > self.memory_limit:
+                if self.spill_segment is None:
+                    self.spill_segment = SpillSegment(self.spill_dir)
+                data = self.spill_segment.append(packet)
+                self.spilled_packets += 1
+            else:
+                data = packet
+                self.memory_bytes += size
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = collections.deque()
+                self.release_matchers.pop(key[0], None)
+            seq = next(self.sequence)
+            bucket.append((seq, data, holding_rule, size, time.perf_counter_ns()))
+            self.count += 1
+        return seq
+
+    # Pops every held packet, in the order they were held.
+    def pop_all(self):
+        with self.lock:
+            buckets = list(self.buckets.values())
+            self.buckets = {}
+            self.release_matchers = {}
+            self._forget(buckets)
+        return self._merge(buckets)
+
+    # Pops the packets whose release rule is triggered by packet.
+    def pop_released(self, release_type, packet):
+        if not self.buckets:
+            return []
+        release_matcher = self.release_matchers.get(release_type)
+        if release_matcher is None:
+            release_matcher = self._build_release_matcher(release_type)
+        matcher, keys = release_matcher
+        if matcher is None:
+            return []
+        indexes = matcher.all_matches(packet)
+        if not indexes:
+            return []
+        released = []
+        with self.lock:
+            for index in indexes:
+                bucket = self.buckets.pop(keys[index], None)
+                if bucket is not None:
+                    released.append(bucket)
+            if released:
+                self.release_matchers.pop(release_type, None)
+                self._forget(released)
+        return self._merge(released)
+
+    # Pops the packets at the head of the bucket of key up to sequence number
+    # seq (used for the packets which became due after a delay).
+    def pop_due(self, key, seq):
+        return self._pop_head(key, lambda entry: entry[0] <= seq)
+
+    # Pops up to count packets at the head of the bucket of key.
+    def pop_head(self, key, count):
+        remaining = [count]
+        def take(entry):
+            remaining[0] -= 1
+            return remaining[0] >= 0
+        return self._pop_head(key, take)
+
+    def has_bucket(self, key):
+        return key in self.buckets
+
+    def close(self):
+        with self.lock:
+            if self.spill_segment is not None:
+                self.spill_segment.close()
+                self.spill_segment = None
+
+    def _pop_head(self, key, condition):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                return []
+            popped = collections.deque()
+            while bucket and condition(bucket[0]):
+                popped.append(bucket.popleft())
+            if not bucket:
+                del self.buckets[key]
+                self.release_matchers.pop(key[0], None)
+            if not popped:
+                return []
+            self._forget([popped])
+        return self._merge([popped])
+
+    def _is_within_rule_limits(self, holding_rule, usage, size):
+        max_packets = holding_rule.get_max_held_packets()
+        max_bytes = holding_rule.get_max_held_bytes()
+        if max_packets and usage[0] + 1 > max_packets:
+            return False
+        if max_bytes and usage[1] + size > max_bytes:
+            return False
+        return True
+
+    # Removes the accounting of the popped buckets. Called with the lock held.
+    def _forget(self, buckets):
+        now = time.perf_counter_ns()
+        for bucket in buckets:
+            self.count -= len(bucket)
+            for _, data, holding_rule, size, held_at in bucket:
+                if self.release_callback is not None:
+                    self.release_callback(holding_rule, size, now - held_at)
+                packets, held_bytes = self.rule_usage.pop(holding_rule)
+                if packets > 1:
+                    self.rule_usage[holding_rule] = (packets - 1, held_bytes - size)
+                if isinstance(data, bytes):
+                    self.memory_bytes -= size
+                else:
+                    self.spilled_packets -= 1
+
+    def _build_release_matcher(self, release_type):
+        with self.lock:
+            keys = [key for key in self.buckets if key[0] == release_type]
+            matcher = KeywordMatcher([key[1] for key in keys]) if keys else None
+            release_matcher = (matcher, keys)
+            self.release_matchers[release_type] = release_matcher
+        return release_matcher
+
+    def _merge(self, buckets):
+        if len(buckets) == 1:
+            entries = buckets[0]
+        else:
+            entries = heapq.merge(*buckets, key=lambda entry: entry[0])
+        if self.spill_segment is None:
+            return [entry[1] for entry in entries]
+        return self._read_back(entries, self.spill_segment)
+
+    @staticmethod
+    def _read_back(entries, spill_segment):
+        return [data if isinstance(data, bytes) else spill_segment.read(data) for _, data, _, _, _ in entries]
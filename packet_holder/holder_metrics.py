@@ -0,0 +1,367 @@
+# holder_metrics.py
+# Description: This file contains the counters and latency histograms of the
+# PacketHolder, and a small HTTP server exposing them in the Prometheus text
+# format.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+from threading import Lock
+from threading import Thread
+import time
+
+from traffic_logger import DIRECTION_FROM_SERVER
+from traffic_logger import DIRECTION_TO_SERVER
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# LatencyHistogram
+# ------------------------------------------------------------------------------
+# HDR-style log-linear histogram of non-negative integers (nanoseconds here).
+# Values below 2^SUB_BUCKET_BITS get their own bucket; above that, every power
+# of two is split into 2^(SUB_BUCKET_BITS-1) linear buckets, so the relative
+# error of a reported value is below 2^-(SUB_BUCKET_BITS-1) (about 3%) with a
+# few hundred buckets covering nanoseconds to hours.
+class LatencyHistogram:
+    SUB_BUCKET_BITS = 6
+
+    def __init__(self):
+        self.half = 1 << (self.SUB_BUCKET_BITS - 1)
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.lock = Lock()
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        index = self._bucket_index(value)
+        with self.lock:
+            counts = self.counts
+            if index >= len(counts):
+                counts.extend([0] * (index + 1 - len(counts)))
+            counts[index] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        self.merge_state(other.get_state())
+
+    # The histogram as a picklable tuple, e.g. to send it to another process.
+    def get_state(self):
+        with self.lock:
+            return (list(self.counts), self.count, self.total, self.min, self.max)
+
+    def merge_state(self, state):
+        counts, count, total, min_value, max_value = state
+        with self.lock:
+            if len(counts) > len(self.counts):
+                self.counts.extend([0] * (len(counts) - len(self.counts)))
+            for index, bucket_count in enumerate(counts):
+                self.counts[index] += bucket_count
+            self.count += count
+            self.total += total
+            if min_value is not None and (self.min is None or min_value < self.min):
+                self.min = min_value
+            if max_value is not None and (self.max is None or max_value > self.max):
+                self.max = max_value
+
+    # Returns the value at percentile (0-100), or None if nothing was recorded.
+    # The upper end of the bucket is reported, clamped to the recorded max.
+    def percentile(self, percentile):
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = max(1, int(round(self.count * percentile / 100.0)))
+            seen = 0
+            for index, bucket_count in enumerate(self.counts):
+                seen += bucket_count
+                if seen >= rank:
+                    return min(self._bucket_upper(index), self.max)
+            return self.max
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        summary = {"count": self.count, "sum": self.total, "min": self.min, "max": self.max}
+        for percentile in percentiles:
+            summary[f"p{percentile:g}"] = self.percentile(percentile)
+        return summary
+
+    def _bucket_index(self, value):
+        if value < 2 * self.half:
+            return value
+        shift = value.bit_length() - self.SUB_BUCKET_BITS
+        return (shift + 1) * self.half + (value >> shift) - self.half
+
+    def _bucket_upper(self, index):
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        mantissa = index - shift * self.half
+        return ((mantissa + 1) << shift) - 1
+
+
+# ------------------------------------------------------------------------------
+# Metrics
+# ------------------------------------------------------------------------------
+class DirectionMetrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.packets = 0
+        self.bytes = 0
+        self.forward_latency = LatencyHistogram()
+
+    def record_forward(self, size, latency_ns):
+        self.record_transfer(size)
+        self.forward_latency.record(latency_ns)
+
+    def record_transfer(self, size):
+        with self.lock:
+            self.packets += 1
+            self.bytes += size
+
+
+class RuleMetrics:
+    def __init__(self, keyword=""):
+        # The keyword of the latest version of the rule
+        self.keyword = keyword
+        self.lock = Lock()
+        self.held_packets = 0
+        self.held_bytes = 0
+        self.released_packets = 0
+        self.released_bytes = 0
+        self.hold_duration = LatencyHistogram()
+
+    def record_hold(self, size):
+        with self.lock:
+            self.held_packets += 1
+            self.held_bytes += size
+
+    def record_release(self, size, hold_duration_ns):
+        with self.lock:
+            self.released_packets += 1
+            self.released_bytes += size
+        self.hold_duration.record(hold_duration_ns)
+
+
+# Metrics of one PacketHolder. rule_label is a callable returning the label of
+# a HoldingRule (its index); the metrics of a rule are kept per label, so they
+# add up over the versions of the rule. queue_depth is a callable returning
+# the number of held packets, read only when a snapshot is taken.
+class HolderMetrics:
+    DIRECTION_NAMES = {DIRECTION_TO_SERVER: "to_server", DIRECTION_FROM_SERVER: "from_server"}
+
+    def __init__(self, rule_label, queue_depth):
+        self.rule_label = rule_label
+        self.queue_depth = queue_depth
+        self.started_at = time.monotonic()
+        self.directions = {direction: DirectionMetrics() for direction in self.DIRECTION_NAMES}
+        self.rules = {}
+        self.rules_lock = Lock()
+
+    def record_forward(self, direction, size, latency_ns):
+        self.directions[direction].record_forward(size, latency_ns)
+
+    # Data moved by the fast path has no forward latency: the time spent in the
+    # kernel can not be told apart from the time spent waiting for data.
+    def record_transfer(self, direction, size):
+        self.directions[direction].record_transfer(size)
+
+    def record_hold(self, holding_rule, size):
+        metrics = self._rule_metrics(holding_rule)
+        metrics.keyword = holding_rule.get_holding_keyword()
+        metrics.record_hold(size)
+
+    def record_release(self, holding_rule, size, hold_duration_ns):
+        self._rule_metrics(holding_rule).record_release(size, hold_duration_ns)
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started_at
+        directions = {}
+        for direction, metrics in self.directions.items():
+            directions[self.DIRECTION_NAMES[direction]] = {
+                "packets": metrics.packets,
+                "bytes": metrics.bytes,
+                "bytes_per_sec": metrics.bytes / elapsed if elapsed > 0 else 0.0,
+                "forward_latency_ns": metrics.forward_latency.snapshot(),
+            }
+        with self.rules_lock:
+            rules = list(self.rules.items())
+        rule_snapshots = {}
+        for label, metrics in rules:
+            rule_snapshots[str(label)] = {
+                "keyword": metrics.keyword,
+                "held_packets": metrics.held_packets,
+                "held_bytes": metrics.held_bytes,
+                "released_packets": metrics.released_packets,
+                "released_bytes": metrics.released_bytes,
+                "hold_duration_ns": metrics.hold_duration.snapshot(),
+            }
+        return {"uptime_sec": elapsed, "queue_depth": self.queue_depth(), "directions": directions, "rules": rule_snapshots}
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        def metric(name, metric_type, samples):
+            lines.append(f"# TYPE packet_holder_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{value_}"' for key, value_ in labels)
+                lines.append(f"packet_holder_{name}{{{label_text}}} {value}" if label_text else f"packet_holder_{name} {value}")
+        def summary(name, entries):
+            samples = []
+            for labels, histogram in entries:
+                for quantile in ("0.5", "0.9", "0.99", "0.999"):
+                    value = histogram[f"p{float(quantile) * 100:g}"]
+                    samples.append((labels + [("quantile", quantile)], (value or 0) / 1e9))
+            metric(name, "summary", samples)
+            for labels, histogram in entries:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f"packet_holder_{name}_sum{{{label_text}}} {histogram['sum'] / 1e9}")
+                lines.append(f"packet_holder_{name}_count{{{label_text}}} {histogram['count']}")
+        directions = snapshot["directions"]
+        metric("uptime_seconds", "gauge", [([], snapshot["uptime_sec"])])
+        metric("queue_depth", "gauge", [([], snapshot["queue_depth"])])
+        metric("packets_total", "counter", [([("direction", name)], d["packets"]) for name, d in directions.items()])
+        metric("bytes_total", "counter", [([("direction", name)], d["bytes"]) for name, d in directions.items()])
+        summary("forward_latency_seconds", [([("direction", name)], d["forward_latency_ns"]) for name, d in directions.items()])
+        rules = snapshot["rules"]
+        metric("held_packets_total", "counter", [([("rule", label)], r["held_packets"]) for label, r in rules.items()])
+        metric("held_bytes_total", "counter", [([("rule", label)], r["held_bytes"]) for label, r in rules.items()])
+        metric("released_packets_total", "counter", [([("rule", label)], r["released_packets"]) for label, r in rules.items()])
+        summary("hold_duration_seconds", [([("rule", label)], r["hold_duration_ns"]) for label, r in rules.items()])
+        return "\n".join(lines) + "\n"
+
+    def _rule_metrics(self, holding_rule):
+        label = self.rule_label(holding_rule)
+        metrics = self.rules.get(label)
+        if metrics is None:
+            with self.rules_lock:
+                metrics = self.rules.setdefault(label, RuleMetrics(holding_rule.get_holding_keyword()))
+        return metrics
+
+    # The counters and histograms as picklable values, to be added to the
+    # HolderMetrics of another process with merge_state().
+    def get_state(self):
+        directions = {}
+        for direction, metrics in self.directions.items():
+            directions[direction] = (metrics.packets, metrics.bytes, metrics.forward_latency.get_state())
+        with self.rules_lock:
+            rules = list(self.rules.items())
+        rule_states = {}
+        for label, metrics in rules:
+            rule_states[label] = (metrics.keyword, metrics.held_packets, metrics.held_bytes,
+                                  metrics.released_packets, metrics.released_bytes, metrics.hold_duration.get_state())
+        return {"queue_depth": self.queue_depth(), "directions": directions, "rules": rule_states}
+
+    def merge_state(self, state):
+        for direction, (packets, size, forward_latency) in state["directions"].items():
+            metrics = self.directions[direction]
+            with metrics.lock:
+                metrics.packets += packets
+                metrics.bytes += size
+            metrics.forward_latency.merge_state(forward_latency)
+        for label, (keyword, held_packets, held_bytes, released_packets, released_bytes, hold_duration) in state["rules"].items():
+            with self.rules_lock:
+                metrics = self.rules.setdefault(label, RuleMetrics(keyword))
+            with metrics.lock:
+                metrics.held_packets += held_packets
+                metrics.held_bytes += held_bytes
+                metrics.released_packets += released_packets
+                metrics.released_bytes += released_bytes
+            metrics.hold_duration.merge_state(hold_duration)
+
+
+# Metrics of several PacketHolders in other processes. update() keeps the
+# latest HolderMetrics.get_state() of each source; snapshot() and
+# to_prometheus() add them up, so they have the same form as HolderMetrics'.
+class AggregatedMetrics:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.states = {}
+        self.lock = Lock()
+
+    def update(self, source, state):
+        with self.lock:
+            self.states[source] = state
+
+    def remove(self, source):
+        with self.lock:
+            self.states.pop(source, None)
+
+    def get_source_count(self):
+        return len(self.states)
+
+    def snapshot(self):
+        snapshot = self._merge().snapshot()
+        snapshot["sources"] = self.get_source_count()
+        return snapshot
+
+    def to_prometheus(self):
+        return self._merge().to_prometheus()
+
+    def _merge(self):
+        with self.lock:
+            states = list(self.states.values())
+        queue_depth = sum(state["queue_depth"] for state in states)
+        metrics = HolderMetrics(lambda label: label, lambda: queue_depth)
+        metrics.started_at = self.started_at
+        for state in states:
+            metrics.merge_state(state)
+        return metrics
+
+
+# ------------------------------------------------------------------------------
+# MetricsServer
+# ------------------------------------------------------------------------------
+# GET /metrics returns the Prometheus text format, GET /metrics.json the
+# snapshot as JSON.
+class MetricsServer:
+    def __init__(self, metrics, host="127.0.0.1", port=9100):
+        self.metrics = metrics
+        self.address = (host, port)
+        self.http_server = None
+        self.thread = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.to_prometheus().encode('utf-8')
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode('utf-8')
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer(self.address, Handler)
+        self.thread = Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"Metrics server is listening on http://{self.address[0]}:{self.http_server.server_address[1]}/metrics")
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.thread.join()
+            self.http_server = None
+            self.thread = None
@@ -5,15 +5,34 @@
 # ------------------------------------------------------------------------------
 # Imports
 # ------------------------------------------------------------------------------
-import collections
-import datetime
+import itertools
 import queue
-import re
 from threading import Lock
 from threading import Thread
 import socket
 import time
 
+from direct_forwarder import DirectForwarder
+from framers import FramingError
+from framers import RawFramer
+from hold_queue import HoldQueue
+from holder_metrics import HolderMetrics
+from holder_metrics import MetricsServer
+from release_scheduler import DelayLine
+from release_scheduler import ReleaseScheduler
+from rule_set import RuleSet
+from rule_set import RuleSetCompiler
+from session_recorder import EVENT_HOLD
+from session_recorder import EVENT_RELEASE
+from session_recorder import SessionRecorder
+from timer_wheel import TimerWheel
+from traffic_logger import DIRECTION_FROM_SERVER
+from traffic_logger import DIRECTION_TO_SERVER
+from traffic_logger import KIND_DELAYED
+from traffic_logger import KIND_HOLDING
+from traffic_logger import KIND_PASS_THROUGH
+from traffic_logger import TrafficLogger
+
 # ------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------
 # HoldingRule
@@ -22,11 +41,23 @@ class HoldingRule:
     RELEASE_TYPE_NONE = 0
     RELEASE_TYPE_FROM_SERVER = 1
     RELEASE_TYPE_FROM_CLIENT = 2
-    def __init__(self, holding_keyword="", release_type=RELEASE_TYPE_NONE, release_keyword="", enabled=False):
+    RELEASE_TYPE_AFTER_DELAY = 3
+    RELEASE_TYPE_RATE = 4
+    def __init__(self, holding_keyword="", release_type=RELEASE_TYPE_NONE, release_keyword="", enabled=False, max_held_packets=0, max_held_bytes=0,
+                 release_delay_ms=0, release_rate=1.0, release_burst=1):
         self.holding_keyword = holding_keyword
         self.release_type = release_type
         self.release_keyword = release_keyword
         self.enabled = enabled
+        # RELEASE_TYPE_AFTER_DELAY: held packets are released after release_delay_ms
+        # RELEASE_TYPE_RATE: held packets are released at release_rate packets/sec
+        # with bursts of up to release_burst packets
+        self.release_delay_ms = release_delay_ms
+        self.release_rate = release_rate
+        self.release_burst = release_burst
+        # 0 means no limit. Packets over the limit are passed through.
+        self.max_held_packets = max_held_packets
+        self.max_held_bytes = max_held_bytes
 
     def get_holding_keyword(self):
         return self.holding_keyword
@@ -39,6 +70,29 @@ class HoldingRule:
     
     def is_enabled(self):
         return self.enabled
+
+    def get_release_delay_ms(self):
+        return self.release_delay_ms
+
+    def get_release_rate(self):
+        return self.release_rate
+
+    def get_release_burst(self):
+        return self.release_burst
+
+    # Held packets with the same release key are released together.
+    def get_release_key(self):
+        if self.release_type == self.RELEASE_TYPE_AFTER_DELAY:
+            return (self.release_type, self.release_delay_ms)
+        if self.release_type == self.RELEASE_TYPE_RATE:
+            return (self.release_type, self.release_rate, self.release_burst)
+        return (self.release_type, self.release_keyword)
+
+    def get_max_held_packets(self):
+        return self.max_held_packets
+
+    def get_max_held_bytes(self):
+        return self.max_held_bytes
     
     def set_holding_keyword(self, holding_keyword):
         self.holding_keyword = holding_keyword
@@ -49,16 +103,57 @@ class HoldingRule:
     def set_release_keyword(self, release_keyword):
         self.release_keyword = release_keyword
 
+    def set_release_delay_ms(self, release_delay_ms):
+        self.release_delay_ms = release_delay_ms
+
+    def set_release_rate(self, release_rate, release_burst=1):
+        self.release_rate = release_rate
+        self.release_burst = release_burst
+
+    def set_max_held_packets(self, max_held_packets):
+        self.max_held_packets = max_held_packets
+
+    def set_max_held_bytes(self, max_held_bytes):
+        self.max_held_bytes = max_held_bytes
+
     def enable(self):   
         self.enabled = True
     
     def disable(self):
         self.enabled = False
 
+    # Returns every setting of the rule, to tell whether two rules are the same.
+    def get_config(self):
+        return (self.holding_keyword, self.release_type, self.release_keyword, self.enabled, self.release_delay_ms,
+                self.release_rate, self.release_burst, self.max_held_packets, self.max_held_bytes)
+
+    # Returns a snapshot of the rule which can not be modified, for a RuleSet.
+    # index is the position of the rule in PacketHolder.holding_rules.
+    def freeze(self, index):
+        return FrozenHoldingRule(self, index)
+
     def __str__(self):
-        return f"HoldingRule: holding_keyword={self.holding_keyword}, release_type={self.release_type}, release_keyword={self.release_keyword}, enabled={self.enabled}"
+        return f"HoldingRule: holding_keyword={self.holding_keyword}, release_type={self.release_type}, release_keyword={self.release_keyword}, enabled={self.enabled}, release_delay_ms={self.release_delay_ms}, release_rate={self.release_rate}, release_burst={self.release_burst}, max_held_packets={self.max_held_packets}, max_held_bytes={self.max_held_bytes}"
     
 
+# A HoldingRule as it was when it was frozen. The setters raise AttributeError.
+class FrozenHoldingRule(HoldingRule):
+    def __init__(self, holding_rule, index):
+        self.__dict__.update(holding_rule.__dict__)
+        self.__dict__["index"] = index
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"A frozen holding rule can not be modified: {name}")
+
+    def get_index(self):
+        return self.index
+
+    def freeze(self, index):
+        if index == self.index:
+            return self
+        return FrozenHoldingRule(self, index)
+
+
 # ------------------------------------------------------------------------------
 # PacketHolder
 # ------------------------------------------------------------------------------
@@ -68,10 +163,30 @@ class PacketHolder:
     RETRY_INTERBAL = 3
 
     def __init__(self, num_of_rules=1):
+        # holding_rules are edited by set_holding_rule(); the forwarding threads
+        # only use rule_set, the frozen and compiled copy of them.
         self.holding_rules = [HoldingRule() for _ in range(num_of_rules)]
+        self.rules_lock = Lock()
+        self.rule_set_versions = itertools.count(1)
+        self.frozen_rules = ()
+        self.rule_set = RuleSet()
+        self.rule_set_compiler = RuleSetCompiler(self._publish_rule_set)
+        self.framer_factory = RawFramer
+        self.recv_size = self.PACKET_MAX_SIZE
         self.server_sending_lock = Lock()
-        self.queue = collections.deque()
-        self.queue_lock = Lock()
+        self.hold_memory_limit = None
+        self.spill_dir = None
+        self.metrics = HolderMetrics(self._get_rule_label, self._get_held_packet_count)
+        self.metrics_server = None
+        self.session_recorder = None
+        self.hold_queue = HoldQueue(release_callback=self._on_packet_released)
+        self.timer_wheel = TimerWheel()
+        self.release_scheduler = ReleaseScheduler(self.timer_wheel.schedule, self.hold_queue, self._send_released_packets)
+        self.impairment = (0, 0)
+        self.delay_lines = {
+            DIRECTION_TO_SERVER: DelayLine(self.timer_wheel.schedule_at, self._sendall_to_server),
+            DIRECTION_FROM_SERVER: DelayLine(self.timer_wheel.schedule_at, self._sendall_to_client),
+        }
         self.bind_address = None
         self.client_socket = None
         self.client_address = None
@@ -83,16 +198,70 @@ class PacketHolder:
         self.s2c_thread = None
         self.starting_thread = None
         self.output_only_holding_packets = False
+        self.traffic_logger = TrafficLogger()
+        self.fast_path_enabled = True
 
-    def set_holding_rule(self, index=0, holding_keyword="", release_type=HoldingRule.RELEASE_TYPE_NONE, release_keyword="", enable=False):
+    # The new rule takes effect when its rule set has been compiled in the
+    # background, which is usually a moment later; the forwarding threads keep
+    # using the previous rule set until then. Returns the version of the new
+    # rule set (see wait_for_rule_set()). Packets already held keep the release
+    # condition of the rule they were held by.
+    def set_holding_rule(self, index=0, holding_keyword="", release_type=HoldingRule.RELEASE_TYPE_NONE, release_keyword="", enable=False, max_held_packets=0, max_held_bytes=0,
+                         release_delay_ms=0, release_rate=1.0, release_burst=1):
         if index < 0 or index >= len(self.holding_rules):
             print(f"Invalid index: {index}")
-            return
-        self.holding_rules[index].set_holding_keyword(holding_keyword)
-        self.holding_rules[index].set_release_type(release_type)
-        self.holding_rules[index].set_release_keyword(release_keyword)
-        self.holding_rules[index].enable() if enable else self.holding_rules[index].disable()
-    
+            return None
+        # The token bucket of RELEASE_TYPE_RATE needs a positive rate and room
+        # for at least one whole token
+        if not release_rate > 0 or not release_burst >= 1:
+            print(f"Invalid release rate: {release_rate} (burst: {release_burst})")
+            return None
+        with self.rules_lock:
+            self.holding_rules[index].set_holding_keyword(holding_keyword)
+            self.holding_rules[index].set_release_type(release_type)
+            self.holding_rules[index].set_release_keyword(release_keyword)
+            self.holding_rules[index].set_release_delay_ms(release_delay_ms)
+            self.holding_rules[index].set_release_rate(release_rate, release_burst)
+            self.holding_rules[index].set_max_held_packets(max_held_packets)
+            self.holding_rules[index].set_max_held_bytes(max_held_bytes)
+            self.holding_rules[index].enable() if enable else self.holding_rules[index].disable()
+            return self._submit_rule_set()
+
+    # Waits until the rule set of version (by default the latest one) is in
+    # use. Returns False on timeout, or when the rule set could not be built
+    # and the previous one stays in use (see get_rule_set_error()).
+    def wait_for_rule_set(self, version=None, timeout=None):
+        return self.rule_set_compiler.wait(version, timeout)
+
+    # Returns the exception of the last rule set which could not be built, or
+    # None.
+    def get_rule_set_error(self):
+        return self.rule_set_compiler.get_error()
+
+    def get_rule_set(self):
+        return self.rule_set
+
+    # Freezes the holding rules and hands them to the compiler. A rule which
+    # did not change keeps its frozen copy, so its held packets and limits
+    # carry over to the new rule set. Called with rules_lock held.
+    def _submit_rule_set(self):
+        frozen_rules = []
+        for index, rule in enumerate(self.holding_rules):
+            if index < len(self.frozen_rules) and self.frozen_rules[index].get_config() == rule.get_config():
+                frozen_rules.append(self.frozen_rules[index])
+            else:
+                frozen_rules.append(rule.freeze(index))
+        self.frozen_rules = tuple(frozen_rules)
+        version = next(self.rule_set_versions)
+        self.rule_set_compiler.submit(version, self.frozen_rules)
+        return version
+
+    # Called from the compiler thread. The swap is one reference assignment,
+    # so a forwarding thread sees either the old or the new rule set.
+    def _publish_rule_set(self, rule_set):
+        if rule_set.get_version() > self.rule_set.get_version():
+            self.rule_set = rule_set
+
     # Start the packet holder. this method will block until the server is stopped.
     def start(self, packet_holder_ip, packet_holder_port, server_ip, server_port, wait=False):
         if self.started:
@@ -104,6 +273,11 @@ class PacketHolder:
         self.started = True
         self.bind_address = (packet_holder_ip, packet_holder_port)
         self.server_address = (server_ip, server_port)
+        # Start with the rules set so far
+        self.wait_for_rule_set()
+        if self.traffic_logger is not None:
+            self.traffic_logger.start()
+        self.timer_wheel.start()
         if wait:
             try:
                 self._start_internal()
@@ -123,6 +297,9 @@ class PacketHolder:
         print("Stopping the packet holder ...")
         self._close_sockets()
         self._wait_for_threads_join()
+        self.timer_wheel.stop()
+        if self.traffic_logger is not None:
+            self.traffic_logger.stop()
         self.started = False
         print("Packet holder is stopped successfully.")
         
@@ -133,6 +310,94 @@ class PacketHolder:
         for packet in self._dequeue_packets():
             self._pass_through_client_to_server_delayed(packet)
     
+    # Returns a snapshot of the counters and latency histograms: per direction
+    # the received packets/bytes and the time the holder spent on each chunk
+    # (forward latency), per rule the held/released packets and hold durations,
+    # and the current number of held packets.
+    def get_metrics(self):
+        return self.metrics.snapshot()
+
+    # Serve the metrics at http://host:port/metrics (Prometheus text format).
+    def start_metrics_server(self, port=9100, host="127.0.0.1"):
+        if self.metrics_server is not None:
+            print("Metrics server is already started")
+            return
+        self.metrics_server = MetricsServer(self.metrics, host, port)
+        self.metrics_server.start()
+
+    def stop_metrics_server(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    # Delay all forwarded traffic (both directions, including released
+    # packets) by latency_ms +/- jitter_ms. Packets are never reordered, also
+    # not by changing the impairment while packets are waiting in the delay
+    # lines. set_impairment() with no arguments turns it off.
+    def set_impairment(self, latency_ms=0, jitter_ms=0):
+        self.impairment = (latency_ms, jitter_ms)
+        for delay_line in self.delay_lines.values():
+            delay_line.set_impairment(latency_ms, jitter_ms)
+
+    # Held packets beyond memory_limit bytes are spilled to a temporary file in
+    # spill_dir (the system temp directory by default). None means no limit.
+    def set_hold_memory_limit(self, memory_limit, spill_dir=None):
+        self.hold_memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.hold_queue.set_memory_limit(memory_limit, spill_dir)
+
+    # Set how the byte stream is split into packets (see framers.py). The
+    # factory is called once per direction, e.g. set_framer(LengthPrefixedFramer)
+    # or set_framer(lambda: DelimiterFramer(b"\r\n")). Since rules are applied
+    # to reassembled frames, recv_size can be raised without changing matching.
+    def set_framer(self, framer_factory, recv_size=None):
+        if self.started:
+            print("Framer can not be changed while the packet holder is running")
+            return
+        self.framer_factory = framer_factory
+        if recv_size is not None:
+            self.recv_size = recv_size
+
+    # Set the logger of the forwarded data, e.g.
+    # TrafficLogger(RotatingFileSink("traffic.log")). None turns logging off.
+    def set_traffic_logger(self, traffic_logger):
+        old_logger = self.traffic_logger
+        self.traffic_logger = traffic_logger
+        if old_logger is not None and old_logger is not traffic_logger:
+            old_logger.close()
+        if traffic_logger is not None and self.started:
+            traffic_logger.start()
+
+    # Record every received chunk and every hold/release into path (see
+    # session_recorder.py) until stop_recording(). The recording can be
+    # replayed against a server with session_replayer.py.
+    def start_recording(self, path):
+        if self.session_recorder is not None:
+            print(f"Recording is already started: {self.session_recorder.path}")
+            return
+        try:
+            session_recorder = SessionRecorder(path)
+        except OSError as e:
+            print(f"Recording can not be started due to an error: {str(e)}")
+            return
+        session_recorder.start()
+        self.session_recorder = session_recorder
+
+    def stop_recording(self):
+        session_recorder = self.session_recorder
+        self.session_recorder = None
+        if session_recorder is not None:
+            session_recorder.close()
+
+    # When enabled, a direction whose data nobody needs to inspect (no enabled
+    # holding rule, no held packet waiting for release, raw framing, no
+    # pass-through logging and no recording) is forwarded by DirectForwarder.
+    # The check is done again after data has arrived and only the data that
+    # had arrived by then is forwarded directly, so inspection resumes with
+    # the first data received after the rule set enabling a rule is in use.
+    def set_fast_path(self, status):
+        self.fast_path_enabled = bool(status)
+
     def set_output_only_holding_packets(self, status):
         if status:
             self.output_only_holding_packets = True
@@ -160,12 +425,19 @@ class PacketHolder:
         self.s2c_thread.start()
 
     def _close_sockets(self):
-        if self.client_socket is not None:
-            self.client_socket.close()
-        if self.server_socket is not None:
-            self.server_socket.close()
-        if self.bind_socket is not None:
-            self.bind_socket.close()
+        for sock in (self.client_socket, self.server_socket, self.bind_socket):
+            if sock is not None:
+                self._shutdown_socket(sock)
+                sock.close()
+
+    # close() alone does not wake up a thread blocked in recv()/accept() on
+    # Linux, shutdown() does.
+    @staticmethod
+    def _shutdown_socket(sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def _wait_for_threads_join(self):
         if self.c2s_thread is not None:
@@ -200,98 +472,203 @@ class PacketHolder:
         if self.client_socket is None:
             print("Client socket is None")
             return
+        framer = self.framer_factory()
+        forwarder = DirectForwarder(self.client_socket, self.server_socket, self.recv_size, self.server_sending_lock)
         while True:
+            if self._can_forward_directly(framer):
+                try:
+                    available = forwarder.wait_readable()
+                    # A rule may have been enabled while waiting; the data
+                    # that has arrived is then inspected.
+                    if not self._can_forward_directly(framer):
+                        continue
+                    size = forwarder.forward(available)
+                except Exception as e:
+                    print("Forwarding from client is failed due to an error: " + str(e))
+                    break
+                if size == 0:
+                    print("recv() from client is failed")
+                    break
+                self.metrics.record_transfer(DIRECTION_TO_SERVER, size)
+                continue
             packet = None
             try:
-                packet = self.client_socket.recv(self.PACKET_MAX_SIZE)
+                packet = self.client_socket.recv(self.recv_size)
             except Exception as e:
                 print("recv() from client is failed due to an error: " + str(e))
                 break
             if not packet:
                 print("recv() from client is failed")
                 break
-            queueing = False
-            for holding_rule in self.holding_rules:
-                if holding_rule.is_enabled():
-                    packet_str = packet.decode('utf-8', 'ignore')
-                    if holding_rule is not None and re.search(holding_rule.get_holding_keyword(), packet_str):
-                        print(f"[Data]{datetime.datetime.now()}[ ToSVR ][Holding]: {packet_str}")
-                        self._enqueue_packet(packet, holding_rule)
-                        queueing = True
-                        break
-            if not queueing:
-                self._pass_through_client_to_server(packet)
-                for packet in self._dequeue_packets(release_type=HoldingRule.RELEASE_TYPE_FROM_CLIENT, packet=packet):
-                    self._pass_through_client_to_server_delayed(packet)
-    
+            received_at = time.perf_counter_ns()
+            self._record_data(DIRECTION_TO_SERVER, packet)
+            framer, frames = self._split_frames(framer, packet, "client")
+            for frame in frames:
+                self._handle_client_packet(frame)
+            self.metrics.record_forward(DIRECTION_TO_SERVER, len(packet), time.perf_counter_ns() - received_at)
+        forwarder.close()
+        remaining = framer.flush()
+        if remaining:
+            self._pass_through_client_to_server(remaining)
+
+    def _handle_client_packet(self, packet):
+        holding_rule = self._find_holding_rule(packet)
+        if holding_rule is not None and self._enqueue_packet(packet, holding_rule):
+            self._log_packet(DIRECTION_TO_SERVER, KIND_HOLDING, packet)
+        else:
+            self._pass_through_client_to_server(packet)
+            for packet in self._dequeue_packets(release_type=HoldingRule.RELEASE_TYPE_FROM_CLIENT, packet=packet):
+                self._pass_through_client_to_server_delayed(packet)
+
     def _handle_server_to_client(self):
+        framer = self.framer_factory()
+        forwarder = DirectForwarder(self.server_socket, self.client_socket, self.recv_size)
         while True:
+            if self._can_forward_directly(framer):
+                try:
+                    available = forwarder.wait_readable()
+                    # A rule may have been enabled while waiting; the data
+                    # that has arrived is then inspected.
+                    if not self._can_forward_directly(framer):
+                        continue
+                    size = forwarder.forward(available)
+                except Exception as e:
+                    print("Forwarding from server is failed due to an error: " + str(e))
+                    break
+                if size == 0:
+                    print("recv() from server is failed")
+                    break
+                self.metrics.record_transfer(DIRECTION_FROM_SERVER, size)
+                continue
             packet = None
             try:
-                packet = self.server_socket.recv(self.PACKET_MAX_SIZE)
+                packet = self.server_socket.recv(self.recv_size)
             except Exception as e:
                 print("recv() from server is failed due to an error: " + str(e))
                 break
             if not packet:
                 print("recv() from server is failed")
                 break
-            self._pass_through_server_to_client(packet)
-            for packet in self._dequeue_packets(release_type=HoldingRule.RELEASE_TYPE_FROM_SERVER, packet=packet):
-                self._pass_through_client_to_server_delayed(packet)
+            received_at = time.perf_counter_ns()
+            self._record_data(DIRECTION_FROM_SERVER, packet)
+            framer, frames = self._split_frames(framer, packet, "server")
+            for frame in frames:
+                self._handle_server_packet(frame)
+            self.metrics.record_forward(DIRECTION_FROM_SERVER, len(packet), time.perf_counter_ns() - received_at)
+        forwarder.close()
+        remaining = framer.flush()
+        if remaining:
+            self._pass_through_server_to_client(remaining)
 
-    def _enqueue_packet(self, packet, holding_rule):
-        with self.queue_lock:
-            self.queue.append((packet, holding_rule))
+    def _handle_server_packet(self, packet):
+        self._pass_through_server_to_client(packet)
+        for packet in self._dequeue_packets(release_type=HoldingRule.RELEASE_TYPE_FROM_SERVER, packet=packet):
+            self._pass_through_client_to_server_delayed(packet)
 
+    def _can_forward_directly(self, framer):
+        return (self.fast_path_enabled
+                and not self.rule_set.is_active()
+                and len(self.hold_queue) == 0
+                and isinstance(framer, RawFramer)
+                and not any(delay_line.is_active() for delay_line in self.delay_lines.values())
+                and self.session_recorder is None
+                and (self.traffic_logger is None or self.output_only_holding_packets))
+
+    # Returns the framer to use for the next data and the frames in data. When
+    # the stream can not be framed any more, everything buffered is returned as
+    # one packet and the rest of the stream is handled as raw packets.
+    def _split_frames(self, framer, data, peer):
+        try:
+            return framer, framer.feed(data)
+        except FramingError as e:
+            print(f"Framing of the data from {peer} is failed: {str(e)}. Falling back to raw packets.")
+            return RawFramer(), [framer.flush()]
+
+    def _find_holding_rule(self, packet):
+        return self.rule_set.find_holding_rule(packet)
+
+    def _enqueue_packet(self, packet, holding_rule):
+        seq = self.hold_queue.put(packet, holding_rule)
+        if seq is not None:
+            self.metrics.record_hold(holding_rule, len(packet))
+            self._record_event(EVENT_HOLD, len(packet))
+            self.release_scheduler.on_hold(holding_rule, seq)
+            return True
+        print(f"Holding limit of the rule is reached, the packet is passed through: {holding_rule}")
+        return False
 
     def _dequeue_packets(self, release_type=None, packet=None):
-        result = []
-        with self.queue_lock:
-            new_queue = collections.deque()
-            while True:
-                qdata = None
-                try:
-                    qdata = self.queue.popleft()
-                except IndexError:
-                    break
-                if release_type is None:
-                    result.append(qdata[0])
-                elif packet is None:
-                    result.append(qdata[0])
-                elif release_type == qdata[1].get_release_type() and re.search(qdata[1].get_release_keyword(), packet.decode('utf-8', 'ignore')):
-                    result.append(qdata[0])
-                else:
-                    new_queue.append(qdata)
-            self.queue = new_queue
-        return result
+        if release_type is None or packet is None:
+            return self.hold_queue.pop_all()
+        return self.hold_queue.pop_released(release_type, packet)
+
+    def _on_packet_released(self, holding_rule, size, hold_duration_ns):
+        self.metrics.record_release(holding_rule, size, hold_duration_ns)
+        self._record_event(EVENT_RELEASE, size)
+
+    def _record_data(self, direction, packet, session_id=None):
+        session_recorder = self.session_recorder
+        if session_recorder is not None:
+            session_recorder.record_data(direction, packet, session_id)
+
+    # Only packets from the client are held, so the events are recorded in
+    # the client to server direction.
+    def _record_event(self, event, size, session_id=None):
+        session_recorder = self.session_recorder
+        if session_recorder is None:
+            return
+        if event == EVENT_HOLD:
+            session_recorder.record_hold(DIRECTION_TO_SERVER, size, session_id)
+        else:
+            session_recorder.record_release(DIRECTION_TO_SERVER, size, session_id)
+
+    def _send_released_packets(self, packets):
+        for packet in packets:
+            self._pass_through_client_to_server_delayed(packet)
 
     def _pass_through_client_to_server_delayed(self, packet):
-        with self.server_sending_lock:
-            print(f"[Data]{datetime.datetime.now()}[ ToSVR ][Delayed]: {packet.decode('utf-8', 'ignore')}");
-            try:
-                self.server_socket.sendall(packet)
-            except  ConnectionAbortedError as e:
-                print(f"sendall() to server is failed due to an error: {str(e)}")
+        self._log_packet(DIRECTION_TO_SERVER, KIND_DELAYED, packet)
+        self._send_to_server(packet)
 
     def _pass_through_client_to_server(self, packet):
-        with self.server_sending_lock:
-            if not self.output_only_holding_packets:
-                print(f"[Data]{datetime.datetime.now()}[ ToSVR ][PassThr]: {packet.decode('utf-8', 'ignore')}");
-            try:
-                self.server_socket.sendall(packet)
-            except ConnectionAbortedError as e:
-                print(f"sendall() to server is failed due to an error: {str(e)}")
+        if not self.output_only_holding_packets:
+            self._log_packet(DIRECTION_TO_SERVER, KIND_PASS_THROUGH, packet)
+        self._send_to_server(packet)
 
     def _pass_through_server_to_client(self, packet):
         if self.client_socket is None:
             print("Client socket is None")
             return
         if not self.output_only_holding_packets:
-            print(f"[Data]{datetime.datetime.now()}[FromSVR][PassThr]: {packet.decode('utf-8', 'ignore')}");
+            self._log_packet(DIRECTION_FROM_SERVER, KIND_PASS_THROUGH, packet)
+        self.delay_lines[DIRECTION_FROM_SERVER].submit(packet)
+
+    def _send_to_server(self, packet):
+        self.delay_lines[DIRECTION_TO_SERVER].submit(packet)
+
+    def _sendall_to_server(self, packet):
+        with self.server_sending_lock:
             try:
-                self.client_socket.sendall(packet)
+                self.server_socket.sendall(packet)
             except ConnectionAbortedError as e:
-                print(f"sendall() to client is failed due to an error: {str(e)}")
+                print(f"sendall() to server is failed due to an error: {str(e)}")
+
+    def _sendall_to_client(self, packet):
+        try:
+            self.client_socket.sendall(packet)
+        except ConnectionAbortedError as e:
+            print(f"sendall() to client is failed due to an error: {str(e)}")
+
+    def _get_rule_label(self, holding_rule):
+        return holding_rule.get_index()
+
+    def _get_held_packet_count(self):
+        return len(self.hold_queue)
+
+    def _log_packet(self, direction, kind, packet, session_id=None):
+        logger = self.traffic_logger
+        if logger is not None:
+            logger.log(direction, kind, packet, session_id)
 
 # ------------------------------------------------------------------------------
 # Main (for sample usage)
@@ -1,54 +1,124 @@
 import PySimpleGUI as sg
 import packet_holder
+import sharded_packet_holder
+
+STATS_REFRESH_MS = 1000
 
 # Define the GUI layout
 layout = [
     [sg.Text('Proxy  IP Address:', size=(14, 1)), sg.InputText('localhost', key='client_ip'), sg.Text('Port:', size=(4, 1)), sg.InputText('16000', key='client_port',size=(10, 1))],
     [sg.Text('Server IP Address:', size=(14, 1)), sg.InputText('localhost', key='server_ip'), sg.Text('Port:', size=(4, 1)), sg.InputText('6000', key='server_port',size=(10, 1))],
     [sg.Text('Keyword:', size=(14, 1)), sg.InputText('333', key='keyword', enable_events=True), sg.Checkbox('Enable packet holding', key='enable_packet_holding', default=False, enable_events=True)],
+    [sg.Text('Workers:', size=(14, 1)), sg.Spin([i for i in range(1, 65)], initial_value=1, key='workers', size=(5, 1)), sg.Text('(>1 runs one holder process per worker)')],
     [sg.Button('Start'), sg.Button('Stop'), sg.Button('Send Pending Packets')],
+    [sg.Text('Recording:', size=(14, 1)), sg.InputText('session_recording.jsonl', key='recording_path'), sg.Button('Start Recording'), sg.Button('Stop Recording')],
+    [sg.Text('Rule error:', size=(14, 1)), sg.Text('', key='rule_error', size=(120, 1))],
+    [sg.Text('Stats:', size=(14, 1)), sg.Text('', key='stats', size=(120, 1))],
     [sg.Text('Log:', size=(14, 1)), sg.Checkbox('Outputs only held packets or those sent after being released from hold.', key='log_only_pending_packets', default=False, enable_events=True)],
     [sg.Output(size=(160, 32), key='output',font='System 10')]
 ]
 
-# Create the window
-window = sg.Window('Packet Holder [Not Running]', layout)
-
-# Initialize packet holder
-packet_holder = packet_holder.PacketHolder()
-
-# Event loop
-while True:
-    event, values = window.read()
-    if event == sg.WINDOW_CLOSED:
-        break
-    elif event == 'Start':
-        packet_holder_ip = values['client_ip']
-        packet_holder_port = int(values['client_port'])
-        server_ip = values['server_ip']
-        server_port = int(values['server_port'])
-        keyword = values['keyword']
-        
-        # Start packet holder with the provided values
-        packet_holder.set_holding_rule(holding_keyword=keyword)
-        packet_holder.start(packet_holder_ip, packet_holder_port, server_ip, server_port)
-        window.set_title('Packet Holder [Running]')
-    elif event == 'Stop':
-        # Stop packet holder
-        packet_holder.stop()
-        window.set_title('Packet Holder [Not Running]')
-    elif event == 'Send Pending Packets':
-        # Send pending packets
-        packet_holder.send_all_holding_packets()
-    elif event == 'keyword':
-        if values['keyword']:
-            packet_holder.set_holding_rule(holding_keyword=values['keyword'])
-    elif event == 'log_only_pending_packets':
-        # Set output only pending packets
-        packet_holder.set_output_only_holding_packets(values['log_only_pending_packets'])
-    elif event == 'enable_packet_holding':
-        # Set packet hold status
-        packet_holder.set_holding_rule(holding_keyword=values['keyword'], enable=values['enable_packet_holding'])
-
-# Close the window
-window.close()
\ No newline at end of file
+
+def create_packet_holder(workers):
+    if workers > 1:
+        return sharded_packet_holder.ShardedPacketHolder(num_of_workers=workers)
+    return packet_holder.PacketHolder()
+
+
+# Recording and the rule error are only available with the single process
+# holder; they are disabled while the holder runs in several processes.
+SINGLE_PROCESS_CONTROLS = ['recording_path', 'Start Recording', 'Stop Recording']
+
+
+def update_single_process_controls(window, holder):
+    sharded = isinstance(holder, sharded_packet_holder.ShardedPacketHolder)
+    for key in SINGLE_PROCESS_CONTROLS:
+        window[key].update(disabled=sharded)
+    if sharded:
+        window['rule_error'].update('(not available with several workers)')
+
+
+def format_stats(metrics):
+    to_server = metrics['directions']['to_server']
+    from_server = metrics['directions']['from_server']
+    held = sum(rule['held_packets'] for rule in metrics['rules'].values())
+    released = sum(rule['released_packets'] for rule in metrics['rules'].values())
+    text = (f"to server: {to_server['packets']} pkts / {to_server['bytes']} bytes, "
+            f"from server: {from_server['packets']} pkts / {from_server['bytes']} bytes, "
+            f"held: {held}, released: {released}, holding now: {metrics['queue_depth']}")
+    if 'sources' in metrics:
+        text += f", workers: {metrics['sources']}"
+    return text
+
+
+def main():
+    # Create the window
+    window = sg.Window('Packet Holder [Not Running]', layout)
+
+    # Initialize packet holder
+    holder = create_packet_holder(1)
+
+    # Event loop (the timeout refreshes the stats)
+    while True:
+        event, values = window.read(timeout=STATS_REFRESH_MS)
+        if event == sg.WINDOW_CLOSED:
+            break
+        elif event == 'Start':
+            packet_holder_ip = values['client_ip']
+            packet_holder_port = int(values['client_port'])
+            server_ip = values['server_ip']
+            server_port = int(values['server_port'])
+            keyword = values['keyword']
+
+            # The number of workers can only be changed while stopped
+            if not holder.started:
+                if not isinstance(holder, sharded_packet_holder.ShardedPacketHolder):
+                    holder.stop_recording()
+                holder = create_packet_holder(int(values['workers']))
+                holder.set_output_only_holding_packets(values['log_only_pending_packets'])
+                update_single_process_controls(window, holder)
+
+            # Start packet holder with the provided values
+            holder.set_holding_rule(holding_keyword=keyword, enable=values['enable_packet_holding'])
+            holder.start(packet_holder_ip, packet_holder_port, server_ip, server_port)
+            window.set_title('Packet Holder [Running]')
+        elif event == 'Stop':
+            # Stop packet holder
+            holder.stop()
+            window.set_title('Packet Holder [Not Running]')
+        elif event == 'Send Pending Packets':
+            # Send pending packets
+            holder.send_all_holding_packets()
+        elif event == 'Start Recording':
+            holder.start_recording(values['recording_path'])
+        elif event == 'Stop Recording':
+            holder.stop_recording()
+        elif event == 'keyword':
+            # Fired on every keystroke. The rules are compiled in the background and
+            # only the latest edit is compiled, so typing does not stall forwarding.
+            if values['keyword']:
+                holder.set_holding_rule(holding_keyword=values['keyword'], enable=values['enable_packet_holding'])
+        elif event == 'log_only_pending_packets':
+            # Set output only pending packets
+            holder.set_output_only_holding_packets(values['log_only_pending_packets'])
+        elif event == 'enable_packet_holding':
+            # Set packet hold status
+            holder.set_holding_rule(holding_keyword=values['keyword'], enable=values['enable_packet_holding'])
+        if holder.started:
+            window['stats'].update(format_stats(holder.get_metrics()))
+        if not isinstance(holder, sharded_packet_holder.ShardedPacketHolder):
+            error = holder.get_rule_set_error()
+            window['rule_error'].update(str(error) if error is not None else '')
+
+    # Close the window
+    if holder.started:
+        holder.stop()
+    if not isinstance(holder, sharded_packet_holder.ShardedPacketHolder):
+        holder.stop_recording()
+    window.close()
+
+
+# The worker processes of ShardedPacketHolder import this module again, so the
+# window must only be created in the main process.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# release_scheduler.py
+# Description: This file contains the time driven parts of the PacketHolder:
+# the ReleaseScheduler for the timed/rate-shaped release types and the
+# DelayLine which injects latency and jitter into forwarded traffic.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import random
+from threading import Lock
+import time
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# TokenBucket
+# ------------------------------------------------------------------------------
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+
+    # Takes every whole token available and returns how many were taken.
+    def take_available(self):
+        self._refill()
+        taken = int(self.tokens)
+        self.tokens -= taken
+        return taken
+
+    # Returns the seconds until the next whole token is available.
+    def delay_until_available(self):
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+# ------------------------------------------------------------------------------
+# ReleaseScheduler
+# ------------------------------------------------------------------------------
+# Releases packets held by rules with RELEASE_TYPE_AFTER_DELAY or
+# RELEASE_TYPE_RATE. schedule(delay, callback, *args) is TimerWheel.schedule
+# for the threaded holder or loop.call_later for the asyncio holder, and
+# send_released(packets) forwards the released packets.
+#
+# A delayed packet gets one timer carrying its sequence number. All packets of
+# one delay bucket have the same delay, so they become due in hold order and
+# the timer pops the head of the bucket up to its own sequence number (packets
+# released earlier by send_all_holding_packets are simply gone).
+# A rate bucket has at most one pending timer, which releases as many packets
+# as its token bucket allows and re-arms itself while packets remain.
+class ReleaseScheduler:
+    def __init__(self, schedule, hold_queue, send_released):
+        self.schedule = schedule
+        self.hold_queue = hold_queue
+        self.send_released = send_released
+        self.token_buckets = {}
+        self.draining = set()
+        self.lock = Lock()
+
+    # Called after holding_rule's packet with sequence number seq was held.
+    def on_hold(self, holding_rule, seq):
+        release_type = holding_rule.get_release_type()
+        key = holding_rule.get_release_key()
+        if release_type == holding_rule.RELEASE_TYPE_AFTER_DELAY:
+            self.schedule(holding_rule.get_release_delay_ms() / 1000.0, self._release_due, key, seq)
+        elif release_type == holding_rule.RELEASE_TYPE_RATE:
+            with self.lock:
+                if key in self.draining:
+                    return
+                self.draining.add(key)
+                token_bucket = self.token_buckets.get(key)
+                if token_bucket is None:
+                    token_bucket = self.token_buckets[key] = TokenBucket(holding_rule.get_release_rate(), holding_rule.get_release_burst())
+                delay = token_bucket.delay_until_available()
+            self.schedule(delay, self._drain, key)
+
+    def _release_due(self, key, seq):
+        self.send_released(self.hold_queue.pop_due(key, seq))
+
+    def _drain(self, key):
+        token_bucket = self.token_buckets[key]
+        count = token_bucket.take_available()
+        if count:
+            self.send_released(self.hold_queue.pop_head(key, count))
+        with self.lock:
+            if not self.hold_queue.has_bucket(key):
+                self.draining.discard(key)
+                return
+            delay = token_bucket.delay_until_available()
+        self.schedule(delay, self._drain, key)
+
+
+# ------------------------------------------------------------------------------
+# DelayLine
+# ------------------------------------------------------------------------------
+# Delays every packet of one direction by latency_ms +/- jitter_ms. A TCP
+# stream must stay in order, so a packet is never delivered before the one in
+# front of it: jitter stretches the gaps between packets but never reorders
+# them. Delivery times are kept strictly increasing so that timers scheduled
+# for the same instant still fire in submission order. schedule_at(deadline,
+# callback, *args) takes a time.monotonic() deadline (TimerWheel.schedule_at or
+# loop.call_at).
+#
+# A holder keeps one DelayLine per direction for its whole life and changes
+# its parameters with set_impairment(): packets submitted after a change are
+# still delivered after the ones already waiting, and with no latency and no
+# jitter a packet is only sent at once when nothing is waiting any more.
+class DelayLine:
+    MIN_GAP = 1e-6
+
+    def __init__(self, schedule_at, send, latency_ms=0, jitter_ms=0):
+        self.schedule_at = schedule_at
+        self.send = send
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.last_deliver_at = 0.0
+        # Packets scheduled but not sent yet
+        self.pending = 0
+        self.lock = Lock()
+
+    def set_impairment(self, latency_ms=0, jitter_ms=0):
+        with self.lock:
+            self.latency = latency_ms / 1000.0
+            self.jitter = jitter_ms / 1000.0
+
+    # False when a packet submitted now would be sent at once, i.e. there is
+    # no impairment and no packet is waiting.
+    def is_active(self):
+        return self.latency > 0 or self.jitter > 0 or self.pending > 0
+
+    def submit(self, packet):
+        with self.lock:
+            if self.is_active():
+                now = time.monotonic()
+                delay = self.latency
+                if self.jitter:
+                    delay += random.uniform(-self.jitter, self.jitter)
+                deliver_at = max(self.last_deliver_at + self.MIN_GAP, now + max(delay, 0.0))
+                self.last_deliver_at = deliver_at
+                self.pending += 1
+                self.schedule_at(deliver_at, self._deliver, packet)
+                return
+        self.send(packet)
+
+    def _deliver(self, packet):
+        try:
+            self.send(packet)
+        finally:
+            with self.lock:
+                self.pending -= 1
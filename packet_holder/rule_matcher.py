@@ -0,0 +1,187 @@
+# rule_matcher.py
+# Description: This file contains the KeywordMatcher class, which compiles a set
+# of holding/release keywords into one matcher that runs on raw packet bytes.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import re
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# KeywordMatcher
+# ------------------------------------------------------------------------------
+# Keywords are regular expressions (as with re.search), but most of them are
+# plain literals such as "333". Literal keywords are merged into a trie and
+# emitted as one regex, so a scan costs one pass over the buffer no matter how
+# many literals there are (the same walk an Aho-Corasick automaton does, but
+# executed by the C regex engine instead of per byte in Python). Real patterns
+# are appended to the same regex as alternatives. Each keyword is tagged with a
+# named group so the match reports which keyword fired.
+#
+# Matching runs on bytes: keywords are encoded to UTF-8 and patterns are
+# compiled as bytes patterns, so packets are never decoded on the hot path.
+# A pattern with non-ASCII characters would change its meaning as a bytes
+# pattern ("é+" would repeat only the last byte of "é", "[あい]" would be a
+# class of single bytes), so such a pattern is compiled as a str pattern,
+# checked separately against the payload decoded as UTF-8.
+#
+# When the combined regex finds a keyword, a keyword with a lower index may
+# still match later in the data. The regex of only the combined keywords below
+# the found one is tried next (built on first use), until nothing below
+# matches; then only the separately checked keywords below it are checked.
+class KeywordMatcher:
+    REGEX_METACHARS = frozenset(".^$*+?{}[]\\|()")
+
+    def __init__(self, keywords=()):
+        self.keywords = list(keywords)
+        self.checks = []
+        self.uncombined_checks = []
+        self.group_to_index = {}
+        # The keywords in the combined regex: (index, literal) and (index, compiled)
+        self.combined_literals = []
+        self.combined_patterns = []
+        self.combined = None
+        # index -> regex of the combined keywords below index (None if there are none)
+        self.combined_below = {}
+        self._build()
+
+    def __len__(self):
+        return len(self.keywords)
+
+    # Returns the lowest keyword index which matches data, or None.
+    # The lowest index wins so that rule priority is the same as checking the
+    # keywords one by one in order.
+    def first_match(self, data):
+        best = None
+        combined = self.combined
+        while combined is not None:
+            m = combined.search(data)
+            if m is None:
+                break
+            best = self.group_to_index[m.lastgroup]
+            combined = self.combined_below.get(best, False)
+            if combined is False:
+                combined = self._build_combined_below(best)
+        for index, check in self.uncombined_checks:
+            if best is not None and index >= best:
+                break
+            if check(data):
+                return index
+        return best
+
+    # Returns the set of all keyword indexes which match data.
+    def all_matches(self, data):
+        if self.combined is not None and not self.uncombined_checks and self.combined.search(data) is None:
+            return set()
+        return {index for index, check in self.checks if check(data)}
+
+    def _build(self):
+        for index, keyword in enumerate(self.keywords):
+            if self.is_literal(keyword):
+                literal = keyword.encode('utf-8')
+                self.checks.append((index, self._literal_check(literal)))
+                self.combined_literals.append((index, literal))
+                continue
+            try:
+                if not keyword.isascii():
+                    check = self._text_check(re.compile(keyword))
+                    self.checks.append((index, check))
+                    self.uncombined_checks.append((index, check))
+                    continue
+                compiled = re.compile(keyword.encode('utf-8'))
+            except re.error as e:
+                print(f"Invalid keyword pattern: {keyword}, error: {str(e)}. It is treated as a literal.")
+                literal = keyword.encode('utf-8')
+                self.checks.append((index, self._literal_check(literal)))
+                self.uncombined_checks.append((index, self._literal_check(literal)))
+                continue
+            self.checks.append((index, compiled.search))
+            # Patterns with their own groups (and possibly backreferences)
+            # cannot be renumbered safely, and patterns which do not compile
+            # inside a group (e.g. global flags such as "(?i)abc") can not be
+            # an alternative, so they are checked separately.
+            if compiled.groups > 0 or not self._can_combine(compiled.pattern):
+                self.uncombined_checks.append((index, compiled.search))
+            else:
+                self.combined_patterns.append((index, compiled))
+        try:
+            self.combined = self._combine(self.combined_literals, self.combined_patterns)
+        except re.error as e:
+            # Each pattern compiled alone, but not all of them together
+            # (e.g. too many groups): check the patterns separately.
+            print(f"Keyword patterns can not be combined, error: {str(e)}. They are checked one by one.")
+            self.uncombined_checks.extend((index, compiled.search) for index, compiled in self.combined_patterns)
+            self.combined_patterns = []
+            self.combined = self._combine(self.combined_literals, [])
+        self.checks.sort(key=lambda check: check[0])
+        self.uncombined_checks.sort(key=lambda check: check[0])
+
+    # Returns one regex of the literals (merged into a trie) and the patterns,
+    # or None when there are none.
+    def _combine(self, literals, patterns):
+        trie = {}
+        for index, literal in literals:
+            node = trie
+            for byte in literal:
+                node = node.setdefault(byte, {})
+            # Keep the first (highest priority) index for duplicate keywords
+            node.setdefault(None, index)
+        alternatives = []
+        if trie:
+            alternatives.append(self._trie_to_regex(trie))
+        for index, compiled in patterns:
+            alternatives.append(self._group_pattern(self._group_name(index), compiled.pattern))
+        if not alternatives:
+            return None
+        return re.compile(b"|".join(alternatives))
+
+    # A subset of alternatives which compiled together always compiles.
+    def _build_combined_below(self, index):
+        combined = self._combine([item for item in self.combined_literals if item[0] < index],
+                                 [item for item in self.combined_patterns if item[0] < index])
+        self.combined_below[index] = combined
+        return combined
+
+    def _trie_to_regex(self, node):
+        branches = []
+        for byte, child in node.items():
+            if byte is None:
+                continue
+            branches.append(re.escape(bytes([byte])) + self._trie_to_regex(child))
+        if None in node:
+            group = self._group_name(node[None])
+            # Longer keywords are tried first, the terminal group is the fallback
+            branches.append(b"(?P<" + group.encode('ascii') + b">)")
+        if len(branches) == 1:
+            return branches[0]
+        return b"(?:" + b"|".join(branches) + b")"
+
+    @staticmethod
+    def _group_pattern(group, pattern):
+        return b"(?P<" + group.encode('ascii') + b">" + pattern + b")"
+
+    @classmethod
+    def _can_combine(cls, pattern):
+        try:
+            re.compile(cls._group_pattern("_k", pattern))
+        except re.error:
+            return False
+        return True
+
+    def _group_name(self, index):
+        group = f"_k{index}"
+        self.group_to_index[group] = index
+        return group
+
+    @staticmethod
+    def _literal_check(literal):
+        return lambda data: literal in data
+
+    @staticmethod
+    def _text_check(compiled):
+        return lambda data: compiled.search(str(data, 'utf-8', 'replace')) is not None
+
+    @classmethod
+    def is_literal(cls, keyword):
+        return not any(c in cls.REGEX_METACHARS for c in keyword)
@@ -0,0 +1,118 @@
+# rule_set.py
+# Description: This file contains the RuleSet class, an immutable and versioned
+# snapshot of the holding rules of the PacketHolder, and the RuleSetCompiler,
+# which builds rule sets on a background thread.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+from threading import Condition
+from threading import Thread
+
+from rule_matcher import KeywordMatcher
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# RuleSet
+# ------------------------------------------------------------------------------
+# rules are frozen HoldingRules (HoldingRule.freeze()), so nothing in a rule
+# set changes after it was built. The forwarding threads read the current rule
+# set once per packet and use it without a lock; a new rule set replaces it
+# with one reference assignment.
+class RuleSet:
+    def __init__(self, version=0, rules=()):
+        self.version = version
+        self.rules = tuple(rules)
+        self.enabled_rules = tuple(rule for rule in self.rules if rule.is_enabled())
+        if self.enabled_rules:
+            self.matcher = KeywordMatcher([rule.get_holding_keyword() for rule in self.enabled_rules])
+        else:
+            self.matcher = None
+
+    def get_version(self):
+        return self.version
+
+    def get_rules(self):
+        return self.rules
+
+    # False when no rule is enabled, i.e. nothing needs to be matched.
+    def is_active(self):
+        return self.matcher is not None
+
+    # Returns the first enabled rule whose keyword is found in packet, or None.
+    def find_holding_rule(self, packet):
+        if self.matcher is None:
+            return None
+        index = self.matcher.first_match(packet)
+        if index is None:
+            return None
+        return self.enabled_rules[index]
+
+
+# ------------------------------------------------------------------------------
+# RuleSetCompiler
+# ------------------------------------------------------------------------------
+# Compiling the matcher of a large rule set takes long enough to stall a
+# forwarding thread, so it is done here and publish(rule_set) is called from
+# the compiler thread when it is ready. Only the latest submitted rules are
+# compiled: a burst of edits (e.g. typing a keyword in the GUI) results in one
+# compilation. When a rule set can not be built, the previous one stays in use
+# and its version is not marked as compiled, so wait() returns False for it.
+class RuleSetCompiler:
+    def __init__(self, publish):
+        self.publish = publish
+        self.condition = Condition()
+        self.pending = None
+        self.submitted_version = 0
+        self.compiled_version = 0
+        # The last version taken from pending (compiled or failed) and the
+        # error of the last failed version
+        self.processed_version = 0
+        self.error = None
+        self.thread = None
+
+    def submit(self, version, rules):
+        with self.condition:
+            self.pending = (version, rules)
+            self.submitted_version = max(self.submitted_version, version)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    # Waits until version (by default the last submitted one) is published.
+    # Returns False on timeout or when it (or the newer version which
+    # replaced it) could not be compiled; get_error() tells the error.
+    def wait(self, version=None, timeout=None):
+        with self.condition:
+            if version is None:
+                version = self.submitted_version
+            self.condition.wait_for(lambda: self.processed_version >= version, timeout)
+            return self.compiled_version >= version
+
+    # Returns the exception of the last version which could not be compiled,
+    # or None.
+    def get_error(self):
+        with self.condition:
+            return self.error
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                version, rules = self.pending
+                self.pending = None
+            error = None
+            try:
+                self.publish(RuleSet(version, rules))
+            except Exception as e:
+                print(f"An error occurred while compiling the holding rules: {str(e)}")
+                error = e
+            with self.condition:
+                if error is None:
+                    self.compiled_version = max(self.compiled_version, version)
+                else:
+                    self.error = error
+                self.processed_version = max(self.processed_version, version)
+                self.condition.notify_all()
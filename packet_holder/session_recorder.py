@@ -0,0 +1,116 @@
+# session_recorder.py
+# Description: This file contains the SessionRecorder class, which records the
+# traffic of the PacketHolder into a compact binary append log for replay
+# (see session_replayer.py), and the reader of that log.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import struct
+import time
+
+from traffic_logger import TrafficLogger
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Events
+# ------------------------------------------------------------------------------
+# EVENT_DATA:    a chunk received from the client or the server, as it was
+#                received (before framing)
+# EVENT_HOLD:    a packet was held
+# EVENT_RELEASE: a held packet was released
+EVENT_DATA = 0
+EVENT_HOLD = 1
+EVENT_RELEASE = 2
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# RecordSink
+# ------------------------------------------------------------------------------
+# File layout: MAGIC, the wall clock time the recording started [f64], then for
+# each record
+#   [timestamp_ns: u64][event: u8][direction: u8][session_id: u32][length: u32]
+# in little endian. timestamp_ns is time.monotonic_ns() relative to the start
+# of the recording. Only EVENT_DATA records are followed by length bytes of
+# data; for EVENT_HOLD/EVENT_RELEASE length is the size of the packet.
+# Records without session id are stored with session_id 0.
+class RecordSink:
+    MAGIC = b"PHREC\x00\x01\x00"
+    FILE_HEADER = struct.Struct("<d")
+    RECORD_HEADER = struct.Struct("<QBBII")
+
+    def __init__(self, path, buffer_size=1024 * 1024):
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.file.write(self.MAGIC)
+        self.file.write(self.FILE_HEADER.pack(time.time()))
+        self.started_at_ns = time.monotonic_ns()
+
+    def write_batch(self, records):
+        chunks = []
+        pack = self.RECORD_HEADER.pack
+        started_at_ns = self.started_at_ns
+        for timestamp_ns, direction, event, data, session_id in records:
+            timestamp_ns = max(timestamp_ns - started_at_ns, 0)
+            if event == EVENT_DATA:
+                chunks.append(pack(timestamp_ns, event, direction, session_id or 0, len(data)))
+                chunks.append(data)
+            else:
+                chunks.append(pack(timestamp_ns, event, direction, session_id or 0, data))
+        self.file.write(b"".join(chunks))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    # Yields (timestamp_ns, event, direction, session_id, data) for each
+    # record, where data is the bytes of EVENT_DATA and the packet size of the
+    # other events. A record cut off at the end of the file (the recording was
+    # not stopped) is ignored.
+    @classmethod
+    def read_records(cls, path):
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is not a PacketHolder recording")
+            f.read(cls.FILE_HEADER.size)
+            while True:
+                header = f.read(cls.RECORD_HEADER.size)
+                if len(header) < cls.RECORD_HEADER.size:
+                    return
+                timestamp_ns, event, direction, session_id, length = cls.RECORD_HEADER.unpack(header)
+                if event == EVENT_DATA:
+                    data = f.read(length)
+                    if len(data) < length:
+                        return
+                else:
+                    data = length
+                yield (timestamp_ns, event, direction, session_id or None, data)
+
+    @classmethod
+    def read_started_at(cls, path):
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is not a PacketHolder recording")
+            return cls.FILE_HEADER.unpack(f.read(cls.FILE_HEADER.size))[0]
+
+
+# ------------------------------------------------------------------------------
+# SessionRecorder
+# ------------------------------------------------------------------------------
+# A TrafficLogger writing to a RecordSink with monotonic timestamps, so the
+# forwarding threads only append to the ring buffer and the file is written by
+# the background writer. A recording with missing records can not be replayed
+# faithfully, so the default policy blocks instead of dropping. sink replaces
+# the RecordSink of path, e.g. to hand the records to another process.
+class SessionRecorder(TrafficLogger):
+    def __init__(self, path, capacity=65536, batch_size=1024, flush_interval=0.1, policy=TrafficLogger.POLICY_BLOCK, sink=None):
+        super().__init__(sink if sink is not None else RecordSink(path), capacity, batch_size, flush_interval, policy, clock=time.monotonic_ns)
+        self.path = path
+
+    def record_data(self, direction, data, session_id=None):
+        self.log(direction, EVENT_DATA, data, session_id)
+
+    def record_hold(self, direction, size, session_id=None):
+        self.log(direction, EVENT_HOLD, size, session_id)
+
+    def record_release(self, direction, size, session_id=None):
+        self.log(direction, EVENT_RELEASE, size, session_id)
@@ -0,0 +1,245 @@
+# session_replayer.py
+# Description: This file contains the SessionReplayer class, which re-drives
+# the client side of a recording made by PacketHolder.start_recording()
+# against a server (or a PacketHolder in front of it).
+#
+# Usage:
+#   python session_replayer.py recording.phrec localhost 6000             (original speed)
+#   python session_replayer.py recording.phrec localhost 6000 --speed 10  (10x)
+#   python session_replayer.py recording.phrec localhost 6000 --asap      (as fast as possible)
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import argparse
+import json
+import selectors
+import socket
+import sys
+from threading import Event
+from threading import Thread
+import time
+
+from session_recorder import EVENT_DATA
+from session_recorder import EVENT_HOLD
+from session_recorder import EVENT_RELEASE
+from session_recorder import RecordSink
+from traffic_logger import DIRECTION_TO_SERVER
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# ReplaySession
+# ------------------------------------------------------------------------------
+# One recorded session replayed on its own connection: the connection is
+# opened at the (scaled) time of the first record of the session, the recorded
+# client chunks are sent at their (scaled) timestamps and whatever the server
+# sends back is read and counted.
+class ReplaySession:
+    def __init__(self, session_id, chunks, started_at_ns=None):
+        self.session_id = session_id
+        self.chunks = chunks
+        # The timestamp of the first record of the session (the server may
+        # have sent data before the first client chunk)
+        self.started_at_ns = chunks[0][0] if started_at_ns is None else started_at_ns
+        self.socket = None
+        self.sent_bytes = 0
+        self.sent_chunks = 0
+        self.received_bytes = 0
+        self.max_lateness = 0.0
+        self.sending_done = Event()
+        self.error = None
+
+    # Replays the session on a new connection to server_address: connects at
+    # started_at + (self.started_at_ns - first_timestamp_ns) / speed, then
+    # sends and receives until the server is drained (see send() and
+    # receive()). With speed None everything happens as soon as possible.
+    def replay(self, server_address, started_at, first_timestamp_ns, speed, connect_timeout, drain_timeout):
+        self._wait_until(started_at, self.started_at_ns - first_timestamp_ns, speed)
+        try:
+            self.connect(server_address, connect_timeout)
+        except OSError as e:
+            self.error = f"connect() is failed due to an error: {str(e)}"
+            return
+        receiving_thread = Thread(target=self.receive, args=(drain_timeout,))
+        receiving_thread.start()
+        self.send(started_at, first_timestamp_ns, speed)
+        receiving_thread.join()
+
+    # The socket stays blocking after the connection is made: send() and
+    # receive() run in two threads on the same socket, so a timeout set for
+    # one of them would apply to the other as well.
+    def connect(self, server_address, timeout):
+        self.socket = socket.create_connection(server_address, timeout=timeout)
+        self.socket.settimeout(None)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Sends every chunk at started_at + timestamp / speed (time.monotonic()),
+    # or back to back when speed is None.
+    def send(self, started_at, first_timestamp_ns, speed):
+        try:
+            for timestamp_ns, data in self.chunks:
+                self._wait_until(started_at, timestamp_ns - first_timestamp_ns, speed)
+                self.socket.sendall(data)
+                self.sent_bytes += len(data)
+                self.sent_chunks += 1
+        except OSError as e:
+            self.error = f"send() is failed due to an error: {str(e)}"
+        finally:
+            self.sending_done.set()
+
+    # Reads until the server closes the connection, or nothing arrived for
+    # drain_timeout seconds after everything was sent. The wait is done with
+    # a selector, so the socket itself never gets a timeout.
+    def receive(self, drain_timeout):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.socket, selectors.EVENT_READ)
+            while True:
+                if not selector.select(drain_timeout):
+                    if self.sending_done.is_set():
+                        return
+                    continue
+                try:
+                    data = self.socket.recv(65536)
+                except OSError as e:
+                    if self.error is None and not self.sending_done.is_set():
+                        self.error = f"recv() is failed due to an error: {str(e)}"
+                    return
+                if not data:
+                    return
+                self.received_bytes += len(data)
+
+    def _wait_until(self, started_at, offset_ns, speed):
+        if speed is None:
+            return
+        delay = started_at + offset_ns / 1e9 / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self.max_lateness = max(self.max_lateness, -delay)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+# ------------------------------------------------------------------------------
+# SessionReplayer
+# ------------------------------------------------------------------------------
+# Every recorded session (client connection) is replayed concurrently on its
+# own connection, and all sessions share one clock: each connection is opened
+# at the recorded start of its session, so the gaps between sessions are
+# replayed as well. speed scales the recorded timing (2.0 replays twice as
+# fast); None connects and sends everything as fast as possible.
+class SessionReplayer:
+    def __init__(self, path, server_address, speed=1.0, session_ids=None, connect_timeout=5.0, drain_timeout=1.0):
+        self.path = path
+        self.server_address = server_address
+        self.speed = speed
+        self.session_ids = session_ids
+        self.connect_timeout = connect_timeout
+        self.drain_timeout = drain_timeout
+
+    # Returns the summary of the recording without replaying it.
+    def describe(self):
+        sessions = {}
+        events = {EVENT_DATA: 0, EVENT_HOLD: 0, EVENT_RELEASE: 0}
+        last_timestamp_ns = 0
+        for timestamp_ns, event, direction, session_id, data in RecordSink.read_records(self.path):
+            events[event] = events.get(event, 0) + 1
+            last_timestamp_ns = timestamp_ns
+            if event == EVENT_DATA:
+                session = sessions.setdefault(session_id or 0, [0, 0])
+                session[direction] += len(data)
+        return {
+            "started_at": RecordSink.read_started_at(self.path),
+            "duration_sec": last_timestamp_ns / 1e9,
+            "data_records": events[EVENT_DATA],
+            "hold_events": events[EVENT_HOLD],
+            "release_events": events[EVENT_RELEASE],
+            "sessions": {str(session_id): {"to_server_bytes": counts[0], "from_server_bytes": counts[1]}
+                         for session_id, counts in sessions.items()},
+        }
+
+    def run(self):
+        replay_sessions = self._load_sessions()
+        if not replay_sessions:
+            print(f"No client data to replay in {self.path}")
+            return None
+        first_timestamp_ns = min(session.started_at_ns for session in replay_sessions)
+        last_timestamp_ns = max(session.chunks[-1][0] for session in replay_sessions)
+        started_at = time.monotonic()
+        threads = []
+        for session in replay_sessions:
+            threads.append(Thread(target=session.replay, args=(self.server_address, started_at, first_timestamp_ns, self.speed,
+                                                              self.connect_timeout, self.drain_timeout)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - started_at
+        for session in replay_sessions:
+            session.close()
+        return {
+            "sessions": len(replay_sessions),
+            "speed": self.speed,
+            "recorded_duration_sec": (last_timestamp_ns - first_timestamp_ns) / 1e9,
+            "duration_sec": duration,
+            "sent_chunks": sum(session.sent_chunks for session in replay_sessions),
+            "sent_bytes": sum(session.sent_bytes for session in replay_sessions),
+            "received_bytes": sum(session.received_bytes for session in replay_sessions),
+            "max_lateness_ms": max(session.max_lateness for session in replay_sessions) * 1000,
+            "errors": {str(session.session_id): session.error for session in replay_sessions if session.error},
+        }
+
+    # Client chunks grouped by session, in recorded order. A session starts
+    # with its first record of any kind.
+    def _load_sessions(self):
+        chunks = {}
+        started_at_ns = {}
+        for timestamp_ns, event, direction, session_id, data in RecordSink.read_records(self.path):
+            session_id = session_id or 0
+            if self.session_ids is not None and session_id not in self.session_ids:
+                continue
+            started_at_ns.setdefault(session_id, timestamp_ns)
+            if event != EVENT_DATA or direction != DIRECTION_TO_SERVER:
+                continue
+            chunks.setdefault(session_id, []).append((timestamp_ns, data))
+        return [ReplaySession(session_id, session_chunks, started_at_ns[session_id])
+                for session_id, session_chunks in sorted(chunks.items())]
+
+
+# ------------------------------------------------------------------------------
+# Main
+# ------------------------------------------------------------------------------
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay a PacketHolder recording against a server")
+    parser.add_argument("recording")
+    parser.add_argument("server_ip", nargs="?")
+    parser.add_argument("server_port", nargs="?", type=int)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 2.0 is twice as fast")
+    parser.add_argument("--asap", action="store_true", help="send as fast as possible")
+    parser.add_argument("--session", type=int, nargs="+", help="replay only these session ids (0 for PacketHolder)")
+    parser.add_argument("--describe", action="store_true", help="print the summary of the recording and exit")
+    args = parser.parse_args(argv)
+
+    speed = None if args.asap else args.speed
+    if speed is not None and speed <= 0:
+        print(f"Invalid speed: {args.speed}")
+        return 1
+    replayer = SessionReplayer(args.recording, (args.server_ip, args.server_port), speed, args.session)
+    if args.describe:
+        print(json.dumps(replayer.describe(), indent=2))
+        return 0
+    if args.server_ip is None or args.server_port is None:
+        print("server_ip and server_port are required to replay")
+        return 1
+    summary = replayer.run()
+    if summary is None:
+        return 1
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,495 @@
+# sharded_packet_holder.py
+# Description: This file contains the ShardedPacketHolder class, which spreads
+# the client connections over several worker processes, each running an
+# AsyncPacketHolder, so that inspection is not limited to one core by the GIL.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import itertools
+import multiprocessing
+from multiprocessing.connection import wait as wait_for_connections
+import os
+import socket
+import sys
+from threading import Condition
+from threading import Lock
+from threading import Thread
+import time
+
+from async_packet_holder import AsyncPacketHolder
+from holder_metrics import AggregatedMetrics
+from holder_metrics import MetricsServer
+from packet_holder import HoldingRule
+from session_recorder import SessionRecorder
+from traffic_logger import TrafficLogger
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Messages
+# ------------------------------------------------------------------------------
+# Between the supervisor and a worker, over a multiprocessing Pipe:
+#   supervisor -> worker: ("rules", version, rule_settings), ("options", options),
+#                         ("release_all",), ("stop",)
+#   worker -> supervisor: ("ready", index), ("error", index, message),
+#                         ("rules_applied", index, version),
+#                         ("rules_failed", index, version, error),
+#                         ("stats", index, state), ("log", index, records),
+#                         ("record", index, records)
+MESSAGE_RULES = "rules"
+MESSAGE_OPTIONS = "options"
+MESSAGE_RELEASE_ALL = "release_all"
+MESSAGE_STOP = "stop"
+MESSAGE_READY = "ready"
+MESSAGE_ERROR = "error"
+MESSAGE_RULES_APPLIED = "rules_applied"
+MESSAGE_RULES_FAILED = "rules_failed"
+MESSAGE_STATS = "stats"
+MESSAGE_LOG = "log"
+MESSAGE_RECORD = "record"
+
+STATS_INTERVAL = 1.0
+LISTEN_TIMEOUT = 10.0
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Worker
+# ------------------------------------------------------------------------------
+# A TrafficLogger sink which hands every batch to the supervisor, which writes
+# it with its own TrafficLogger (so the GUI shows the log of every worker).
+# With kind MESSAGE_RECORD the batches are session records, written by the
+# SessionRecorder of the supervisor into one recording.
+class ConnectionSink:
+    def __init__(self, send, worker_index, kind=MESSAGE_LOG):
+        self.send = send
+        self.worker_index = worker_index
+        self.kind = kind
+
+    def write_batch(self, records):
+        self.send((self.kind, self.worker_index, records))
+
+    def close(self):
+        pass
+
+
+def _rule_settings(holding_rule):
+    return {
+        "holding_keyword": holding_rule.get_holding_keyword(),
+        "release_type": holding_rule.get_release_type(),
+        "release_keyword": holding_rule.get_release_keyword(),
+        "enable": holding_rule.is_enabled(),
+        "max_held_packets": holding_rule.get_max_held_packets(),
+        "max_held_bytes": holding_rule.get_max_held_bytes(),
+        "release_delay_ms": holding_rule.get_release_delay_ms(),
+        "release_rate": holding_rule.get_release_rate(),
+        "release_burst": holding_rule.get_release_burst(),
+    }
+
+
+# Returns False when the rules could not be compiled (the worker keeps using
+# its previous rules).
+def _apply_rules(holder, rule_settings):
+    for index, settings in enumerate(rule_settings):
+        holder.set_holding_rule(index=index, **settings)
+    return holder.wait_for_rule_set()
+
+
+def _apply_options(holder, options, send, worker_index):
+    if "output_only_holding_packets" in options:
+        holder.set_output_only_holding_packets(options["output_only_holding_packets"])
+    if "logging" in options:
+        holder.set_traffic_logger(TrafficLogger(ConnectionSink(send, worker_index)) if options["logging"] else None)
+    if "fast_path" in options:
+        holder.set_fast_path(options["fast_path"])
+    if "impairment" in options:
+        holder.set_impairment(*options["impairment"])
+    if "hold_memory_limit" in options:
+        holder.set_hold_memory_limit(*options["hold_memory_limit"])
+    if "framer" in options and not holder.started:
+        holder.set_framer(*options["framer"])
+    if "recording" in options:
+        if not options["recording"]:
+            holder.stop_recording()
+        elif holder.session_recorder is None:
+            # The records carry time.monotonic_ns() timestamps, which are the
+            # same clock in every process of the machine.
+            session_recorder = SessionRecorder(None, sink=ConnectionSink(send, worker_index, MESSAGE_RECORD))
+            session_recorder.start()
+            holder.session_recorder = session_recorder
+
+
+# The main function of a worker process. Either listening_socket is a socket
+# shared with the other workers, or every worker binds bind_address with
+# SO_REUSEPORT. Session ids are worker_index + 1 + k * num_of_workers, so they
+# are unique over all workers.
+def run_worker(worker_index, num_of_workers, bind_address, server_address, listening_socket, connection, rule_settings, options):
+    send_lock = Lock()
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    holder = AsyncPacketHolder(len(rule_settings))
+    holder.session_ids = itertools.count(worker_index + 1, num_of_workers)
+    if not _apply_rules(holder, rule_settings):
+        send((MESSAGE_ERROR, worker_index, f"Worker {worker_index} could not compile the holding rules: {holder.get_rule_set_error()}"))
+        return
+    _apply_options(holder, options, send, worker_index)
+    if listening_socket is not None:
+        holder.set_listening_socket(listening_socket)
+    else:
+        holder.set_reuse_port(True)
+    holder.start(bind_address[0], bind_address[1], server_address[0], server_address[1])
+    deadline = time.monotonic() + LISTEN_TIMEOUT
+    while holder.listening_server is None and holder.loop_thread.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    if holder.listening_server is None:
+        send((MESSAGE_ERROR, worker_index, f"Worker {worker_index} could not listen on {bind_address}"))
+        holder.stop()
+        return
+    send((MESSAGE_READY, worker_index))
+
+    next_stats_at = time.monotonic()
+    try:
+        while True:
+            if connection.poll(max(next_stats_at - time.monotonic(), 0)):
+                message = connection.recv()
+                if message[0] == MESSAGE_STOP:
+                    break
+                if message[0] == MESSAGE_RULES:
+                    _, version, rule_settings = message
+                    if _apply_rules(holder, rule_settings):
+                        send((MESSAGE_RULES_APPLIED, worker_index, version))
+                    else:
+                        send((MESSAGE_RULES_FAILED, worker_index, version, str(holder.get_rule_set_error())))
+                elif message[0] == MESSAGE_OPTIONS:
+                    _apply_options(holder, message[1], send, worker_index)
+                elif message[0] == MESSAGE_RELEASE_ALL:
+                    holder.send_all_holding_packets()
+            if time.monotonic() >= next_stats_at:
+                send((MESSAGE_STATS, worker_index, holder.metrics.get_state()))
+                next_stats_at += STATS_INTERVAL
+    except (EOFError, OSError, KeyboardInterrupt):
+        # The supervisor is gone or interrupted
+        pass
+    holder.stop()
+    holder.stop_recording()
+    if holder.traffic_logger is not None:
+        holder.traffic_logger.close()
+    try:
+        send((MESSAGE_STATS, worker_index, holder.metrics.get_state()))
+    except (EOFError, OSError):
+        pass
+
+
+# ------------------------------------------------------------------------------
+# ShardedPacketHolder
+# ------------------------------------------------------------------------------
+# Same API as PacketHolder. start() spawns num_of_workers processes which all
+# accept clients on the same port: on Linux every worker binds the port itself
+# with SO_REUSEPORT and the kernel balances the connections, elsewhere (where
+# SO_REUSEPORT does not balance, or does not exist) the supervisor binds it
+# and passes the listening socket to the workers.
+# A client and its upstream connection stay in one worker, so held packets
+# are released in the worker that holds them.
+#
+# Rule changes are sent to every worker, which compiles them in the
+# background like PacketHolder. Workers push their metrics every
+# STATS_INTERVAL seconds and get_metrics() adds them up, so it can be up to
+# that much behind. The traffic log and the recording of the workers are
+# written by this process.
+class ShardedPacketHolder:
+    def __init__(self, num_of_rules=1, num_of_workers=None):
+        self.holding_rules = [HoldingRule() for _ in range(num_of_rules)]
+        self.num_of_workers = num_of_workers or os.cpu_count() or 1
+        self.rules_lock = Lock()
+        self.rule_versions = itertools.count(1)
+        self.rule_version = 0
+        self.options = {"output_only_holding_packets": False, "logging": True, "fast_path": True}
+        self.traffic_logger = TrafficLogger()
+        self.session_recorder = None
+        self.rule_set_error = None
+        self.metrics = AggregatedMetrics()
+        self.metrics_server = None
+        self.workers = []
+        self.connections = {}
+        self.send_lock = Lock()
+        self.condition = Condition()
+        self.ready_workers = set()
+        self.applied_versions = {}
+        self.failed_versions = {}
+        self.worker_errors = []
+        self.listening_socket = None
+        self.receiving_thread = None
+        self.started = False
+
+    def set_holding_rule(self, index=0, holding_keyword="", release_type=HoldingRule.RELEASE_TYPE_NONE, release_keyword="", enable=False, max_held_packets=0, max_held_bytes=0,
+                         release_delay_ms=0, release_rate=1.0, release_burst=1):
+        if index < 0 or index >= len(self.holding_rules):
+            print(f"Invalid index: {index}")
+            return None
+        # The token bucket of RELEASE_TYPE_RATE needs a positive rate and room
+        # for at least one whole token
+        if not release_rate > 0 or not release_burst >= 1:
+            print(f"Invalid release rate: {release_rate} (burst: {release_burst})")
+            return None
+        with self.rules_lock:
+            self.holding_rules[index].set_holding_keyword(holding_keyword)
+            self.holding_rules[index].set_release_type(release_type)
+            self.holding_rules[index].set_release_keyword(release_keyword)
+            self.holding_rules[index].set_release_delay_ms(release_delay_ms)
+            self.holding_rules[index].set_release_rate(release_rate, release_burst)
+            self.holding_rules[index].set_max_held_packets(max_held_packets)
+            self.holding_rules[index].set_max_held_bytes(max_held_bytes)
+            self.holding_rules[index].enable() if enable else self.holding_rules[index].disable()
+            self.rule_version = next(self.rule_versions)
+            self._broadcast((MESSAGE_RULES, self.rule_version, self._get_rule_settings()))
+            return self.rule_version
+
+    # Waits until every running worker uses the rules of version (by default
+    # the latest one). Returns False on timeout or when a worker could not
+    # compile them (it keeps using its previous rules).
+    def wait_for_rule_set(self, version=None, timeout=None):
+        if version is None:
+            version = self.rule_version
+        with self.condition:
+            self.condition.wait_for(
+                lambda: all(max(self.applied_versions.get(index, 0), self.failed_versions.get(index, 0)) >= version
+                            for index in self.ready_workers), timeout)
+            return all(self.applied_versions.get(index, 0) >= version for index in self.ready_workers)
+
+    # Returns the error of the last rule set which a worker could not compile
+    # (as a RuntimeError with the worker's message), or None.
+    def get_rule_set_error(self):
+        with self.condition:
+            return self.rule_set_error
+
+    def set_output_only_holding_packets(self, status):
+        self._set_options({"output_only_holding_packets": bool(status)})
+
+    def set_fast_path(self, status):
+        self._set_options({"fast_path": bool(status)})
+
+    def set_impairment(self, latency_ms=0, jitter_ms=0):
+        self._set_options({"impairment": (latency_ms, jitter_ms)})
+
+    def set_hold_memory_limit(self, memory_limit, spill_dir=None):
+        self._set_options({"hold_memory_limit": (memory_limit, spill_dir)})
+
+    # framer_factory is sent to the worker processes, so it must be picklable
+    # (a framer class or a functools.partial of one, not a lambda).
+    def set_framer(self, framer_factory, recv_size=None):
+        if self.started:
+            print("Framer can not be changed while the packet holder is running")
+            return
+        self.options["framer"] = (framer_factory, recv_size)
+
+    # None turns the traffic log of the workers off.
+    def set_traffic_logger(self, traffic_logger):
+        old_logger = self.traffic_logger
+        self.traffic_logger = traffic_logger
+        if old_logger is not None and old_logger is not traffic_logger:
+            old_logger.close()
+        if traffic_logger is not None and self.started:
+            traffic_logger.start()
+        self._set_options({"logging": traffic_logger is not None})
+
+    # Records the traffic of every worker into path, see
+    # PacketHolder.start_recording(). Session ids are unique over the
+    # workers, so the recording can be replayed like one of PacketHolder.
+    def start_recording(self, path):
+        if self.session_recorder is not None:
+            print(f"Recording is already started: {self.session_recorder.path}")
+            return
+        try:
+            session_recorder = SessionRecorder(path)
+        except OSError as e:
+            print(f"Recording can not be started due to an error: {str(e)}")
+            return
+        session_recorder.start()
+        self.session_recorder = session_recorder
+        self._set_options({"recording": True})
+
+    # Records still on their way from the workers are dropped.
+    def stop_recording(self):
+        session_recorder = self.session_recorder
+        self.session_recorder = None
+        self._set_options({"recording": False})
+        if session_recorder is not None:
+            session_recorder.close()
+
+    def start(self, packet_holder_ip, packet_holder_port, server_ip, server_port, wait=False):
+        if self.started:
+            print("Process is already started")
+            return
+        bind_address = (packet_holder_ip, packet_holder_port)
+        server_address = (server_ip, server_port)
+        self.listening_socket = None
+        if not sys.platform.startswith("linux"):
+            try:
+                self.listening_socket = socket.create_server(bind_address, backlog=AsyncPacketHolder.LISTEN_BACKLOG)
+            except OSError as e:
+                print(f"An error occurred while listening on {bind_address}, error: {str(e)}")
+                return
+        self.started = True
+        if self.traffic_logger is not None:
+            self.traffic_logger.start()
+        self.ready_workers = set()
+        self.applied_versions = {}
+        self.failed_versions = {}
+        self.worker_errors = []
+        context = multiprocessing.get_context("spawn")
+        with self.rules_lock:
+            rule_settings = self._get_rule_settings()
+            for worker_index in range(self.num_of_workers):
+                parent_connection, child_connection = context.Pipe()
+                process = context.Process(
+                    target=run_worker,
+                    args=(worker_index, self.num_of_workers, bind_address, server_address, self.listening_socket,
+                          child_connection, rule_settings, dict(self.options)),
+                    daemon=True)
+                process.start()
+                child_connection.close()
+                self.workers.append(process)
+                self.connections[worker_index] = parent_connection
+                self.applied_versions[worker_index] = self.rule_version
+        self.receiving_thread = Thread(target=self._receive_loop, daemon=True)
+        self.receiving_thread.start()
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.ready_workers) + len(self.worker_errors) >= self.num_of_workers,
+                                    LISTEN_TIMEOUT + 20)
+        for error in self.worker_errors:
+            print(error)
+        print(f"Listening on {bind_address} with {len(self.ready_workers)} worker processes ...")
+        if wait:
+            try:
+                while self.receiving_thread.is_alive():
+                    self.receiving_thread.join(0.5)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.stop()
+
+    def stop(self):
+        if not self.started:
+            print("Process is already stopped")
+            return
+        print("Stopping the packet holder ...")
+        self._broadcast((MESSAGE_STOP,))
+        for process in self.workers:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.workers = []
+        if self.receiving_thread is not None:
+            self.receiving_thread.join()
+            self.receiving_thread = None
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+        if self.listening_socket is not None:
+            self.listening_socket.close()
+            self.listening_socket = None
+        if self.traffic_logger is not None:
+            self.traffic_logger.stop()
+        self.started = False
+        print("Packet holder is stopped successfully.")
+
+    def send_all_holding_packets(self):
+        if not self.started:
+            print("Process is not started")
+            return
+        self._broadcast((MESSAGE_RELEASE_ALL,))
+
+    def get_worker_count(self):
+        return len(self.ready_workers)
+
+    # The metrics of all workers added up, with "sources" set to the number of
+    # workers which reported.
+    def get_metrics(self):
+        return self.metrics.snapshot()
+
+    def start_metrics_server(self, port=9100, host="127.0.0.1"):
+        if self.metrics_server is not None:
+            print("Metrics server is already started")
+            return
+        self.metrics_server = MetricsServer(self.metrics, host, port)
+        self.metrics_server.start()
+
+    def stop_metrics_server(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def _get_rule_settings(self):
+        return [_rule_settings(rule) for rule in self.holding_rules]
+
+    def _set_options(self, options):
+        self.options.update(options)
+        self._broadcast((MESSAGE_OPTIONS, options))
+
+    def _broadcast(self, message):
+        with self.send_lock:
+            for worker_index, connection in list(self.connections.items()):
+                try:
+                    connection.send(message)
+                except (OSError, ValueError) as e:
+                    print(f"Sending to worker {worker_index} is failed due to an error: {str(e)}")
+
+    # Handles the messages of all workers until every worker has exited.
+    def _receive_loop(self):
+        connections = {connection: worker_index for worker_index, connection in self.connections.items()}
+        while connections:
+            for connection in wait_for_connections(list(connections)):
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    worker_index = connections.pop(connection)
+                    with self.condition:
+                        self.ready_workers.discard(worker_index)
+                        self.condition.notify_all()
+                    continue
+                self._handle_message(message)
+
+    def _handle_message(self, message):
+        kind = message[0]
+        if kind == MESSAGE_LOG:
+            if self.traffic_logger is not None:
+                self.traffic_logger.log_records(message[2])
+        elif kind == MESSAGE_RECORD:
+            session_recorder = self.session_recorder
+            if session_recorder is not None:
+                session_recorder.log_records(message[2])
+        elif kind == MESSAGE_STATS:
+            self.metrics.update(message[1], message[2])
+        elif kind == MESSAGE_RULES_APPLIED:
+            with self.condition:
+                self.applied_versions[message[1]] = max(self.applied_versions.get(message[1], 0), message[2])
+                self.condition.notify_all()
+        elif kind == MESSAGE_RULES_FAILED:
+            print(f"Worker {message[1]} could not compile the holding rules of version {message[2]}: {message[3]}")
+            with self.condition:
+                self.failed_versions[message[1]] = max(self.failed_versions.get(message[1], 0), message[2])
+                self.rule_set_error = RuntimeError(message[3])
+                self.condition.notify_all()
+        elif kind == MESSAGE_READY:
+            with self.condition:
+                self.ready_workers.add(message[1])
+                self.condition.notify_all()
+        elif kind == MESSAGE_ERROR:
+            with self.condition:
+                self.worker_errors.append(message[2])
+                self.condition.notify_all()
+
+
+# ------------------------------------------------------------------------------
+# Main (for sample usage)
+# ------------------------------------------------------------------------------
+if __name__ == "__main__":
+    packet_holder_ip = "localhost"
+    packet_holder_port = 16000
+    real_server_ip = "localhost"
+    real_server_port = 6000
+    packet_holder = ShardedPacketHolder()
+    packet_holder.set_holding_rule(index=0, holding_keyword="333", enable=True)
+    packet_holder.start(packet_holder_ip, packet_holder_port, real_server_ip, real_server_port, wait=True)
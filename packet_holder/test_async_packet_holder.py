@@ -0,0 +1,119 @@
+# test_async_packet_holder.py
+import socket
+import threading
+import time
+
+import pytest
+
+from async_packet_holder import AsyncPacketHolder
+from test_packet_holder import connect
+from test_packet_holder import get_free_port
+
+
+# ------------------------------------------------------------------------------
+# Helpers
+# ------------------------------------------------------------------------------
+# A server that reads until the client closes its side, then answers with
+# everything it received in upper case and closes.
+class UpperCaseServer:
+    def __init__(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.listen(8)
+        self.port = self.server_socket.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server_socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._answer, args=(conn,), daemon=True).start()
+
+    def _answer(self, conn):
+        conn.settimeout(5)
+        with conn:
+            received = bytearray()
+            try:
+                while True:
+                    data = conn.recv(1024)
+                    if not data:
+                        break
+                    received += data
+                conn.sendall(bytes(received).upper())
+            except OSError:
+                pass
+
+    def close(self):
+        self.server_socket.close()
+
+
+def receive_all(sock):
+    received = bytearray()
+    while True:
+        data = sock.recv(1024)
+        if not data:
+            return bytes(received)
+        received += data
+
+
+@pytest.fixture
+def server():
+    server = UpperCaseServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def holder(server):
+    holder = AsyncPacketHolder()
+    holder.set_traffic_logger(None)
+    port = get_free_port()
+    yield holder, port
+    if holder.started:
+        holder.stop()
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+# The end of the client's stream is forwarded and the answer still arrives
+def test_half_close_is_forwarded(server, holder):
+    holder, port = holder
+    holder.start("127.0.0.1", port, "127.0.0.1", server.port)
+    with connect(port) as client:
+        client.sendall(b"abc")
+        client.shutdown(socket.SHUT_WR)
+        assert receive_all(client) == b"ABC"
+
+
+# Delayed data and the end of the stream are forwarded in order
+def test_half_close_waits_for_delayed_data(server, holder):
+    holder, port = holder
+    holder.set_impairment(200, 0)
+    holder.start("127.0.0.1", port, "127.0.0.1", server.port)
+    with connect(port) as client:
+        client.sendall(b"abc")
+        client.shutdown(socket.SHUT_WR)
+        started = time.monotonic()
+        assert receive_all(client) == b"ABC"
+        assert time.monotonic() - started >= 0.4
+
+
+# set_impairment() applies to a session that is already running
+def test_impairment_applies_to_running_sessions(server, holder):
+    holder, port = holder
+    holder.start("127.0.0.1", port, "127.0.0.1", server.port)
+    with connect(port) as client:
+        deadline = time.monotonic() + 5
+        while holder.get_session_count() == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        holder.set_impairment(200, 0)
+        time.sleep(0.05)
+        client.sendall(b"abc")
+        client.shutdown(socket.SHUT_WR)
+        started = time.monotonic()
+        assert receive_all(client) == b"ABC"
+        assert time.monotonic() - started >= 0.4
@@ -0,0 +1,69 @@
+# test_framers.py
+import pytest
+
+from framers import DelimiterFramer
+from framers import FixedSizeFramer
+from framers import FramingError
+from framers import LengthPrefixedFramer
+from framers import RawFramer
+
+
+def feed_in_chunks(framer, data, chunk_size):
+    frames = []
+    for start in range(0, len(data), chunk_size):
+        frames.extend(framer.feed(data[start:start + chunk_size]))
+    return frames
+
+
+def length_prefixed(payload, header_size=4, byteorder='big'):
+    return len(payload).to_bytes(header_size, byteorder) + payload
+
+
+def test_raw_framer_returns_every_chunk():
+    framer = RawFramer()
+    assert framer.feed(b"abc") == [b"abc"]
+    assert framer.flush() == b""
+    assert framer.pending() == 0
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1000])
+def test_length_prefixed_framer_reassembles_frames(chunk_size):
+    messages = [b"hello", b"", b"x" * 20, b"world"]
+    data = b"".join(length_prefixed(message) for message in messages)
+    frames = feed_in_chunks(LengthPrefixedFramer(), data, chunk_size)
+    assert frames == [length_prefixed(message) for message in messages]
+
+
+def test_length_prefixed_framer_keeps_incomplete_frame():
+    framer = LengthPrefixedFramer(header_size=2, byteorder='little')
+    data = length_prefixed(b"abcdef", 2, 'little')
+    assert framer.feed(data[:5]) == []
+    assert framer.pending() == 5
+    assert framer.flush() == data[:5]
+    assert framer.pending() == 0
+
+
+def test_length_prefixed_framer_rejects_oversized_frame():
+    framer = LengthPrefixedFramer(max_frame_size=16)
+    with pytest.raises(FramingError):
+        framer.feed(length_prefixed(b"x" * 13))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 1000])
+def test_delimiter_framer_keeps_delimiter(chunk_size):
+    framer = DelimiterFramer(b"\r\n")
+    frames = feed_in_chunks(framer, b"GET /\r\nHost: a\r\n\r\npartial", chunk_size)
+    assert frames == [b"GET /\r\n", b"Host: a\r\n", b"\r\n"]
+    assert framer.flush() == b"partial"
+
+
+def test_delimiter_framer_rejects_oversized_frame():
+    framer = DelimiterFramer(max_frame_size=8)
+    with pytest.raises(FramingError):
+        framer.feed(b"123456789")
+
+
+def test_fixed_size_framer():
+    framer = FixedSizeFramer(3)
+    assert feed_in_chunks(framer, b"abcdefgh", 2) == [b"abc", b"def"]
+    assert framer.flush() == b"gh"
@@ -0,0 +1,87 @@
+# test_hold_queue.py
+from hold_queue import HoldQueue
+from packet_holder import HoldingRule
+
+
+def keyword_rule(release_type, release_keyword, **kwargs):
+    return HoldingRule("hold", release_type, release_keyword, True, **kwargs)
+
+
+# ------------------------------------------------------------------------------
+# Release
+# ------------------------------------------------------------------------------
+def test_pop_all_keeps_hold_order():
+    queue = HoldQueue()
+    rule_a = keyword_rule(HoldingRule.RELEASE_TYPE_FROM_SERVER, "a")
+    rule_b = keyword_rule(HoldingRule.RELEASE_TYPE_FROM_SERVER, "b")
+    for packet, rule in [(b"1", rule_a), (b"2", rule_b), (b"3", rule_a)]:
+        assert queue.put(packet, rule) is not None
+    assert queue.pop_all() == [b"1", b"2", b"3"]
+    assert len(queue) == 0
+
+
+def test_pop_released_pops_only_the_triggered_buckets():
+    queue = HoldQueue()
+    rule_a = keyword_rule(HoldingRule.RELEASE_TYPE_FROM_SERVER, "a")
+    rule_b = keyword_rule(HoldingRule.RELEASE_TYPE_FROM_SERVER, "b")
+    queue.put(b"1", rule_a)
+    queue.put(b"2", rule_b)
+    queue.put(b"3", rule_a)
+    assert queue.pop_released(HoldingRule.RELEASE_TYPE_FROM_CLIENT, b"a") == []
+    assert queue.pop_released(HoldingRule.RELEASE_TYPE_FROM_SERVER, b"xa") == [b"1", b"3"]
+    assert queue.pop_released(HoldingRule.RELEASE_TYPE_FROM_SERVER, b"xa") == []
+    assert queue.pop_all() == [b"2"]
+
+
+def test_rule_limits():
+    queue = HoldQueue()
+    rule = keyword_rule(HoldingRule.RELEASE_TYPE_FROM_SERVER, "a", max_held_packets=2)
+    assert queue.put(b"1", rule) is not None
+    assert queue.put(b"2", rule) is not None
+    assert queue.put(b"3", rule) is None
+    queue.pop_all()
+    assert queue.put(b"4", rule) is not None
+
+
+# ------------------------------------------------------------------------------
+# Spill
+# ------------------------------------------------------------------------------
+def test_spilled_packets_are_read_back_in_order(tmp_path):
+    queue = HoldQueue(memory_limit=10, spill_dir=str(tmp_path))
+    rule = keyword_rule(HoldingRule.RELEASE_TYPE_FROM_SERVER, "a")
+    packets = [bytes([ord("a") + i]) * 4 for i in range(6)]
+    for packet in packets:
+        queue.put(packet, rule)
+    usage = queue.get_usage()
+    assert usage == {"packets": 6, "memory_bytes": 8, "spilled_packets": 4}
+    assert queue.pop_all() == packets
+    assert queue.get_usage() == {"packets": 0, "memory_bytes": 0, "spilled_packets": 0}
+    # Everything was read back, so the spill file is truncated
+    assert queue.spill_segment.size == 0
+    queue.close()
+
+
+def test_spill_is_reused_after_read_back(tmp_path):
+    queue = HoldQueue(memory_limit=0, spill_dir=str(tmp_path))
+    rule_a = keyword_rule(HoldingRule.RELEASE_TYPE_FROM_SERVER, "a")
+    rule_b = keyword_rule(HoldingRule.RELEASE_TYPE_FROM_SERVER, "b")
+    for cycle in range(3):
+        queue.put(b"first%d" % cycle, rule_a)
+        queue.put(b"", rule_b)
+        queue.put(b"second%d" % cycle, rule_a)
+        assert queue.pop_released(HoldingRule.RELEASE_TYPE_FROM_SERVER, b"a") == [b"first%d" % cycle, b"second%d" % cycle]
+        assert queue.pop_all() == [b""]
+        assert queue.spill_segment.size == 0
+    queue.close()
+
+
+def test_release_callback_is_called_for_every_packet(tmp_path):
+    released = []
+    queue = HoldQueue(memory_limit=4, spill_dir=str(tmp_path),
+                      release_callback=lambda rule, size, duration: released.append(size))
+    rule = keyword_rule(HoldingRule.RELEASE_TYPE_FROM_SERVER, "a")
+    for packet in [b"12", b"345", b"6789"]:
+        queue.put(packet, rule)
+    queue.pop_all()
+    assert released == [2, 3, 4]
+    queue.close()
@@ -0,0 +1,139 @@
+# test_packet_holder.py
+import socket
+import threading
+import time
+
+import pytest
+
+from framers import RawFramer
+from packet_holder import PacketHolder
+
+
+# ------------------------------------------------------------------------------
+# Helpers
+# ------------------------------------------------------------------------------
+# A server that collects everything it receives on its first connection
+class CollectingServer:
+    def __init__(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.listen(1)
+        self.port = self.server_socket.getsockname()[1]
+        self.received = bytearray()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        conn, _ = self.server_socket.accept()
+        conn.settimeout(5)
+        with conn:
+            try:
+                while True:
+                    data = conn.recv(1024)
+                    if not data:
+                        break
+                    self.received += data
+            except OSError:
+                pass
+
+    def wait_for(self, size, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(self.received) < size and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return bytes(self.received)
+
+    def close(self):
+        self.server_socket.close()
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def connect(port, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return socket.create_connection(("127.0.0.1", port), timeout=timeout)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+@pytest.fixture
+def server():
+    server = CollectingServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def holder(server):
+    holder = PacketHolder()
+    holder.set_traffic_logger(None)
+    port = get_free_port()
+    yield holder, port
+    if holder.started:
+        holder.stop()
+
+
+# ------------------------------------------------------------------------------
+# Impairment
+# ------------------------------------------------------------------------------
+# Turning the impairment off while a packet is still waiting in the delay line
+# must not let the next packet overtake it.
+def test_removing_impairment_keeps_order(server, holder):
+    holder, port = holder
+    holder.set_impairment(300, 0)
+    holder.start("127.0.0.1", port, "127.0.0.1", server.port)
+    client = connect(port)
+    try:
+        time.sleep(0.2)
+        client.sendall(b"A")
+        time.sleep(0.05)
+        holder.set_impairment(0, 0)
+        client.sendall(b"B")
+        assert server.wait_for(2) == b"AB"
+    finally:
+        client.close()
+
+
+# Lowering the latency must not let a packet overtake one submitted earlier
+def test_lowering_latency_keeps_order(server, holder):
+    holder, port = holder
+    holder.set_impairment(300, 0)
+    holder.start("127.0.0.1", port, "127.0.0.1", server.port)
+    client = connect(port)
+    try:
+        time.sleep(0.2)
+        client.sendall(b"A")
+        time.sleep(0.05)
+        holder.set_impairment(10, 0)
+        client.sendall(b"B")
+        assert server.wait_for(2) == b"AB"
+    finally:
+        client.close()
+
+
+# The fast path must stay off until every delayed packet has been delivered
+def test_fast_path_waits_for_delay_line(server, holder):
+    holder, port = holder
+    holder.set_output_only_holding_packets(True)
+    holder.set_fast_path(True)
+    holder.set_impairment(300, 0)
+    holder.start("127.0.0.1", port, "127.0.0.1", server.port)
+    client = connect(port)
+    try:
+        time.sleep(0.2)
+        client.sendall(b"A")
+        time.sleep(0.05)
+        holder.set_impairment()
+        assert not holder._can_forward_directly(RawFramer())
+        client.sendall(b"B")
+        assert server.wait_for(2) == b"AB"
+        assert holder._can_forward_directly(RawFramer())
+    finally:
+        client.close()
@@ -0,0 +1,105 @@
+# test_rule_matcher.py
+import random
+import re
+
+import pytest
+
+from rule_matcher import KeywordMatcher
+
+# Literals, patterns which are combined into one regex and patterns which are
+# checked separately (own groups, global flags)
+KEYWORDS = [
+    "333", "33", "abc", "ab", "b", "xyz", "zz",
+    "a.c", "b+x", "[xy]z", "c$", "^ab", "3{2,}",
+    "(ab)c", "(?i)ABC", "(x|y)\\1",
+]
+
+
+def expected_first_match(keywords, data):
+    for index, keyword in enumerate(keywords):
+        if re.search(keyword.encode('utf-8'), data):
+            return index
+    return None
+
+
+def expected_all_matches(keywords, data):
+    return {index for index, keyword in enumerate(keywords) if re.search(keyword.encode('utf-8'), data)}
+
+
+# ------------------------------------------------------------------------------
+# Priority
+# ------------------------------------------------------------------------------
+# The lowest matching index wins, even when the combined regex finds a
+# higher-priority keyword's match later in the data than another one's.
+def test_lowest_index_wins_over_leftmost_match():
+    matcher = KeywordMatcher(["xyz", "abc"])
+    assert matcher.first_match(b"abc xyz") == 0
+
+
+def test_duplicate_literals_keep_the_first_index():
+    matcher = KeywordMatcher(["b", "abc", "abc"])
+    assert matcher.first_match(b"abc") == 0
+    matcher = KeywordMatcher(["abc", "abc"])
+    assert matcher.first_match(b"abc") == 0
+    assert matcher.all_matches(b"abc") == {0, 1}
+
+
+def test_no_match():
+    matcher = KeywordMatcher(["abc", "(?i)xyz"])
+    assert matcher.first_match(b"ab xy") is None
+    assert matcher.all_matches(b"ab xy") == set()
+
+
+# ------------------------------------------------------------------------------
+# Fuzz against re.search per keyword
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_like_search_per_keyword(seed):
+    rng = random.Random(seed)
+    keywords = rng.sample(KEYWORDS, rng.randint(1, len(KEYWORDS)))
+    matcher = KeywordMatcher(keywords)
+    for _ in range(200):
+        data = bytes(rng.choice(b"abcxyzABC3 ") for _ in range(rng.randint(0, 12)))
+        assert matcher.first_match(data) == expected_first_match(keywords, data), (keywords, data)
+        assert matcher.all_matches(data) == expected_all_matches(keywords, data), (keywords, data)
+
+
+# ------------------------------------------------------------------------------
+# Lower-priority hits
+# ------------------------------------------------------------------------------
+# After a combined hit only the keywords below it are searched again, and the
+# separately checked keywords at or above the hit are never run.
+def test_separate_checks_above_the_hit_are_skipped():
+    matcher = KeywordMatcher(["zz", "abc", "(ab)c"])
+    calls = []
+    matcher.uncombined_checks = [(index, lambda data, index=index: calls.append(index) or True)
+                                 for index, _ in matcher.uncombined_checks]
+    assert matcher.first_match(b"abc zz") == 0
+    assert calls == []
+
+
+def test_keywords_below_the_hit_are_resolved_one_by_one():
+    keywords = ["zz", "b+x", "yy", "abc"]
+    matcher = KeywordMatcher(keywords)
+    assert matcher.first_match(b"abc yy bx") == 1
+    assert matcher.first_match(b"abc yy") == 2
+    assert matcher.first_match(b"abc yy bx zz") == 0
+    assert matcher.first_match(b"abc") == 3
+
+
+# ------------------------------------------------------------------------------
+# Non-ASCII keywords
+# ------------------------------------------------------------------------------
+# A pattern with non-ASCII characters keeps its meaning as a text pattern
+def test_non_ascii_pattern_matches_as_text():
+    matcher = KeywordMatcher(["[あい]う", "é+"])
+    assert matcher.first_match("いう".encode('utf-8')) == 0
+    assert matcher.first_match("ééé".encode('utf-8')) == 1
+    assert matcher.first_match(b"e\xcc\x81") is None
+    assert matcher.all_matches("いうé".encode('utf-8')) == {0, 1}
+
+
+def test_non_ascii_literal_matches_as_bytes():
+    matcher = KeywordMatcher(["ログイン", "abc"])
+    assert matcher.first_match("abc ログイン".encode('utf-8')) == 0
+    assert matcher.first_match("ログ".encode('utf-8')) is None
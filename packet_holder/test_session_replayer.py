@@ -0,0 +1,107 @@
+# test_session_replayer.py
+import socket
+import threading
+import time
+
+from session_recorder import EVENT_DATA
+from session_recorder import RecordSink
+from session_replayer import SessionReplayer
+from traffic_logger import DIRECTION_FROM_SERVER
+from traffic_logger import DIRECTION_TO_SERVER
+
+
+# ------------------------------------------------------------------------------
+# Helpers
+# ------------------------------------------------------------------------------
+# An echo server which remembers when each connection was accepted
+class EchoServer:
+    def __init__(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.listen(8)
+        self.address = self.server_socket.getsockname()
+        self.accepted_at = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server_socket.accept()
+            except OSError:
+                return
+            self.accepted_at.append(time.monotonic())
+            threading.Thread(target=self._echo, args=(conn,), daemon=True).start()
+
+    def _echo(self, conn):
+        with conn:
+            try:
+                while True:
+                    data = conn.recv(1024)
+                    if not data:
+                        return
+                    conn.sendall(data)
+            except OSError:
+                pass
+
+    def close(self):
+        self.server_socket.close()
+
+
+# records: (offset_sec, direction, data, session_id)
+def write_recording(path, records):
+    sink = RecordSink(path)
+    sink.write_batch([(sink.started_at_ns + int(offset * 1e9), direction, EVENT_DATA, data, session_id)
+                      for offset, direction, data, session_id in records])
+    sink.close()
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+# A session is connected at the recorded time of its first record, also when
+# that record came from the server.
+def test_sessions_connect_at_their_recorded_start(tmp_path):
+    path = str(tmp_path / "session.phrec")
+    write_recording(path, [
+        (0.0, DIRECTION_TO_SERVER, b"first", 1),
+        (0.4, DIRECTION_FROM_SERVER, b"banner", 2),
+        (0.5, DIRECTION_TO_SERVER, b"second", 2),
+    ])
+    server = EchoServer()
+    try:
+        summary = SessionReplayer(path, server.address, drain_timeout=0.3).run()
+    finally:
+        server.close()
+    assert summary["errors"] == {}
+    assert summary["sent_bytes"] == len(b"firstsecond")
+    assert summary["received_bytes"] == len(b"firstsecond")
+    first, second = sorted(server.accepted_at)
+    assert 0.3 <= second - first < 0.5
+
+
+# As fast as possible, every session connects at once
+def test_asap_connects_at_once(tmp_path):
+    path = str(tmp_path / "session.phrec")
+    write_recording(path, [
+        (0.0, DIRECTION_TO_SERVER, b"first", 1),
+        (1.0, DIRECTION_TO_SERVER, b"second", 2),
+    ])
+    server = EchoServer()
+    try:
+        started = time.monotonic()
+        summary = SessionReplayer(path, server.address, speed=None, drain_timeout=0.2).run()
+    finally:
+        server.close()
+    assert summary["errors"] == {}
+    assert summary["received_bytes"] == len(b"firstsecond")
+    assert time.monotonic() - started < 0.9
+
+
+def test_connect_error_is_reported_per_session(tmp_path):
+    path = str(tmp_path / "session.phrec")
+    write_recording(path, [(0.0, DIRECTION_TO_SERVER, b"first", 1)])
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        address = unused.getsockname()
+    summary = SessionReplayer(path, address, drain_timeout=0.2).run()
+    assert "connect()" in summary["errors"]["1"]
@@ -0,0 +1,39 @@
+# test_sharded_packet_holder.py
+import time
+
+from session_recorder import EVENT_DATA
+from session_recorder import RecordSink
+from sharded_packet_holder import ShardedPacketHolder
+from test_packet_holder import CollectingServer
+from test_packet_holder import connect
+from test_packet_holder import get_free_port
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+# The workers' traffic ends up in the recording of the supervisor
+def test_recording_collects_traffic_of_workers(tmp_path):
+    server = CollectingServer()
+    holder = ShardedPacketHolder(num_of_workers=2)
+    holder.set_traffic_logger(None)
+    port = get_free_port()
+    path = tmp_path / "session.phrec"
+    holder.start_recording(str(path))
+    holder.start("127.0.0.1", port, "127.0.0.1", server.port)
+    try:
+        assert holder.get_worker_count() == 2
+        with connect(port) as client:
+            client.sendall(b"hello")
+            assert server.wait_for(5) == b"hello"
+        # Records are pushed by the workers in batches
+        time.sleep(0.5)
+        holder.stop_recording()
+    finally:
+        holder.stop()
+        server.close()
+    records = list(RecordSink.read_records(str(path)))
+    data = [record for record in records if record[1] == EVENT_DATA]
+    assert [record[4] for record in data] == [b"hello"]
+    assert data[0][3] is not None
+    assert holder.get_rule_set_error() is None
@@ -0,0 +1,139 @@
+# timer_wheel.py
+# Description: This file contains the TimerWheel class, a hashed timing wheel
+# which runs any number of one-shot timers on a single thread.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import math
+from threading import Condition
+from threading import Thread
+import time
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Timer
+# ------------------------------------------------------------------------------
+class Timer:
+    __slots__ = ("rounds", "callback", "args", "cancelled")
+
+    def __init__(self, rounds, callback, args):
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+# ------------------------------------------------------------------------------
+# TimerWheel
+# ------------------------------------------------------------------------------
+# Time is divided into ticks of tick seconds and the wheel has wheel_size
+# slots. A timer due at tick T goes into slot T % wheel_size with the number of
+# full revolutions still to wait, so scheduling is O(1) and every tick only
+# looks at one slot. Timers due in the same tick fire in the order they were
+# scheduled. Callbacks run on the wheel thread and must not block for long.
+# When no timer is pending the thread sleeps until one is scheduled.
+class TimerWheel:
+    def __init__(self, tick=0.001, wheel_size=4096):
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self.slots = [[] for _ in range(wheel_size)]
+        self.condition = Condition()
+        self.origin = time.monotonic()
+        self.current_tick = 0
+        self.pending = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Stops the thread. Pending timers are kept and fire after start().
+    def stop(self):
+        with self.condition:
+            if not self.running:
+                return
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.thread = None
+
+    def get_pending_count(self):
+        return self.pending
+
+    # Calls callback(*args) after delay seconds. Returns a Timer which can be
+    # cancelled.
+    def schedule(self, delay, callback, *args):
+        return self.schedule_at(time.monotonic() + max(delay, 0.0), callback, *args)
+
+    # Calls callback(*args) at deadline (a time.monotonic() value). Timers with
+    # increasing deadlines fire in the same order.
+    def schedule_at(self, deadline, callback, *args):
+        with self.condition:
+            now_tick = self._now_tick()
+            if self.pending == 0:
+                # Nothing to fire in between, skip the idle ticks
+                self.current_tick = max(self.current_tick, now_tick)
+            target_tick = max(self.current_tick + 1, math.ceil((deadline - self.origin) / self.tick))
+            ticks_ahead = target_tick - self.current_tick
+            timer = Timer((ticks_ahead - 1) // self.wheel_size, callback, args)
+            self.slots[target_tick % self.wheel_size].append(timer)
+            self.pending += 1
+            self.condition.notify()
+        return timer
+
+    def _now_tick(self):
+        return int((time.monotonic() - self.origin) / self.tick)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                if self.pending == 0:
+                    self.condition.wait()
+                    continue
+                now_tick = self._now_tick()
+                if now_tick <= self.current_tick:
+                    self.condition.wait((self.current_tick + 1) * self.tick + self.origin - time.monotonic())
+                    continue
+                expired = self._advance(now_tick)
+            for timer in expired:
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    print(f"An error occurred in a timer callback: {str(e)}")
+
+    # Moves the wheel up to now_tick and returns the expired timers in order.
+    # Called with the condition held.
+    def _advance(self, now_tick):
+        expired = []
+        slots = self.slots
+        while self.current_tick < now_tick and self.pending > len(expired):
+            self.current_tick += 1
+            index = self.current_tick % self.wheel_size
+            slot = slots[index]
+            if not slot:
+                continue
+            remaining = []
+            for timer in slot:
+                if timer.rounds == 0:
+                    expired.append(timer)
+                else:
+                    timer.rounds -= 1
+                    remaining.append(timer)
+            slots[index] = remaining
+        self.pending -= len(expired)
+        if self.pending == 0:
+            self.current_tick = max(self.current_tick, now_tick)
+        return expired
@@ -0,0 +1,226 @@
+# traffic_logger.py
+# Description: This file contains the TrafficLogger class and its sinks. The
+# forwarding threads only append a record to a ring buffer; formatting and I/O
+# are done in batches by a background writer thread.
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+import collections
+import datetime
+import os
+import struct
+import sys
+import time
+from threading import Event
+from threading import Thread
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Record
+# ------------------------------------------------------------------------------
+# A record is a plain tuple (timestamp, direction, kind, packet, session_id),
+# which is the cheapest thing to build on the forwarding path.
+DIRECTION_TO_SERVER = 0
+DIRECTION_FROM_SERVER = 1
+
+KIND_PASS_THROUGH = 0
+KIND_HOLDING = 1
+KIND_DELAYED = 2
+
+DIRECTION_TAGS = {DIRECTION_TO_SERVER: "[ ToSVR ]", DIRECTION_FROM_SERVER: "[FromSVR]"}
+KIND_TAGS = {KIND_PASS_THROUGH: "[PassThr]", KIND_HOLDING: "[Holding]", KIND_DELAYED: "[Delayed]"}
+
+
+def format_record(record):
+    timestamp, direction, kind, packet, session_id = record
+    session_tag = f"[Session {session_id}]" if session_id is not None else ""
+    return f"[Data]{datetime.datetime.fromtimestamp(timestamp)}{session_tag}{DIRECTION_TAGS[direction]}{KIND_TAGS[kind]}: {packet.decode('utf-8', 'ignore')}\n"
+
+
+# ------------------------------------------------------------------------------
+# Sinks
+# ------------------------------------------------------------------------------
+# A sink receives a list of records with write_batch() and is closed with
+# close(). Sinks are only used from the writer thread.
+class StdoutSink:
+    def write_batch(self, records):
+        # sys.stdout is looked up every time because GUIs redirect it
+        sys.stdout.write("".join(format_record(record) for record in records))
+        sys.stdout.flush()
+
+    def close(self):
+        pass
+
+
+class RotatingFileSink:
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.file = open(path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def write_batch(self, records):
+        text = "".join(format_record(record) for record in records)
+        if self.size > 0 and self.size + len(text) > self.max_bytes:
+            self._rotate()
+        self.file.write(text)
+        self.file.flush()
+        self.size += len(text)
+
+    def close(self):
+        self.file.close()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'w', encoding='utf-8')
+        self.size = 0
+
+
+# Binary capture: an 8-byte file header, then for each record
+# [timestamp: f64][direction: u8][kind: u8][session_id: u32][length: u32][packet]
+# in little endian. Records without session id are stored with session_id 0.
+class CaptureSink:
+    MAGIC = b"PHCAP\x00\x01\x00"
+    RECORD_HEADER = struct.Struct("<dBBII")
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(self.MAGIC)
+
+    def write_batch(self, records):
+        chunks = []
+        pack = self.RECORD_HEADER.pack
+        for timestamp, direction, kind, packet, session_id in records:
+            chunks.append(pack(timestamp, direction, kind, session_id or 0, len(packet)))
+            chunks.append(packet)
+        self.file.write(b"".join(chunks))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @classmethod
+    def read_records(cls, path):
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is not a PacketHolder capture file")
+            while True:
+                header = f.read(cls.RECORD_HEADER.size)
+                if len(header) < cls.RECORD_HEADER.size:
+                    return
+                timestamp, direction, kind, session_id, length = cls.RECORD_HEADER.unpack(header)
+                yield (timestamp, direction, kind, f.read(length), session_id or None)
+
+
+# ------------------------------------------------------------------------------
+# TrafficLogger
+# ------------------------------------------------------------------------------
+# The ring buffer is a collections.deque: append() and popleft() are atomic, so
+# the forwarding threads never take a lock to log. When the writer falls
+# behind and the buffer is full, the policy decides what happens:
+#   POLICY_DROP_NEWEST: the new record is dropped (default)
+#   POLICY_DROP_OLDEST: the oldest record is overwritten
+#   POLICY_BLOCK:       the forwarding thread waits for free space (backpressure)
+class TrafficLogger:
+    POLICY_DROP_NEWEST = "drop_newest"
+    POLICY_DROP_OLDEST = "drop_oldest"
+    POLICY_BLOCK = "block"
+
+    def __init__(self, sink=None, capacity=65536, batch_size=1024, flush_interval=0.1, policy=POLICY_DROP_NEWEST, clock=time.time):
+        self.sink = sink if sink is not None else StdoutSink()
+        # clock() gives the timestamp of every record
+        self.clock = clock
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        maxlen = capacity if policy == self.POLICY_DROP_OLDEST else None
+        self.ring = collections.deque(maxlen=maxlen)
+        self.dropped = 0
+        self.written = 0
+        self.wakeup = Event()
+        self.space_available = Event()
+        self.running = False
+        self.writer_thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.writer_thread = Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    # Stops the writer after everything already logged has been written.
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.writer_thread.join()
+        self.writer_thread = None
+
+    def close(self):
+        self.stop()
+        self.sink.close()
+
+    def log(self, direction, kind, packet, session_id=None):
+        self._append((self.clock(), direction, kind, packet, session_id))
+
+    # Logs records built elsewhere (e.g. by a TrafficLogger in another
+    # process) with their own timestamps.
+    def log_records(self, records):
+        for record in records:
+            self._append(record)
+
+    def _append(self, record):
+        ring = self.ring
+        if len(ring) >= self.capacity:
+            if self.policy == self.POLICY_DROP_NEWEST:
+                self.dropped += 1
+                return
+            if self.policy == self.POLICY_BLOCK:
+                while len(ring) >= self.capacity and self.running:
+                    self.wakeup.set()
+                    self.space_available.clear()
+                    self.space_available.wait(self.flush_interval)
+            else:
+                self.dropped += 1
+        ring.append(record)
+        if len(ring) >= self.batch_size:
+            self.wakeup.set()
+
+    def _write_loop(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            running = self.running
+            self._drain()
+            if not running:
+                break
+
+    def _drain(self):
+        ring = self.ring
+        while ring:
+            batch = []
+            try:
+                for _ in range(self.batch_size):
+                    batch.append(ring.popleft())
+            except IndexError:
+                pass
+            self.space_available.set()
+            try:
+                self.sink.write_batch(batch)
+                self.written += len(batch)
+            except Exception as e:
+                print(f"An error occurred while writing the traffic log: {str(e)}")
@@ -2,91 +2,90 @@
 """
 .pcapngファイルを解析して、アドレスとポートのペアごとのデータサイズを集計するプログラム
 
-必要なライブラリ:
-    pip install pyshark
+外部ライブラリは不要 (pcapng / pcap は pcap_reader モジュールで直接読み込む)
+NumPy がインストールされていれば集計にNumPyを使う (任意):
+    pip install numpy
 
 使用方法:
-    python analyze_pcapng.py <pcapngファイルパス>
+    python analyze_pcapng.py <pcapngファイルパス> [--jobs 並列数] [--bucket 時間幅] [--timeline-output 出力ファイル]
+                             [--conversations]
+    python analyze_pcapng.py --live <pcapngファイルパス | -> [--window 秒] [--interval 秒]
+    python analyze_pcapng.py <pcapngファイルパス> --index [--host アドレス] [--port ポート]
+                             [--since 時刻] [--until 時刻] [--top 件数]
+
+--bucket を指定すると、時間幅 (例: 10ms, 1s) ごとのバイト数からピークレートとパーセンタイルを表示する。
+--timeline-output で時間幅ごとの値を CSV (Parquet は拡張子 .parquet, pyarrow が必要) に出力する。
+--conversations を指定すると、双方向の会話ごとにヘッダーとペイロードの内訳、TCP の再送、グッドプットを表示する
+(TCP のシーケンス番号をパケットの順にたどるため、--jobs によらず逐次処理になる)。
+--live を指定すると、書き込み中のファイル (- は標準入力、dumpcap -w - の出力など) を読みながら、
+直近のウィンドウのレートを一定間隔で表示する。Ctrl+C で止めると累計を表示する。
+--index を指定すると、1回目にキャプチャの隣にインデックス (<キャプチャ>.index.npz, NumPy が必要) を作り、
+2回目以降はキャプチャを読まずにインデックスから集計する (キャプチャが変わっていれば作り直す)。
+--host / --port / --since / --until で絞り込み、--top で上位の接続と送受信の多いホストを表示する
+(絞り込みを指定するとインデックスを使う)。
 """
 
+import argparse
+import os
+import stat
 import sys
-import pyshark
-from collections import defaultdict
+import time
 from datetime import datetime
 
-
-def analyze_pcapng(pcapng_file):
+from capture_index import build_index
+from capture_index import get_index_path
+from capture_index import is_index_available
+from capture_index import load_index
+from capture_index import parse_time
+from flow_aggregator import aggregate_capture
+from flow_aggregator import is_numpy_available
+from live_capture import LIVE_WINDOW_SECONDS
+from live_capture import LiveCapture
+from live_capture import LiveFlowTable
+from timeline import REPORT_PERCENTILES
+from timeline import format_bucket_size
+from timeline import is_parquet_available
+from timeline import parse_bucket_size
+
+
+def analyze_pcapng(pcapng_file, jobs=1, bucket_seconds=None, timeline_output=None, conversations=False,
+                   use_index=False, query=None, top=None):
     """
     pcapngファイルを解析して、接続ごとのデータサイズを集計
 
     Args:
-        pcapng_file: .pcapngファイルのパス
+        pcapng_file: .pcapngファイル (または .pcap ファイル) のパス
+        jobs: 並列に解析するプロセス数 (2以上でファイルをチャンクに分けて並列に解析する)
+        bucket_seconds: 指定した場合はこの秒数ごとのスループットも集計する
+        timeline_output: 時間幅ごとの値の出力先 (.csv / .parquet)
+        conversations: True の場合は双方向の会話ごとの内訳も集計する (逐次処理になる)
+        use_index: True の場合はインデックスから集計する (ない場合や古い場合は作成する)
+        query: インデックスでの絞り込みの条件 (CaptureIndex.select() の引数の辞書)
+        top: 指定した場合は上位この件数の接続と、送受信の多いホストを表示する
     """
     print(f"pcapngファイルを読み込み中: {pcapng_file}\n")
 
     try:
-        # pcapngファイルを開く
-        cap = pyshark.FileCapture(pcapng_file)
-
-        # 統計情報を保存する辞書
-        # キー: (送信元IP, 送信元ポート, 宛先IP, 宛先ポート, プロトコル)
-        # 値: {'packets': パケット数, 'bytes': 総バイト数, 'timestamps': [タイムスタンプリスト]}
-        stats = defaultdict(lambda: {'packets': 0, 'bytes': 0, 'timestamps': []})
-
-        total_packets = 0
-
-        print("パケット解析中...")
-
-        # 各パケットを解析
-        for packet in cap:
-            total_packets += 1
-
-            try:
-                # IPレイヤーがあるか確認
-                if hasattr(packet, 'ip'):
-                    src_ip = packet.ip.src
-                    dst_ip = packet.ip.dst
-                    protocol = None
-                    src_port = None
-                    dst_port = None
-
-                    # TCPパケットの場合
-                    if hasattr(packet, 'tcp'):
-                        protocol = 'TCP'
-                        src_port = packet.tcp.srcport
-                        dst_port = packet.tcp.dstport
-                        packet_size = int(packet.length)
-
-                    # UDPパケットの場合
-                    elif hasattr(packet, 'udp'):
-                        protocol = 'UDP'
-                        src_port = packet.udp.srcport
-                        dst_port = packet.udp.dstport
-                        packet_size = int(packet.length)
-
-                    else:
-                        # TCP/UDP以外のIPパケット
-                        protocol = packet.ip.proto
-                        src_port = '-'
-                        dst_port = '-'
-                        packet_size = int(packet.length)
-
-                    # キーを作成（双方向の通信を別々に集計）
-                    key = (src_ip, src_port, dst_ip, dst_port, protocol)
-
-                    # 統計情報を更新
-                    stats[key]['packets'] += 1
-                    stats[key]['bytes'] += packet_size
-
-                    # タイムスタンプを記録
-                    if hasattr(packet, 'sniff_timestamp'):
-                        stats[key]['timestamps'].append(float(packet.sniff_timestamp))
-
-            except AttributeError as e:
-                # パケットの属性にアクセスできない場合はスキップ
-                continue
-
-        cap.close()
+        if use_index:
+            flow_table = aggregate_with_index(pcapng_file, bucket_seconds, query or {})
+        else:
+            if conversations and jobs > 1:
+                print("会話の解析はパケットの順に行うため、並列数は1になります")
+                jobs = 1
+            if is_numpy_available():
+                print(f"パケット解析中 (NumPy で集計, 並列数: {jobs})...")
+            else:
+                print(f"パケット解析中 (並列数: {jobs})...")
+
+            # 接続ごとの統計情報
+            # キー: (送信元IP, 送信元ポート, 宛先IP, 宛先ポート, プロトコル)
+            # 値: {'packets': パケット数, 'bytes': 総バイト数, 'first_timestamp': 最初のタイムスタンプ, 'last_timestamp': 最後のタイムスタンプ}
+            # パケットサイズは元のフレーム長、双方向の通信は別々に集計
+            flow_table = aggregate_capture(pcapng_file, workers=jobs, progress=print_progress,
+                                           bucket_seconds=bucket_seconds, conversations=conversations)
+            print()
+        stats = flow_table.get_stats()
+        total_packets = flow_table.total_packets
 
         print(f"解析完了: {total_packets} パケット\n")
 
@@ -100,21 +99,38 @@ def analyze_pcapng(pcapng_file):
 
         total_bytes = 0
 
-        for key, value in sorted_stats:
+        for rank, (key, value) in enumerate(sorted_stats):
             src_ip, src_port, dst_ip, dst_port, protocol = key
             packets = value['packets']
             bytes_count = value['bytes']
             total_bytes += bytes_count
 
+            # --top の場合は上位の接続だけを表示する (合計はすべての接続)
+            if top is not None and rank >= top:
+                continue
             print(f"{src_ip:25} {str(src_port):12} {dst_ip:25} {str(dst_port):12} {protocol:8} {packets:10} {bytes_count:15,}")
 
         print("=" * 100)
         print(f"{'合計':82} {sum(s['packets'] for s in stats.values()):10} {total_bytes:15,}")
         print("=" * 100)
 
+        if top is not None:
+            print_top_talkers(sorted_stats, top)
+
         # 接続ごとの詳細情報を表示（オプション）
         print_detailed_stats(sorted_stats)
 
+        # 時間幅ごとのスループットを表示
+        if flow_table.timeline is not None:
+            print_timeline_stats(flow_table.timeline, sorted_stats)
+            if timeline_output:
+                flow_table.timeline.write(timeline_output, [key for key, _value in sorted_stats])
+                print(f"\n時間幅ごとの値を出力しました: {timeline_output}")
+
+        # 双方向の会話ごとの内訳を表示
+        if flow_table.conversations is not None:
+            print_conversation_stats(flow_table.conversations.get_sorted())
+
     except FileNotFoundError:
         print(f"エラー: ファイルが見つかりません: {pcapng_file}")
         sys.exit(1)
@@ -123,6 +139,142 @@ def analyze_pcapng(pcapng_file):
         sys.exit(1)
 
 
+def aggregate_with_index(pcapng_file, bucket_seconds, query):
+    """
+    インデックスから接続ごとに集計する (インデックスがない場合やキャプチャが変わっている場合は作成する)
+
+    Args:
+        pcapng_file: .pcapngファイル (または .pcap ファイル) のパス
+        bucket_seconds: 指定した場合はこの秒数ごとのスループットも集計する
+        query: 絞り込みの条件 (CaptureIndex.select() の引数の辞書)
+
+    Returns:
+        FlowTable
+    """
+    index_path = get_index_path(pcapng_file)
+    index = load_index(pcapng_file)
+    if index is not None:
+        print(f"インデックスを使用: {index_path}")
+    else:
+        if not os.path.exists(pcapng_file):
+            raise FileNotFoundError(pcapng_file)
+        print("インデックスを作成中 (NumPy で集計)...")
+        index, _flow_table = build_index(pcapng_file, progress=print_progress)
+        print()
+        try:
+            index.save(index_path)
+            print(f"インデックスを保存しました: {index_path}")
+        except OSError as e:
+            print(f"警告: インデックスを保存できませんでした: {e}")
+
+    conditions = [f"{name}={value}" for name, value in query.items() if value]
+    if conditions:
+        print(f"絞り込み: {', '.join(conditions)}")
+    return index.get_flow_table(index.select(**query) if conditions else None, bucket_seconds)
+
+
+def print_top_talkers(sorted_stats, count):
+    """
+    送受信のバイト数が多いホストを表示
+    """
+    # ホスト -> [送信バイト数, 受信バイト数]
+    hosts = {}
+    for (src_ip, _src_port, dst_ip, _dst_port, _protocol), value in sorted_stats:
+        hosts.setdefault(src_ip, [0, 0])[0] += value['bytes']
+        hosts.setdefault(dst_ip, [0, 0])[1] += value['bytes']
+
+    print("\n\n" + "=" * 100)
+    print(f"送受信の多いホスト (上位{count}件)")
+    print("=" * 100)
+    print(f"{'アドレス':40} {'送信バイト数':>15} {'受信バイト数':>15} {'合計':>15}")
+    for host, (sent, received) in sorted(hosts.items(), key=lambda x: sum(x[1]), reverse=True)[:count]:
+        print(f"{host:40} {sent:15,} {received:15,} {sent + received:15,}")
+
+
+def analyze_live(capture_source, window_seconds=LIVE_WINDOW_SECONDS, interval=1.0):
+    """
+    書き込み中のキャプチャを読みながら、直近のレートを interval 秒ごとに表示
+
+    Args:
+        capture_source: .pcapng / .pcap ファイルのパス (ファイルは書き込みを待って読み続ける)。
+            '-' の場合は標準入力、名前付きパイプの場合はパイプが閉じられるまで読む
+        window_seconds: レートを計算するウィンドウ (秒)
+        interval: 表示を更新する間隔 (秒)
+    """
+    try:
+        if capture_source == '-':
+            f = sys.stdin.buffer
+            follow = False
+        else:
+            f = open(capture_source, 'rb')
+            follow = not stat.S_ISFIFO(os.fstat(f.fileno()).st_mode)
+    except FileNotFoundError:
+        print(f"エラー: ファイルが見つかりません: {capture_source}")
+        sys.exit(1)
+
+    table = LiveFlowTable(window_seconds, slot_seconds=min(1.0, window_seconds))
+    capture = LiveCapture(f, follow, table)
+    capture.start()
+    try:
+        while capture.is_running():
+            time.sleep(interval)
+            print_live_stats(table, capture_source)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        capture.stop(timeout=1.0)
+        if f is not sys.stdin.buffer:
+            f.close()
+
+    if capture.error is not None:
+        print(f"エラー: {capture.error}")
+        sys.exit(1)
+
+    # 累計を表示
+    with table.lock:
+        stats = table.get_stats()
+        print(f"\n読み込み完了: {table.total_packets} パケット ({table.total_bytes:,} bytes)")
+        if table.evicted_flows:
+            print(f"(接続数が上限を超えたため、{table.evicted_flows:,} 接続 ({table.evicted_packets:,} パケット, "
+                  f"{table.evicted_bytes:,} bytes) は累計から除外)")
+    print_detailed_stats(sorted(stats.items(), key=lambda x: x[1]['bytes'], reverse=True))
+
+
+def print_live_stats(table, capture_source):
+    """
+    直近のウィンドウのレートの上位の接続を、画面を消去して表示
+    """
+    with table.lock:
+        (packet_rate, byte_rate), rates = table.get_rates()
+        flows = {key: table.flows[key][:2] for key in rates if key in table.flows}
+        total_packets = table.total_packets
+        total_bytes = table.total_bytes
+        flow_count = len(table.flows)
+
+    # カーソルを先頭に戻して画面を消去する
+    print("\033[H\033[J", end='')
+    print(f"ライブ解析中: {capture_source}  (直近 {table.window_seconds:g} 秒のレート, Ctrl+C で終了)")
+    print(f"累計: {total_packets:,} パケット, {total_bytes:,} bytes, 接続数: {flow_count:,}")
+    print(f"全体: {byte_rate:,.2f} bytes/sec ({byte_rate/1024:,.2f} KB/sec), {packet_rate:,.1f} packets/sec")
+    print("=" * 100)
+    print(f"{'接続':60} {'KB/sec':>12} {'packets/sec':>12} {'累計バイト数':>14}")
+    print("=" * 100)
+    for key, (packets_per_sec, bytes_per_sec) in sorted(rates.items(), key=lambda x: x[1][1], reverse=True)[:20]:
+        src_ip, src_port, dst_ip, dst_port, protocol = key
+        flow = f"{src_ip}:{src_port} → {dst_ip}:{dst_port} ({protocol})"
+        bytes_count = flows[key][1] if key in flows else 0
+        print(f"{flow:60} {bytes_per_sec/1024:12,.2f} {packets_per_sec:12,.1f} {bytes_count:14,}")
+    sys.stdout.flush()
+
+
+def print_progress(done_bytes, total_bytes):
+    """
+    解析の進捗を同じ行に上書きして表示
+    """
+    percent = done_bytes / total_bytes * 100 if total_bytes else 100.0
+    print(f"\r  進捗: {percent:5.1f}% ({done_bytes/1024/1024:,.1f} / {total_bytes/1024/1024:,.1f} MB)", end='', flush=True)
+
+
 def print_detailed_stats(sorted_stats):
     """
     接続ごとの詳細統計情報を表示
@@ -135,16 +287,15 @@ def print_detailed_stats(sorted_stats):
         src_ip, src_port, dst_ip, dst_port, protocol = key
         packets = value['packets']
         bytes_count = value['bytes']
-        timestamps = value['timestamps']
+        start_time = value['first_timestamp']
+        end_time = value['last_timestamp']
 
         print(f"\n[{idx}] {src_ip}:{src_port} → {dst_ip}:{dst_port} ({protocol})")
         print(f"    パケット数: {packets:,}")
         print(f"    総バイト数: {bytes_count:,} bytes ({bytes_count/1024:.2f} KB, {bytes_count/1024/1024:.2f} MB)")
         print(f"    平均パケットサイズ: {bytes_count/packets:.2f} bytes")
 
-        if timestamps and len(timestamps) > 1:
-            start_time = min(timestamps)
-            end_time = max(timestamps)
+        if start_time is not None and packets > 1:
             duration = end_time - start_time
 
             # タイムスタンプを日付・時刻に変換
@@ -157,21 +308,112 @@ def print_detailed_stats(sorted_stats):
             if duration > 0:
                 print(f"    通信時間: {duration:.2f} 秒")
                 print(f"    平均レート: {bytes_count/duration:.2f} bytes/sec ({bytes_count/duration/1024:.2f} KB/sec)")
-        elif timestamps and len(timestamps) == 1:
+        elif start_time is not None:
             # パケットが1つだけの場合
-            single_time = timestamps[0]
-            single_datetime = datetime.fromtimestamp(single_time)
+            single_datetime = datetime.fromtimestamp(start_time)
             print(f"    通信時刻: {single_datetime.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}")
 
 
+def print_timeline_stats(timeline, sorted_stats):
+    """
+    時間幅ごとのスループットのピークとパーセンタイルを表示
+    (パケットのない時間帯も0として数える)
+    """
+    percentile_header = ' '.join(f"{'p' + str(percentile):>12}" for percentile in REPORT_PERCENTILES)
+
+    print("\n\n" + "=" * 100)
+    print(f"時間帯別スループット (時間幅: {format_bucket_size(timeline.bucket_seconds)}, 単位: KB/sec)")
+    print("=" * 100)
+
+    summary = timeline.summarize(timeline.get_total())
+    if summary is None:
+        print("タイムスタンプのあるパケットがありません")
+        return
+
+    peak_datetime = datetime.fromtimestamp(summary['peak_at'])
+    print("全体")
+    print(f"    ピークレート: {summary['peak_bytes_per_sec']:,.2f} bytes/sec ({summary['peak_bytes_per_sec']/1024:,.2f} KB/sec, "
+          f"{summary['peak_packets_per_sec']:,.0f} packets/sec)")
+    print(f"    ピーク時刻: {peak_datetime.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}")
+    print(f"    平均レート: {summary['mean_bytes_per_sec']:,.2f} bytes/sec ({summary['mean_bytes_per_sec']/1024:,.2f} KB/sec)")
+    for percentile, rate in summary['percentiles'].items():
+        print(f"    p{percentile}: {rate:,.2f} bytes/sec ({rate/1024:,.2f} KB/sec)")
+    print(f"    時間幅の数: {summary['buckets']:,} (パケットあり: {summary['active_buckets']:,})")
+
+    print(f"\n{'接続':60} {'ピーク':>12} {percentile_header}")
+    for key, _value in sorted_stats[:10]:  # 上位10件のみ表示
+        summary = timeline.summarize(timeline.flows.get(key))
+        if summary is None:
+            continue
+        src_ip, src_port, dst_ip, dst_port, protocol = key
+        flow = f"{src_ip}:{src_port} → {dst_ip}:{dst_port} ({protocol})"
+        percentiles = ' '.join(f"{rate/1024:12,.2f}" for rate in summary['percentiles'].values())
+        print(f"{flow:60} {summary['peak_bytes_per_sec']/1024:12,.2f} {percentiles}")
+
+
+def print_conversation_stats(sorted_conversations):
+    """
+    双方向の会話ごとのヘッダー・ペイロードの内訳と TCP の再送を表示
+    (グッドプット: 再送・重複・キープアライブを除いたペイロードのバイト数。
+    順番が入れ替わって届いたセグメントは再送に含まれる)
+    """
+    print("\n\n" + "=" * 100)
+    print("会話ごとの内訳 (A ⇄ B, 単位: bytes)")
+    print("=" * 100)
+    print(f"{'会話':56} {'パケット数':>10} {'総バイト数':>13} {'ヘッダー':>12} {'ペイロード':>13} {'再送':>6} {'重複':>6} {'効率':>7}")
+
+    for conversation in sorted_conversations:
+        a_ip, a_port, b_ip, b_port, protocol = conversation.key
+        name = f"{a_ip}:{a_port} ⇄ {b_ip}:{b_port} ({protocol})"
+        wire_bytes = conversation.get_total('wire_bytes')
+        efficiency = conversation.get_goodput_bytes() / wire_bytes * 100 if wire_bytes else 0.0
+        print(f"{name:56} {conversation.get_total('packets'):10} {wire_bytes:13,} {conversation.get_header_bytes():12,} "
+              f"{conversation.get_total('payload_bytes'):13,} {conversation.get_total('retransmitted_segments'):6} "
+              f"{conversation.get_total('duplicate_segments'):6} {efficiency:6.1f}%")
+
+    for idx, conversation in enumerate(sorted_conversations[:10], 1):  # 上位10件のみ表示
+        a_ip, a_port, b_ip, b_port, protocol = conversation.key
+        print(f"\n[{idx}] {a_ip}:{a_port} ⇄ {b_ip}:{b_port} ({protocol})")
+        for label, direction in (('A → B', conversation.directions[0]), ('B → A', conversation.directions[1])):
+            if direction.packets == 0:
+                print(f"    {label}: パケットなし")
+                continue
+            print(f"    {label}: {direction.packets:,} パケット, {direction.wire_bytes:,} bytes "
+                  f"(L2: {direction.l2_bytes:,}, L3: {direction.l3_bytes:,}, L4: {direction.l4_bytes:,}, "
+                  f"ペイロード: {direction.payload_bytes:,})")
+            if protocol == 'TCP':
+                print(f"           再送: {direction.retransmitted_segments:,} セグメント, "
+                      f"重複: {direction.duplicate_segments:,} セグメント, "
+                      f"再送されたバイト数: {direction.retransmitted_bytes:,}, "
+                      f"キープアライブ: {direction.keepalive_segments:,} セグメント, "
+                      f"グッドプット: {direction.get_goodput_bytes():,} bytes")
+
+        duration = conversation.get_duration()
+        if duration:
+            wire_rate = conversation.get_total('wire_bytes') / duration
+            goodput_rate = conversation.get_goodput_bytes() / duration
+            print(f"    通信時間: {duration:.2f} 秒")
+            print(f"    スループット: {wire_rate:,.2f} bytes/sec ({wire_rate/1024:,.2f} KB/sec), "
+                  f"グッドプット: {goodput_rate:,.2f} bytes/sec ({goodput_rate/1024:,.2f} KB/sec)")
+
+
 def print_usage():
     """使用方法を表示"""
     print("使用方法:")
-    print("  python analyze_pcapng.py <pcapngファイルパス>")
+    print("  python analyze_pcapng.py <pcapngファイルパス> [--jobs 並列数] [--bucket 時間幅] [--timeline-output 出力ファイル]")
+    print("                           [--conversations]")
+    print("  python analyze_pcapng.py --live <pcapngファイルパス | -> [--window 秒] [--interval 秒]")
+    print("  python analyze_pcapng.py <pcapngファイルパス> --index [--host アドレス] [--port ポート] [--since 時刻] [--until 時刻] [--top 件数]")
     print("\n例:")
     print("  python analyze_pcapng.py capture.pcapng")
-    print("\n必要なライブラリ:")
-    print("  pip install pyshark")
+    print("  python analyze_pcapng.py capture.pcapng --jobs 0    (CPUコア数で並列に解析)")
+    print("  python analyze_pcapng.py capture.pcapng --bucket 10ms --timeline-output timeline.csv")
+    print("  python analyze_pcapng.py capture.pcapng --conversations    (会話ごとの内訳・TCP の再送を表示)")
+    print("  python analyze_pcapng.py --live capture.pcapng    (書き込み中のファイルを読みながら表示)")
+    print("  dumpcap -i lo -w - | python analyze_pcapng.py --live -")
+    print("  python analyze_pcapng.py capture.pcapng --port 12345 --top 5    (インデックスから絞り込んで集計)")
+    print("\n対応フォーマット:")
+    print("  pcapng / pcap (Ethernet, Linux cooked capture, loopback, raw IP の IPv4 / IPv6)")
 
 
 if __name__ == "__main__":
@@ -180,5 +422,62 @@ if __name__ == "__main__":
         print_usage()
         sys.exit(1)
 
-    pcapng_file = sys.argv[1]
-    analyze_pcapng(pcapng_file)
+    parser = argparse.ArgumentParser(description=".pcapngファイルを解析して、アドレスとポートのペアごとのデータサイズを集計")
+    parser.add_argument('pcapng_file', help=".pcapng / .pcap ファイルのパス (--live では - で標準入力)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="並列に解析するプロセス数 (0: CPUコア数, 既定: 1)")
+    parser.add_argument('--bucket', help="スループットを集計する時間幅 (例: 10ms, 1s)")
+    parser.add_argument('--timeline-output', help="時間幅ごとの値の出力先 (.csv / .parquet, 時間幅の既定: 1s)")
+    parser.add_argument('--conversations', action='store_true',
+                        help="双方向の会話ごとにヘッダー・ペイロードの内訳と TCP の再送を表示 (逐次処理)")
+    parser.add_argument('--live', action='store_true',
+                        help="書き込み中のファイル・パイプを読みながら直近のレートを表示 (Ctrl+C で終了)")
+    parser.add_argument('--window', type=float, default=LIVE_WINDOW_SECONDS,
+                        help=f"--live でレートを計算するウィンドウ (秒, 既定: {LIVE_WINDOW_SECONDS:g})")
+    parser.add_argument('--interval', type=float, default=1.0, help="--live で表示を更新する間隔 (秒, 既定: 1)")
+    parser.add_argument('--index', action='store_true',
+                        help="インデックス (<キャプチャ>.index.npz) を作成・使用して集計 (NumPy が必要)")
+    parser.add_argument('--host', action='append', help="このアドレスの接続に絞り込む (複数指定可, インデックスを使用)")
+    parser.add_argument('--port', type=int, action='append', help="このポートの接続に絞り込む (複数指定可, インデックスを使用)")
+    parser.add_argument('--since', help="この時刻以降のパケットに絞り込む (UNIX 時間か '2025-10-25 12:00:00', インデックスを使用)")
+    parser.add_argument('--until', help="この時刻より前のパケットに絞り込む (インデックスを使用)")
+    parser.add_argument('--top', type=int, help="上位の件数の接続と、送受信の多いホストを表示")
+    args = parser.parse_args()
+
+    if args.live:
+        if not (args.window > 0 and args.interval > 0):
+            print("エラー: --window と --interval は正の値にしてください")
+            sys.exit(1)
+        analyze_live(args.pcapng_file, args.window, args.interval)
+        sys.exit(0)
+
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    bucket_seconds = None
+    if args.bucket or args.timeline_output:
+        try:
+            bucket_seconds = parse_bucket_size(args.bucket or '1s')
+        except ValueError as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+    if args.timeline_output and args.timeline_output.lower().endswith('.parquet') and not is_parquet_available():
+        print("エラー: Parquet への出力には pyarrow が必要です (pip install pyarrow)")
+        sys.exit(1)
+
+    try:
+        query = {'hosts': args.host, 'ports': args.port,
+                 'since': parse_time(args.since) if args.since else None,
+                 'until': parse_time(args.until) if args.until else None}
+    except ValueError as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
+    use_index = args.index or any(value is not None for value in query.values())
+    if use_index and not is_index_available():
+        print("エラー: インデックスには NumPy が必要です (pip install numpy)")
+        sys.exit(1)
+    if use_index and args.conversations:
+        print("エラー: --conversations はパケットのデータを読むため、インデックスや絞り込みと併用できません")
+        sys.exit(1)
+    if args.top is not None and args.top <= 0:
+        print("エラー: --top は正の値にしてください")
+        sys.exit(1)
+    analyze_pcapng(args.pcapng_file, jobs, bucket_seconds, args.timeline_output, args.conversations,
+                   use_index, query, args.top)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+キャプチャファイルのインデックス (サイドカーファイル) を作成・検索するモジュール
+
+1回目の解析でパケットごとの位置・タイムスタンプ・フレーム長・接続の番号を列ごとの配列にして
+キャプチャの隣 (<キャプチャ>.index.npz) に保存する。
+2回目以降はキャプチャを読まずにインデックスだけで集計するため、
+ホスト・ポート・時間帯で絞り込んだ集計や並べ替えをすぐに行える。
+
+インデックスにはキャプチャのサイズと更新時刻を記録し、キャプチャが変わっていれば作り直す。
+
+NumPy が必要:
+    pip install numpy
+"""
+
+import math
+import mmap
+import os
+from datetime import datetime
+from itertools import islice
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from flow_aggregator import CHUNK_PACKETS
+from flow_aggregator import FlowTable
+from flow_aggregator import aggregate_buckets
+from flow_aggregator import aggregate_packets
+from pcap_reader import scan_packets
+
+if np is not None:
+    from flow_aggregator import PACKET_DTYPE
+
+
+# インデックスファイルの拡張子 (キャプチャのファイル名の後ろに付ける)
+INDEX_SUFFIX = '.index.npz'
+# インデックスの形式のバージョン (形式を変えたら上げる)
+INDEX_VERSION = 1
+
+# パケットごとの列
+PACKET_COLUMNS = ('offset', 'captured', 'timestamp', 'length', 'flow')
+
+
+def is_index_available():
+    """インデックスが使えるか (NumPy がインストールされているか)"""
+    return np is not None
+
+
+def get_index_path(capture_file):
+    """キャプチャファイルのインデックスのパス"""
+    return capture_file + INDEX_SUFFIX
+
+
+def parse_time(text):
+    """
+    時刻の文字列を UNIX 時間 (秒) に変換する
+
+    Args:
+        text: UNIX 時間 ('1700000000.5') または日時 ('2025-10-25 12:00:00', ローカル時刻)
+    """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise ValueError(f"時刻が不正です: {text}")
+
+
+class CaptureIndex:
+    """
+    キャプチャのインデックス
+
+    columns: パケットごとの列 (PACKET_COLUMNS)
+        offset / captured: パケットデータの位置とキャプチャされた長さ
+        timestamp: タイムスタンプ (ない場合は NaN)
+        length: 元のフレーム長
+        flow: 接続の番号 (flow_keys での位置、IP パケットでない場合は -1)
+    flow_keys: 接続のキーのリスト (最初のパケットが現れた順)
+    """
+
+    def __init__(self, columns, flow_keys, capture_size, capture_mtime_ns):
+        self.columns = columns
+        self.flow_keys = flow_keys
+        self.capture_size = capture_size
+        self.capture_mtime_ns = capture_mtime_ns
+
+    def __len__(self):
+        return len(self.columns['flow'])
+
+    def is_valid_for(self, capture_file):
+        """キャプチャが変わっていないか (サイズと更新時刻で判定する)"""
+        stat = os.stat(capture_file)
+        return stat.st_size == self.capture_size and stat.st_mtime_ns == self.capture_mtime_ns
+
+    def select(self, hosts=None, ports=None, since=None, until=None):
+        """
+        条件に合うパケットを選ぶ
+
+        Args:
+            hosts: いずれかを送信元か宛先に含む接続のパケット
+            ports: いずれかを送信元か宛先のポートに含む接続のパケット
+            since / until: タイムスタンプがこの範囲 (since 以上 until 未満) のパケット
+
+        Returns:
+            パケットごとの bool の配列
+        """
+        flow = self.columns['flow']
+        mask = flow >= 0
+        if hosts or ports:
+            hosts = set(hosts or ())
+            ports = set(ports or ())
+            matched = np.array([(not hosts or src_ip in hosts or dst_ip in hosts) and
+                                (not ports or src_port in ports or dst_port in ports)
+                                for src_ip, src_port, dst_ip, dst_port, _protocol in self.flow_keys] + [False],
+                               dtype=bool)
+            # flow が -1 のパケットは最後の要素 (False) になる
+            mask &= matched[flow]
+        timestamp = self.columns['timestamp']
+        if since is not None:
+            mask &= timestamp >= since
+        if until is not None:
+            mask &= timestamp < until
+        return mask
+
+    def get_flow_table(self, mask=None, bucket_seconds=None):
+        """
+        インデックスから接続ごとに集計する (キャプチャ全体を集計した場合と同じ結果になる)
+
+        Args:
+            mask: select() の戻り値。省略時はすべてのパケット
+            bucket_seconds: 指定した場合はこの秒数ごとのバケットの値も集計する
+
+        Returns:
+            FlowTable
+        """
+        table = FlowTable(bucket_seconds)
+        flow = self.columns['flow']
+        if mask is None:
+            table.total_packets = len(flow)
+            mask = flow >= 0
+        else:
+            table.total_packets = int(np.count_nonzero(mask))
+        flow = flow[mask]
+        length = self.columns['length'][mask]
+        timestamp = self.columns['timestamp'][mask]
+        if len(flow) == 0:
+            return table
+
+        # 選んだパケットに現れる接続だけを、最初に現れた順に並べる
+        numbers, first_positions, inverse = np.unique(flow, return_index=True, return_inverse=True)
+        order = np.argsort(first_positions, kind='stable')
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        inverse = rank[inverse.reshape(-1)]
+        flow_keys = [self.flow_keys[number] for number in numbers[order].tolist()]
+
+        count = len(flow_keys)
+        packet_counts = np.bincount(inverse, minlength=count)
+        byte_counts = np.zeros(count, dtype=np.uint64)
+        np.add.at(byte_counts, inverse, length)
+        first_timestamps = np.full(count, np.nan)
+        last_timestamps = np.full(count, np.nan)
+        np.fmin.at(first_timestamps, inverse, timestamp)
+        np.fmax.at(last_timestamps, inverse, timestamp)
+        for key, packet_count, bytes_count, first_timestamp, last_timestamp in zip(
+                flow_keys, packet_counts.tolist(), byte_counts.tolist(),
+                first_timestamps.tolist(), last_timestamps.tolist()):
+            if math.isnan(first_timestamp):
+                first_timestamp = last_timestamp = None
+            table.add_flow(key, packet_count, bytes_count, first_timestamp, last_timestamp)
+
+        if table.timeline is not None:
+            aggregate_buckets(table.timeline, {'timestamp': timestamp, 'length': length}, flow_keys, inverse)
+        return table
+
+    def save(self, path):
+        """インデックスを保存する (書き込み途中のファイルが残らないよう、一時ファイルから置き換える)"""
+        src_ip, src_port, dst_ip, dst_port, protocol = zip(*self.flow_keys) if self.flow_keys else ((),) * 5
+        arrays = dict(self.columns)
+        arrays.update({
+            'version': np.array(INDEX_VERSION),
+            'capture_size': np.array(self.capture_size),
+            'capture_mtime_ns': np.array(self.capture_mtime_ns),
+            'src_ip': np.array(src_ip, dtype=str),
+            'src_port': np.array([-1 if port == '-' else port for port in src_port], dtype=np.int64),
+            'dst_ip': np.array(dst_ip, dtype=str),
+            'dst_port': np.array([-1 if port == '-' else port for port in dst_port], dtype=np.int64),
+            'protocol': np.array(protocol, dtype=str),
+        })
+        temporary_path = path + '.tmp'
+        try:
+            with open(temporary_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+
+def load_index(capture_file):
+    """
+    キャプチャのインデックスを読み込む
+
+    Returns:
+        CaptureIndex。インデックスがない・壊れている・キャプチャが変わっている場合は None
+    """
+    try:
+        with np.load(get_index_path(capture_file), allow_pickle=False) as arrays:
+            if int(arrays['version']) != INDEX_VERSION:
+                return None
+            columns = {name: arrays[name] for name in PACKET_COLUMNS}
+            flow_keys = [(src_ip, '-' if src_port < 0 else src_port, dst_ip, '-' if dst_port < 0 else dst_port, protocol)
+                         for src_ip, src_port, dst_ip, dst_port, protocol in zip(
+                             arrays['src_ip'].tolist(), arrays['src_port'].tolist(), arrays['dst_ip'].tolist(),
+                             arrays['dst_port'].tolist(), arrays['protocol'].tolist())]
+            index = CaptureIndex(columns, flow_keys, int(arrays['capture_size']), int(arrays['capture_mtime_ns']))
+    except (OSError, KeyError, ValueError):
+        return None
+    return index if index.is_valid_for(capture_file) else None
+
+
+def build_index(capture_file, progress=None):
+    """
+    キャプチャを読んでインデックスを作成する
+
+    Args:
+        capture_file: .pcapng / .pcap ファイルのパス
+        progress: 進捗を受け取る関数 progress(処理済みバイト数, ファイルのバイト数)
+
+    Returns:
+        (CaptureIndex, キャプチャ全体の FlowTable)
+    """
+    table = FlowTable()
+    # 接続のキー -> 番号 (table.flows での位置)
+    numbers = {}
+    chunks = []
+    with open(capture_file, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    scanner = scan_packets(buffer, no_timestamp=math.nan)
+    try:
+        while True:
+            records = list(islice(scanner, CHUNK_PACKETS))
+            if not records:
+                break
+            packets = np.array(records, dtype=PACKET_DTYPE)
+            flow_ids = np.empty(len(packets), dtype=np.int64)
+            chunk_table = aggregate_packets(buffer, data, packets, flow_ids=flow_ids)
+            table.merge(chunk_table)
+            # チャンク内の番号を全体の番号にする (-1 は最後の要素の -1 になる)
+            lookup = np.array([numbers.setdefault(key, len(numbers)) for key in chunk_table.flows] + [-1],
+                              dtype=np.int64)
+            chunks.append((packets['offset'], packets['captured'], packets['timestamp'], packets['length'],
+                           lookup[flow_ids].astype(np.int32)))
+            if progress is not None:
+                _timestamp, _length, _linktype, offset, captured = records[-1]
+                progress(offset + captured, stat.st_size)
+    finally:
+        del data
+        scanner.close()
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+    if progress is not None:
+        progress(stat.st_size, stat.st_size)
+
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.uint64),
+             np.empty(0, dtype=np.int32))
+    columns = {name: np.concatenate([chunk[i] for chunk in chunks]) if chunks else empty[i]
+               for i, name in enumerate(PACKET_COLUMNS)}
+    index = CaptureIndex(columns, list(table.flows), stat.st_size, stat.st_mtime_ns)
+    return index, table
@@ -1,29 +1,108 @@
+import argparse
+import asyncio
 import socket
 import random
 import string
 import time
 import sys
+import threading
+from collections import deque
 from datetime import datetime
 
+from latency_histogram import LatencyHistogram
+from latency_histogram import format_latency
+from latency_histogram import format_summary
+from latency_histogram import write_json
+from reporting import IntervalReporter
+from reporting import TraceWriter
+
 HOST = '127.0.0.1'
 PORT = 12345
 
+# 負荷生成モードで事前に生成しておくメッセージの数 (送信時は順に使い回す)
+PAYLOAD_POOL_SIZE = 1024
+# 負荷生成モードの接続ごとの受信バッファーの初期サイズ
+RECV_BUFFER_SIZE = 64 * 1024
+# 負荷生成モードで同時に接続処理を行う数
+CONNECT_CONCURRENCY = 100
+# 負荷生成モードの統計情報の表示間隔 (秒)
+LOAD_REPORT_INTERVAL = 1.0
+# 通常モードの統計情報の表示間隔 (秒)
+CLIENT_REPORT_INTERVAL = 10.0
+
+# --trace で出力するメッセージごとの記録の列
+TRACE_COLUMNS = ('time_ns', 'connection', 'sent', 'received', 'rtt_ns')
+
 class ClientStats:
     def __init__(self):
         self.total_sent = 0
         self.total_received = 0
         self.message_count = 0
+        self.errors = 0
+        # 送信してからエコーバックを受信し終えるまでの時間 (ナノ秒)
+        self.rtt = LatencyHistogram()
+        # 前回 take_window() 以降の RTT
+        self.window_rtt = LatencyHistogram()
+        # 表示用のスレッドからも参照するため、更新と参照は lock を取って行う
+        self.lock = threading.Lock()
 
-    def add_stats(self, sent, received):
-        self.total_sent += sent
-        self.total_received += received
-        self.message_count += 1
+    def add_stats(self, sent, received, rtt_ns=None):
+        with self.lock:
+            self.total_sent += sent
+            self.total_received += received
+            self.message_count += 1
+            if rtt_ns is not None:
+                self.rtt.record(rtt_ns)
+                self.window_rtt.record(rtt_ns)
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def take_window(self):
+        """(メッセージ数, 送信量, 受信量, 照合エラー数, 前回呼び出してからの RTT のヒストグラム)"""
+        with self.lock:
+            window, self.window_rtt = self.window_rtt, LatencyHistogram()
+            return self.message_count, self.total_sent, self.total_received, self.errors, window
 
     def print_stats(self, client_id):
         print(f"\n[クライアント{client_id}] 統計情報:")
         print(f"  メッセージ数: {self.message_count}")
         print(f"  総送信量: {self.total_sent:,} バイト ({self.total_sent/1024:.2f} KB)")
         print(f"  総受信量: {self.total_received:,} バイト ({self.total_received/1024:.2f} KB)")
+        print(f"  照合エラー: {self.errors}")
+        print(f"  RTT: {format_summary(self.rtt)}")
+
+    def to_dict(self, client_id):
+        """JSON に出力する結果 ('rtt' は latency_histogram.py で他のクライアントと統合できる)"""
+        return {
+            'client': str(client_id),
+            'messages': self.message_count,
+            'sent_bytes': self.total_sent,
+            'received_bytes': self.total_received,
+            'errors': self.errors,
+            'rtt': self.rtt.to_dict(),
+        }
+
+    def make_report(self, client_id):
+        """
+        IntervalReporter に渡す、前回の表示からの変化を1行にする関数を作る
+
+        メッセージがなかった区間は表示しない
+        """
+        previous_count, previous_sent, previous_received, previous_errors, _window = self.take_window()
+
+        def report():
+            nonlocal previous_count, previous_sent, previous_received, previous_errors
+            count, sent, received, errors, window = self.take_window()
+            messages = count - previous_count
+            line = (f"[{datetime.now().strftime('%H:%M:%S')}] クライアント{client_id} - メッセージ: {messages}, "
+                    f"送信: {sent - previous_sent:,}バイト, 受信: {received - previous_received:,}バイト, "
+                    f"照合エラー: {errors - previous_errors}, RTT p50: {format_latency(window.percentile(50))} "
+                    f"max: {format_latency(window.max if window.count else None)}")
+            previous_count, previous_sent, previous_received, previous_errors = count, sent, received, errors
+            return line if messages else None
+        return report
 
 def generate_random_ascii(min_size=100, max_size=1000):
     """ランダムなASCII文字列を生成"""
@@ -63,48 +142,352 @@ def receive_message(sock):
     received_size = len(length_data) + len(data)
     return data.decode('ascii'), received_size
 
-def run_client(client_id):
-    """クライアントを実行"""
+def generate_payload_pool(sizes, count=PAYLOAD_POOL_SIZE):
+    """
+    負荷生成用のメッセージ (長さヘッダー付き) を事前に生成する
+
+    Args:
+        sizes: メッセージ本体のサイズを返す関数
+        count: 生成するメッセージの数
+
+    Returns:
+        [長さヘッダー + ランダムなASCII文字列 の bytes]
+    """
+    sizes = [sizes() for _ in range(count)]
+    characters = (string.ascii_letters + string.digits + string.punctuation + ' ').encode('ascii')
+    # 全メッセージで共有する文字列を1回だけ生成し、ずらしながら切り出す
+    block = bytes(random.choices(characters, k=max(sizes) + count))
+    return [size.to_bytes(4, 'big') + block[i:i + size] for i, size in enumerate(sizes)]
+
+class LoadConnection(asyncio.BufferedProtocol):
+    """
+    負荷生成モードの1接続
+
+    送信したメッセージを送信時刻と一緒に outstanding に積み、
+    エコーバックを受信した順に取り出して照合し、RTT を記録する。
+    受信は確保済みのバッファーに直接書き込まれる (BufferedProtocol)。
+    """
+    def __init__(self, generator):
+        self.generator = generator
+        self.transport = None
+        self.buffer = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.filled = 0
+        # 応答待ちの (メッセージ, 送信時刻 (perf_counter_ns))
+        self.outstanding = deque()
+        # この接続の RTT
+        self.rtt = LatencyHistogram()
+        self.name = None
+        # 応答待ちが減ったときに送信側を起こす
+        self.window_open = asyncio.Event()
+        self.closed = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.name = '%s:%s' % transport.get_extra_info('sockname')[:2]
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, frame):
+        self.outstanding.append((frame, time.perf_counter_ns()))
+        self.transport.write(frame)
+        self.generator.stats.add_sent(len(frame))
+
+    def get_buffer(self, sizehint):
+        if self.filled == len(self.buffer):
+            self.view.release()
+            self.buffer.extend(bytes(len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        return self.view[self.filled:]
+
+    def buffer_updated(self, nbytes):
+        self.filled += nbytes
+        position = 0
+        stats = self.generator.stats
+        trace = self.generator.trace
+        now = time.perf_counter_ns()
+        while self.filled - position >= 4:
+            frame_size = 4 + int.from_bytes(self.view[position:position + 4], 'big')
+            if self.filled - position < frame_size:
+                break
+            if not self.outstanding:
+                stats.errors += 1
+            else:
+                expected, sent_at = self.outstanding.popleft()
+                if len(expected) != frame_size or \
+                        (self.generator.verify and self.view[position:position + frame_size] != expected):
+                    stats.errors += 1
+                self.rtt.record(now - sent_at)
+                stats.window_rtt.record(now - sent_at)
+                if trace is not None:
+                    trace.record(time.time_ns(), self.name, len(expected), frame_size, now - sent_at)
+            stats.add_received(frame_size)
+            position += frame_size
+        if position:
+            rest = self.filled - position
+            if rest:
+                self.view[:rest] = self.buffer[position:self.filled]
+            self.filled = rest
+            self.window_open.set()
+
+    def connection_lost(self, exc):
+        self.closed.set()
+        self.window_open.set()
+
+class LoadStats:
+    """負荷生成モードの統計 (イベントループの1スレッドからのみ更新する)"""
+    def __init__(self):
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.received_messages = 0
+        self.received_bytes = 0
+        self.errors = 0
+        # 前回 take_window() 以降の全接続の RTT
+        self.window_rtt = LatencyHistogram()
+
+    def take_window(self):
+        """前回呼び出してからの RTT のヒストグラムを返し、次の区間を始める"""
+        window, self.window_rtt = self.window_rtt, LatencyHistogram()
+        return window
+
+    def add_sent(self, size):
+        self.sent_messages += 1
+        self.sent_bytes += size
+
+    def add_received(self, size):
+        self.received_messages += 1
+        self.received_bytes += size
+
+    def snapshot(self):
+        return self.sent_messages, self.sent_bytes, self.received_messages, self.received_bytes
+
+class LoadGenerator:
+    """
+    1プロセスから複数の接続を開き、目標のメッセージレートでエコーサーバーに負荷をかける
+
+    Args:
+        host, port: サーバーのアドレス
+        connections: 接続数
+        rate: 全接続合計の目標メッセージ数/秒 (0 の場合は応答が返りしだい次を送る)
+        pipeline: 接続ごとの応答待ちメッセージ数の上限
+        payloads: generate_payload_pool() で生成したメッセージ
+        verify: エコーバックの内容まで照合するか (False の場合は長さだけ照合する)
+        trace: メッセージごとの記録を渡す TraceWriter (省略時は記録しない)
+    """
+    def __init__(self, host, port, connections, rate, pipeline, payloads, verify=False, trace=None):
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.rate = rate
+        self.pipeline = pipeline
+        self.payloads = payloads
+        self.verify = verify
+        self.trace = trace
+        self.stats = LoadStats()
+        self.running = True
+        self.connection_list = []
+
+    async def run(self, duration=0):
+        """負荷をかける (duration 秒で終了、0 の場合は停止されるまで)"""
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def connect():
+            async with semaphore:
+                _transport, protocol = await loop.create_connection(
+                    lambda: LoadConnection(self), self.host, self.port)
+                return protocol
+
+        print(f"[負荷生成] {self.connections} 接続を開いています: {self.host}:{self.port}")
+        connections = await asyncio.gather(*(connect() for _ in range(self.connections)))
+        self.connection_list = connections
+        print(f"[負荷生成] 接続完了 (目標レート: {self.rate or '無制限'} メッセージ/秒, パイプライン: {self.pipeline})\n")
+
+        senders = [asyncio.create_task(self._send_loop(connection, index))
+                   for index, connection in enumerate(connections)]
+        reporter = asyncio.create_task(self._report_loop())
+        try:
+            if duration:
+                await asyncio.sleep(duration)
+            else:
+                await asyncio.gather(*senders)
+        finally:
+            self.running = False
+            for task in senders + [reporter]:
+                task.cancel()
+            for connection in connections:
+                connection.transport.close()
+
+    async def _send_loop(self, connection, index):
+        loop = asyncio.get_running_loop()
+        payloads = self.payloads
+        position = index * 7919 % len(payloads)
+        # 接続ごとの送信間隔 (開始時刻を接続ごとにずらす)
+        interval = self.connections / self.rate if self.rate else 0
+        next_time = loop.time() + random.uniform(0, interval)
+        while self.running and not connection.closed.is_set():
+            if len(connection.outstanding) >= self.pipeline:
+                connection.window_open.clear()
+                await connection.window_open.wait()
+                continue
+            if interval:
+                delay = next_time - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # 遅れた分はまとめて送らず、パイプラインの上限まで追いつく
+                next_time = max(next_time + interval, loop.time() - interval * self.pipeline)
+            connection.send(payloads[position])
+            position = (position + 1) % len(payloads)
+
+    async def _report_loop(self):
+        previous = self.stats.snapshot()
+        previous_time = time.time()
+        while True:
+            await asyncio.sleep(LOAD_REPORT_INTERVAL)
+            window_rtt = self.stats.take_window()
+            current = self.stats.snapshot()
+            now = time.time()
+            elapsed = now - previous_time
+            sent_messages, sent_bytes, received_messages, received_bytes = \
+                (current[i] - previous[i] for i in range(4))
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 送信: {sent_messages/elapsed:,.0f} メッセージ/秒 "
+                  f"({sent_bytes/elapsed/1024:,.1f} KB/秒), 受信: {received_messages/elapsed:,.0f} メッセージ/秒 "
+                  f"({received_bytes/elapsed/1024:,.1f} KB/秒), 応答待ち: {current[0] - current[2]}, "
+                  f"RTT p50: {format_latency(window_rtt.percentile(50))} p99: {format_latency(window_rtt.percentile(99))} "
+                  f"max: {format_latency(window_rtt.max if window_rtt.count else None)}")
+            previous, previous_time = current, now
+
+    def print_stats(self):
+        stats = self.stats
+        print("\n[負荷生成] 統計情報:")
+        print(f"  接続数: {self.connections}")
+        print(f"  送信メッセージ数: {stats.sent_messages:,}")
+        print(f"  受信メッセージ数: {stats.received_messages:,}")
+        print(f"  総送信量: {stats.sent_bytes:,} バイト ({stats.sent_bytes/1024:.2f} KB)")
+        print(f"  総受信量: {stats.received_bytes:,} バイト ({stats.received_bytes/1024:.2f} KB)")
+        print(f"  照合エラー: {stats.errors:,}")
+        print(f"  RTT (全接続): {format_summary(self.get_total_rtt())}")
+        # RTT の p99 が大きい接続
+        slowest = sorted((connection for connection in self.connection_list if connection.rtt.count),
+                         key=lambda connection: connection.rtt.percentile(99), reverse=True)[:5]
+        if len(self.connection_list) > 1 and slowest:
+            print("  RTT の p99 が大きい接続:")
+            for connection in slowest:
+                print(f"    {connection.name}: {format_summary(connection.rtt)}")
+
+    def get_total_rtt(self):
+        """全接続の RTT を統合したヒストグラム"""
+        total = LatencyHistogram()
+        for connection in self.connection_list:
+            total.merge(connection.rtt)
+        return total
+
+    def to_dict(self):
+        """JSON に出力する結果 (接続ごとの RTT と、全接続を統合した 'rtt')"""
+        stats = self.stats
+        return {
+            'client': 'load',
+            'connections': self.connections,
+            'rate': self.rate,
+            'pipeline': self.pipeline,
+            'messages': stats.received_messages,
+            'sent_bytes': stats.sent_bytes,
+            'received_bytes': stats.received_bytes,
+            'errors': stats.errors,
+            'rtt': self.get_total_rtt().to_dict(),
+            'per_connection': [{'connection': connection.name, 'rtt': connection.rtt.summary()}
+                               for connection in self.connection_list],
+        }
+
+def run_load(args):
+    """負荷生成モードを実行"""
+    if args.sizes:
+        payloads = generate_payload_pool(lambda: random.choice(args.sizes))
+    else:
+        payloads = generate_payload_pool(lambda: random.randint(args.min_size, args.max_size))
+    trace = TraceWriter(args.trace, TRACE_COLUMNS) if args.trace else None
+    generator = LoadGenerator(args.host, args.port, args.connections, args.rate, args.pipeline, payloads,
+                              verify=args.verify, trace=trace)
+    try:
+        asyncio.run(generator.run(args.duration))
+    except KeyboardInterrupt:
+        print("\n[負荷生成] 停止中...")
+    except ConnectionRefusedError:
+        print("[負荷生成] エラー: サーバーに接続できません。サーバーが起動しているか確認してください。")
+        return
+    except OSError as e:
+        print(f"[負荷生成] エラー: {e}")
+    finally:
+        if trace is not None:
+            trace.close()
+    generator.print_stats()
+    if trace is not None:
+        print(f"\n[負荷生成] メッセージごとの記録を出力しました: {args.trace}")
+    if args.json_output:
+        write_json(args.json_output, generator.to_dict())
+        print(f"\n[負荷生成] 結果を出力しました: {args.json_output}")
+
+def run_client(client_id, json_output=None, trace_path=None, verbose=False, report_interval=CLIENT_REPORT_INTERVAL):
+    """
+    クライアントを実行
+
+    メッセージごとの表示は verbose の場合だけ行い、それ以外は report_interval 秒ごとにまとめて表示する。
+    json_output を指定した場合は終了時に結果を JSON で、trace_path を指定した場合はメッセージごとの記録を CSV で出力する。
+    """
     stats = ClientStats()
+    trace = TraceWriter(trace_path, TRACE_COLUMNS) if trace_path else None
+    reporter = None if verbose else IntervalReporter(report_interval, stats.make_report(client_id))
 
     print(f"[クライアント{client_id}] サーバーに接続中: {HOST}:{PORT}")
 
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             sock.connect((HOST, PORT))
+            name = '%s:%s' % sock.getsockname()[:2]
             print(f"[クライアント{client_id}] 接続成功\n")
+            if reporter is not None:
+                reporter.start()
 
             while True:
                 # ランダムなASCII文字列を生成
                 message = generate_random_ascii(100, 1000)
 
                 # サーバーに送信
+                sent_at = time.perf_counter_ns()
                 sent_size = send_message(sock, message)
 
-                timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-                print(f"[{timestamp}] クライアント{client_id} - 送信: {sent_size}バイト (データ: {len(message)}バイト)")
+                if verbose:
+                    timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
+                    print(f"[{timestamp}] クライアント{client_id} - 送信: {sent_size}バイト (データ: {len(message)}バイト)")
 
                 # サーバーからのエコーバックを受信
                 received_message, received_size = receive_message(sock)
+                rtt = time.perf_counter_ns() - sent_at
 
                 if received_message is None:
                     print(f"[クライアント{client_id}] サーバーから切断されました")
                     break
 
-                print(f"[{timestamp}] クライアント{client_id} - 受信: {received_size}バイト")
+                if verbose:
+                    print(f"[{timestamp}] クライアント{client_id} - 受信: {received_size}バイト (RTT: {format_latency(rtt)})")
 
-                # 送信データと受信データが一致するか確認
-                if message == received_message:
+                # 送信データと受信データが一致するか確認 (失敗は verbose でなくても表示する)
+                if message != received_message:
+                    stats.add_error()
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] クライアント{client_id} - ✗ データ検証失敗!")
+                elif verbose:
                     print(f"[{timestamp}] クライアント{client_id} - ✓ データ検証成功")
-                else:
-                    print(f"[{timestamp}] クライアント{client_id} - ✗ データ検証失敗!")
 
                 # 統計情報を更新
-                stats.add_stats(sent_size, received_size)
+                stats.add_stats(sent_size, received_size, rtt)
+                if trace is not None:
+                    trace.record(time.time_ns(), name, sent_size, received_size, rtt)
 
                 # 3～5秒のランダムな間隔で待機
                 sleep_time = random.uniform(3.0, 5.0)
-                print(f"[{timestamp}] クライアント{client_id} - 次の送信まで {sleep_time:.1f}秒待機\n")
+                if verbose:
+                    print(f"[{timestamp}] クライアント{client_id} - 次の送信まで {sleep_time:.1f}秒待機\n")
                 time.sleep(sleep_time)
 
     except KeyboardInterrupt:
@@ -112,12 +495,58 @@ def run_client(client_id):
         stats.print_stats(client_id)
     except ConnectionRefusedError:
         print(f"[クライアント{client_id}] エラー: サーバーに接続できません。サーバーが起動しているか確認してください。")
+        return
     except Exception as e:
         print(f"[クライアント{client_id}] エラー: {e}")
         stats.print_stats(client_id)
+    finally:
+        if reporter is not None and reporter.is_running():
+            reporter.stop()
+        if trace is not None:
+            trace.close()
+
+    if trace is not None:
+        print(f"\n[クライアント{client_id}] メッセージごとの記録を出力しました: {trace_path}")
+    if json_output:
+        write_json(json_output, stats.to_dict(client_id))
+        print(f"\n[クライアント{client_id}] 結果を出力しました: {json_output}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TCPエコークライアント")
     # コマンドライン引数からクライアントIDを取得（デフォルトは1）
-    client_id = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    parser.add_argument('client_id', nargs='?', type=int, default=1, help="クライアントID (既定: 1)")
+    parser.add_argument('--host', default=HOST, help=f"サーバーのアドレス (既定: {HOST})")
+    parser.add_argument('--port', type=int, default=PORT, help=f"サーバーのポート (既定: {PORT})")
+    parser.add_argument('--load', action='store_true', help="負荷生成モード (複数の接続から連続して送信)")
+    parser.add_argument('-c', '--connections', type=int, default=10, help="負荷生成モードの接続数 (既定: 10)")
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help="負荷生成モードの全接続合計の目標メッセージ数/秒 (既定: 0 = 無制限)")
+    parser.add_argument('-p', '--pipeline', type=int, default=1,
+                        help="負荷生成モードの接続ごとの応答待ちメッセージ数の上限 (既定: 1)")
+    parser.add_argument('--min-size', type=int, default=100, help="メッセージ本体の最小サイズ (既定: 100)")
+    parser.add_argument('--max-size', type=int, default=1000, help="メッセージ本体の最大サイズ (既定: 1000)")
+    parser.add_argument('--sizes', help="メッセージ本体のサイズの候補 (例: 64,512,1460。指定時は等確率で選ぶ)")
+    parser.add_argument('-d', '--duration', type=float, default=0, help="負荷生成モードの実行秒数 (既定: 0 = Ctrl+C まで)")
+    parser.add_argument('--verify', action='store_true', help="負荷生成モードでエコーバックの内容まで照合する")
+    parser.add_argument('--json-output', help="終了時に結果 (RTT のヒストグラムを含む) を出力する JSON ファイル")
+    parser.add_argument('--trace', help="メッセージごとの記録 (時刻・接続・送信量・受信量・RTT) を出力する CSV ファイル")
+    parser.add_argument('-v', '--verbose', action='store_true', help="メッセージごとに表示する (負荷生成モード以外)")
+    parser.add_argument('--report-interval', type=float, default=CLIENT_REPORT_INTERVAL,
+                        help=f"メッセージごとに表示しない場合にまとめて表示する間隔 (秒, 既定: {CLIENT_REPORT_INTERVAL:g})")
+    args = parser.parse_args()
 
-    run_client(client_id)
+    if args.load:
+        try:
+            if args.sizes:
+                args.sizes = [int(size) for size in args.sizes.split(',')]
+        except ValueError:
+            print(f"エラー: --sizes が不正です: {args.sizes}")
+            sys.exit(1)
+        if args.connections <= 0 or args.pipeline <= 0 or args.rate < 0 or not 0 <= args.min_size <= args.max_size \
+                or any(size < 0 for size in args.sizes or ()):
+            print("エラー: 負荷生成モードの引数が不正です")
+            sys.exit(1)
+        run_load(args)
+    else:
+        HOST, PORT = args.host, args.port
+        run_client(args.client_id, args.json_output, args.trace, args.verbose, args.report_interval)
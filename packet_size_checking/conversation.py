@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+双方向の会話 (TCP コネクションなど) ごとに、ヘッダーとペイロードのバイト数を集計するモジュール
+
+フレーム長を L2 / L3 / L4 ヘッダーとペイロードに分けて集計し、
+TCP はシーケンス番号から再送・重複セグメントを検出して、
+グッドプット (再送を除いたペイロード) とワイヤ上のスループットを比べられるようにする。
+
+再送の判定 (方向ごと):
+    それまでに見たシーケンス番号の最大値より前のデータを含むセグメントを再送とし、
+    重なったバイト数を再送バイト数とする。
+    直前のセグメントとシーケンス番号・長さが同じもの (同じパケットを2回キャプチャした場合など) は重複とする。
+    ACK のない方向の情報は使わないので、順番が入れ替わって届いたセグメント (アウトオブオーダー) も
+    再送として数える。
+
+キープアライブ:
+    ACK フラグだけのセグメントで、ペイロードが0か1バイト、シーケンス番号が最大値 - 1 のものはキープアライブとし、
+    再送・重複の判定から除き (直前のセグメントとしても扱わない)、ペイロードはグッドプットに含めない。
+    キャプチャの途中から始まった方向の最初のセグメントは、そのまま次のセグメントがキープアライブの場合
+    (同じバイトを送り直している場合) に、1バイトのキープアライブだったとみなす。
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+TCP_FLAG_FIN = 0x01
+TCP_FLAG_SYN = 0x02
+TCP_FLAG_ACK = 0x10
+# キープアライブの判定で見るフラグ (FIN, SYN, RST, PSH, ACK, URG)
+TCP_CONTROL_FLAGS = 0x3F
+
+_SEQ_MODULO = 1 << 32
+_SEQ_HALF = 1 << 31
+# 方向ごとの累積最大値を1回の maximum.accumulate で求めるときの方向の間隔
+_GROUP_SPACING = 1 << 45
+
+
+class DirectionStats:
+    """会話の片方向の統計情報と TCP の状態"""
+
+    def __init__(self):
+        self.packets = 0
+        self.wire_bytes = 0
+        self.l2_bytes = 0
+        self.l3_bytes = 0
+        self.l4_bytes = 0
+        self.payload_bytes = 0
+        self.retransmitted_segments = 0
+        self.duplicate_segments = 0
+        # 再送・重複セグメントのうち、すでに送られていたペイロードのバイト数
+        self.retransmitted_bytes = 0
+        # キープアライブのセグメント数とそのペイロードのバイト数
+        self.keepalive_segments = 0
+        self.keepalive_bytes = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        # TCP の状態 (シーケンス番号は折り返しを展開した値)
+        self.last_seq = None
+        self.last_payload = 0
+        self.highest_end = None
+        # 最初のセグメントが1バイトのキープアライブの形だった場合、次のセグメントを見るまで True
+        self.keepalive_candidate = False
+
+    def add_timestamps(self, first_timestamp, last_timestamp):
+        if first_timestamp is None:
+            return
+        if self.first_timestamp is None or first_timestamp < self.first_timestamp:
+            self.first_timestamp = first_timestamp
+        if self.last_timestamp is None or last_timestamp > self.last_timestamp:
+            self.last_timestamp = last_timestamp
+
+    def add_segment(self, seq, payload, flags):
+        """TCP セグメント1つ分のシーケンス番号を処理する"""
+        seq_length = payload + (1 if flags & TCP_FLAG_SYN else 0) + (1 if flags & TCP_FLAG_FIN else 0)
+        keepalive_shape = flags & TCP_CONTROL_FLAGS == TCP_FLAG_ACK and payload <= 1
+        if self.last_seq is None:
+            self.last_seq = seq
+            self.last_payload = payload
+            self.highest_end = seq + seq_length
+            self.keepalive_candidate = keepalive_shape and payload == 1
+            return
+        # 直前のセグメントからの差 (-2^31 〜 2^31) で折り返しを展開する
+        seq = self.last_seq + ((seq - self.last_seq + _SEQ_HALF) % _SEQ_MODULO) - _SEQ_HALF
+        keepalive = keepalive_shape and seq == self.highest_end - 1
+        if self.keepalive_candidate:
+            self.keepalive_candidate = False
+            if keepalive:
+                self.keepalive_segments += 1
+                self.keepalive_bytes += 1
+        if keepalive:
+            # 最大値は変わらない (seq + payload <= highest_end)
+            self.keepalive_segments += 1
+            self.keepalive_bytes += payload
+            return
+        if payload > 0:
+            data_start = seq + (1 if flags & TCP_FLAG_SYN else 0)
+            overlap = min(data_start + payload, self.highest_end) - data_start
+            if overlap > 0:
+                if seq == self.last_seq and payload == self.last_payload:
+                    self.duplicate_segments += 1
+                else:
+                    self.retransmitted_segments += 1
+                self.retransmitted_bytes += overlap
+        self.highest_end = max(self.highest_end, seq + seq_length)
+        self.last_seq = seq
+        self.last_payload = payload
+
+    def get_goodput_bytes(self):
+        """再送・重複・キープアライブを除いたペイロードのバイト数"""
+        return self.payload_bytes - self.retransmitted_bytes - self.keepalive_bytes
+
+    def get_header_bytes(self):
+        return self.l2_bytes + self.l3_bytes + self.l4_bytes
+
+
+class Conversation:
+    """
+    双方向の会話
+
+    key は (A のIP, A のポート, B のIP, B のポート, プロトコル) で、A は最初のパケットの送信元
+    (最初のパケットが SYN+ACK の場合は宛先)。directions[0] が A → B、directions[1] が B → A。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.directions = [DirectionStats(), DirectionStats()]
+
+    def get_total(self, name):
+        """両方向の合計 (name は DirectionStats の属性名)"""
+        return sum(getattr(direction, name) for direction in self.directions)
+
+    def get_goodput_bytes(self):
+        return sum(direction.get_goodput_bytes() for direction in self.directions)
+
+    def get_header_bytes(self):
+        return sum(direction.get_header_bytes() for direction in self.directions)
+
+    def get_duration(self):
+        """最初のパケットから最後のパケットまでの秒数 (タイムスタンプがない場合は None)"""
+        first_timestamps = [d.first_timestamp for d in self.directions if d.first_timestamp is not None]
+        if not first_timestamps:
+            return None
+        last_timestamps = [d.last_timestamp for d in self.directions if d.last_timestamp is not None]
+        return max(last_timestamps) - min(first_timestamps)
+
+
+class ConversationTable:
+    """
+    会話ごとの統計情報
+
+    会話は最初のパケットが現れた順に並ぶ。
+    """
+
+    def __init__(self):
+        self.conversations = {}
+        # 方向のキー (送信元IP, 送信元ポート, 宛先IP, 宛先ポート, プロトコル) -> DirectionStats
+        self.directions = {}
+
+    def get_direction(self, key, flags=0):
+        """
+        方向のキーの DirectionStats を返す (初めての会話の場合は作る)
+
+        Args:
+            key: (送信元IP, 送信元ポート, 宛先IP, 宛先ポート, プロトコル)
+            flags: 最初のパケットの TCP フラグ (SYN+ACK の場合は宛先を会話の開始側とする)
+        """
+        direction = self.directions.get(key)
+        if direction is not None:
+            return direction
+        src_ip, src_port, dst_ip, dst_port, protocol = key
+        reverse_key = (dst_ip, dst_port, src_ip, src_port, protocol)
+        if flags & (TCP_FLAG_SYN | TCP_FLAG_ACK) == TCP_FLAG_SYN | TCP_FLAG_ACK:
+            conversation = Conversation(reverse_key)
+            self.directions[reverse_key], self.directions[key] = conversation.directions
+        else:
+            conversation = Conversation(key)
+            self.directions[key], self.directions[reverse_key] = conversation.directions
+        self.conversations[conversation.key] = conversation
+        return self.directions[key]
+
+    def add_packet(self, timestamp, length, segment):
+        """
+        1パケット分を加算する
+
+        Args:
+            timestamp: タイムスタンプ (不明な場合は None)
+            length: フレーム長
+            segment: pcap_reader.decode_segment() の戻り値
+        """
+        l2_bytes, l3_bytes, l4_bytes, payload, seq, flags = segment[5:]
+        direction = self.get_direction(segment[:5], flags)
+        direction.packets += 1
+        direction.wire_bytes += length
+        direction.l2_bytes += l2_bytes
+        direction.l3_bytes += l3_bytes
+        direction.l4_bytes += l4_bytes
+        direction.payload_bytes += payload
+        direction.add_timestamps(timestamp, timestamp)
+        if seq is not None:
+            direction.add_segment(seq, payload, flags)
+
+    def add_batch(self, keys, key_indexes, columns):
+        """
+        NumPy の配列にまとめたパケットを加算する (add_packet() を順に呼んだのと同じ結果になる)
+
+        Args:
+            keys: 方向のキーのリスト
+            key_indexes: パケットごとの keys での位置 (パケットの順)
+            columns: パケットごとの値の配列の辞書
+                'timestamp' (不明な場合は NaN), 'length', 'l2', 'l3', 'l4', 'payload',
+                'seq' (TCP 以外は -1), 'flags'
+        """
+        if len(key_indexes) == 0:
+            return
+        # 初めての方向は、add_packet() と同じく最初に現れた順に会話を作る
+        used_indexes, first_positions = np.unique(key_indexes, return_index=True)
+        directions = [None] * len(keys)
+        flags = columns['flags']
+        for position, index in sorted(zip(first_positions.tolist(), used_indexes.tolist())):
+            directions[index] = self.get_direction(keys[index], int(flags[position]))
+
+        count = len(keys)
+        packets = np.bincount(key_indexes, minlength=count).tolist()
+        sums = {name: _sum_by(key_indexes, columns[name], count)
+                for name in ('length', 'l2', 'l3', 'l4', 'payload')}
+        first_timestamps = np.full(count, np.nan)
+        last_timestamps = np.full(count, np.nan)
+        np.fmin.at(first_timestamps, key_indexes, columns['timestamp'])
+        np.fmax.at(last_timestamps, key_indexes, columns['timestamp'])
+        first_timestamps = first_timestamps.tolist()
+        last_timestamps = last_timestamps.tolist()
+
+        for index in used_indexes.tolist():
+            direction = directions[index]
+            direction.packets += packets[index]
+            direction.wire_bytes += sums['length'][index]
+            direction.l2_bytes += sums['l2'][index]
+            direction.l3_bytes += sums['l3'][index]
+            direction.l4_bytes += sums['l4'][index]
+            direction.payload_bytes += sums['payload'][index]
+            if first_timestamps[index] == first_timestamps[index]:  # NaN でない
+                direction.add_timestamps(first_timestamps[index], last_timestamps[index])
+
+        tcp = columns['seq'] >= 0
+        if tcp.any():
+            _add_segments(directions, key_indexes[tcp], columns['seq'][tcp],
+                          columns['payload'][tcp], flags[tcp])
+
+    def get_sorted(self):
+        """会話をワイヤ上のバイト数の降順で返す"""
+        return sorted(self.conversations.values(), key=lambda c: c.get_total('wire_bytes'), reverse=True)
+
+
+def _sum_by(key_indexes, values, count):
+    """key_indexes ごとの values の合計 (整数のリスト)"""
+    sums = np.zeros(count, dtype=np.int64)
+    np.add.at(sums, key_indexes, values)
+    return sums.tolist()
+
+
+def _add_segments(directions, key_indexes, seqs, payloads, flags):
+    """
+    TCP セグメントのシーケンス番号を方向ごとにベクトル演算で処理する
+    (DirectionStats.add_segment() をパケットの順に呼んだのと同じ結果になる)
+    """
+    # 方向ごとにまとめる (安定ソートなので方向の中はパケットの順)
+    order = np.argsort(key_indexes, kind='stable')
+    groups = key_indexes[order]
+    raw_seqs = seqs[order].astype(np.int64)
+    payloads = payloads[order].astype(np.int64)
+    flags = flags[order].astype(np.int64)
+    firsts = np.ones(len(order), dtype=bool)
+    firsts[1:] = groups[1:] != groups[:-1]
+    first_positions = np.flatnonzero(firsts)
+    ranks = np.cumsum(firsts) - 1
+    group_directions = [directions[index] for index in groups[first_positions].tolist()]
+
+    # 直前のセグメントからの差 (-2^31 〜 2^31) を累積して折り返しを展開する (方向の先頭からの相対値)
+    steps = np.empty(len(order), dtype=np.int64)
+    steps[0] = 0
+    steps[1:] = ((raw_seqs[1:] - raw_seqs[:-1] + _SEQ_HALF) % _SEQ_MODULO) - _SEQ_HALF
+    steps[firsts] = 0
+    relative_seqs = np.cumsum(steps)
+    relative_seqs -= relative_seqs[first_positions][ranks]
+
+    # 方向の先頭のセグメントの展開したシーケンス番号と、それまでの状態
+    group_count = len(first_positions)
+    bases = np.empty(group_count, dtype=np.int64)
+    initial_highest = np.empty(group_count, dtype=np.int64)
+    previous_seqs = np.empty(group_count, dtype=np.int64)
+    previous_payloads = np.full(group_count, -1, dtype=np.int64)
+    # 方向の先頭のセグメントが方向の最初のセグメントか、前回までの最初のセグメントがキープアライブの候補か
+    fresh = np.zeros(group_count, dtype=bool)
+    candidates = np.zeros(group_count, dtype=bool)
+    for rank, (direction, raw_seq) in enumerate(zip(group_directions, raw_seqs[first_positions].tolist())):
+        if direction.last_seq is None:
+            bases[rank] = raw_seq
+            initial_highest[rank] = raw_seq
+            previous_seqs[rank] = raw_seq
+            fresh[rank] = True
+        else:
+            candidates[rank] = direction.keepalive_candidate
+            bases[rank] = direction.last_seq + ((raw_seq - direction.last_seq + _SEQ_HALF) % _SEQ_MODULO) - _SEQ_HALF
+            initial_highest[rank] = direction.highest_end
+            previous_seqs[rank] = direction.last_seq
+            previous_payloads[rank] = direction.last_payload
+
+    syn = (flags & TCP_FLAG_SYN) != 0
+    fin = (flags & TCP_FLAG_FIN) != 0
+    seqs = bases[ranks] + relative_seqs
+    ends = seqs + payloads + syn + fin
+
+    # 各セグメントより前のシーケンス番号の最大値 (方向ごとの累積最大値)。
+    # 方向ごとに十分離れた値を足して、1回の累積最大値で方向をまたがないようにする
+    spacing = ranks * _GROUP_SPACING
+    shifted = ends - bases[ranks] + spacing
+    cumulative = np.maximum.accumulate(shifted)
+    highest_before = np.empty(len(order), dtype=np.int64)
+    highest_before[1:] = cumulative[:-1] - spacing[1:] + bases[ranks[1:]]
+    highest_before[first_positions] = initial_highest
+    highest_before = np.maximum(highest_before, initial_highest[ranks])
+
+    # キープアライブ (方向の最初のセグメントは除く)。キープアライブの終わりは最大値を超えないので、
+    # 最大値の計算から除かなくてよい
+    keepalive_shapes = ((flags & TCP_CONTROL_FLAGS) == TCP_FLAG_ACK) & (payloads <= 1)
+    keepalives = keepalive_shapes & (seqs == highest_before - 1)
+    keepalives[first_positions[fresh]] = False
+    # 方向の最初のセグメントがキープアライブの候補で、次のセグメントがキープアライブなら候補も数える
+    fresh_firsts = first_positions[fresh]
+    candidate_positions = fresh_firsts[keepalive_shapes[fresh_firsts] & (payloads[fresh_firsts] == 1)]
+    has_next = np.zeros(len(candidate_positions), dtype=bool)
+    inside = candidate_positions + 1 < len(order)
+    has_next[inside] = ranks[candidate_positions[inside] + 1] == ranks[candidate_positions[inside]]
+    confirmed_ranks = ranks[candidate_positions[has_next]][keepalives[candidate_positions[has_next] + 1]]
+    pending_ranks = ranks[candidate_positions[~has_next]]
+    # 前回までの候補は、この方向の先頭のセグメントで決まる
+    confirmed_ranks = np.concatenate([confirmed_ranks, np.flatnonzero(candidates & keepalives[first_positions])])
+
+    data_starts = seqs + syn
+    overlaps = np.minimum(data_starts + payloads, highest_before) - data_starts
+    redundant = (payloads > 0) & (overlaps > 0) & ~keepalives
+    # 直前のセグメント (キープアライブを除く。方向の先頭では前回までの最後のセグメント)
+    positions = np.arange(len(order))
+    latest = np.maximum.accumulate(np.where(keepalives, -1, positions))
+    previous = np.empty(len(order), dtype=np.int64)
+    previous[0] = -1
+    previous[1:] = latest[:-1]
+    from_state = previous < first_positions[ranks]
+    last_seqs = np.where(from_state, previous_seqs[ranks], seqs[previous])
+    last_payloads = np.where(from_state, previous_payloads[ranks], payloads[previous])
+    duplicates = redundant & (seqs == last_seqs) & (payloads == last_payloads)
+    retransmissions = redundant & ~duplicates
+
+    duplicate_counts = np.bincount(ranks, weights=duplicates, minlength=group_count).astype(np.int64).tolist()
+    retransmission_counts = np.bincount(ranks, weights=retransmissions, minlength=group_count).astype(np.int64).tolist()
+    redundant_bytes = np.zeros(group_count, dtype=np.int64)
+    np.add.at(redundant_bytes, ranks, np.where(redundant, overlaps, 0))
+    keepalive_counts = np.bincount(ranks, weights=keepalives, minlength=group_count).astype(np.int64)
+    keepalive_bytes = np.zeros(group_count, dtype=np.int64)
+    np.add.at(keepalive_bytes, ranks, np.where(keepalives, payloads, 0))
+    np.add.at(keepalive_counts, confirmed_ranks, 1)
+    np.add.at(keepalive_bytes, confirmed_ranks, 1)
+    keepalive_counts = keepalive_counts.tolist()
+    keepalive_bytes = keepalive_bytes.tolist()
+    pending = np.zeros(group_count, dtype=bool)
+    pending[pending_ranks] = True
+    pending = pending.tolist()
+    highest_ends = np.maximum(np.maximum.reduceat(ends, first_positions), initial_highest).tolist()
+    # 方向の最後のキープアライブでないセグメント (すべてキープアライブなら前回までの状態のまま)
+    last_positions = latest[np.append(first_positions[1:], len(order)) - 1]
+    has_last = (last_positions >= first_positions).tolist()
+
+    for rank, (direction, last_seq, last_payload) in enumerate(
+            zip(group_directions, seqs[last_positions].tolist(), payloads[last_positions].tolist())):
+        direction.duplicate_segments += duplicate_counts[rank]
+        direction.retransmitted_segments += retransmission_counts[rank]
+        direction.retransmitted_bytes += int(redundant_bytes[rank])
+        direction.keepalive_segments += keepalive_counts[rank]
+        direction.keepalive_bytes += keepalive_bytes[rank]
+        direction.keepalive_candidate = pending[rank]
+        direction.highest_end = highest_ends[rank]
+        if has_last[rank]:
+            direction.last_seq = last_seq
+            direction.last_payload = last_payload
@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+"""
+キャプチャファイルのパケットを接続 (5タプル) ごとに集計するモジュール
+
+NumPy がインストールされている場合は、キャプチャファイルを mmap して
+パケットの位置・長さ・タイムスタンプをチャンク単位で構造化配列に取り出し、
+IPv4 のヘッダーのデコードと5タプルごとの集計をベクトル演算で行う。
+NumPy がない場合や IPv6 などのパケットは pcap_reader.decode_flow で1パケットずつ処理する。
+
+タイムスタンプはパケットごとには保持せず、接続ごとの最小値・最大値だけを持つため、
+メモリ使用量はパケット数ではなく接続数に比例する。
+
+大きなキャプチャはブロック境界でチャンクに分け、プロセスプールで並列に集計できる。
+
+NumPy (任意):
+    pip install numpy
+"""
+
+import math
+import mmap
+import multiprocessing
+import os
+import socket
+from itertools import islice
+
+from pcap_reader import ETHERTYPE_IPV4
+from pcap_reader import ETHERTYPE_IPV6
+from pcap_reader import ETHERTYPE_VLAN
+from pcap_reader import IP_PROTO_TCP
+from pcap_reader import IP_PROTO_UDP
+from pcap_reader import LINKTYPE_ETHERNET
+from pcap_reader import LINKTYPE_IPV4
+from pcap_reader import LINKTYPE_IPV6
+from pcap_reader import LINKTYPE_LINUX_SLL
+from pcap_reader import LINKTYPE_LINUX_SLL2
+from pcap_reader import LINKTYPE_LOOP
+from pcap_reader import LINKTYPE_NULL
+from pcap_reader import LINKTYPE_RAW
+from pcap_reader import NULL_FAMILY_IPV4
+from pcap_reader import decode_flow
+from pcap_reader import decode_segment
+from pcap_reader import format_address
+from pcap_reader import scan_packets
+from pcap_reader import split_capture
+from conversation import ConversationTable
+from timeline import Timeline
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# NumPy でまとめて処理するパケット数
+CHUNK_PACKETS = 65536
+
+# 並列処理で1つのワーカーに渡すチャンクの最小バイト数
+MIN_PARALLEL_CHUNK_BYTES = 16 * 1024 * 1024
+# 並列処理でワーカー1つあたりに作るチャンク数 (処理時間の偏りをならすため)
+CHUNKS_PER_WORKER = 4
+
+# ベクトル演算でリンク層を判定できなかった (IPv6 などの) パケットを表す EtherType
+_ETHERTYPE_UNDECIDED = -2
+
+if np is not None:
+    # scan_packets() が返す1パケット分のフィールド
+    PACKET_DTYPE = np.dtype([
+        ('timestamp', 'f8'),
+        ('length', 'u8'),
+        ('linktype', 'u2'),
+        ('offset', 'i8'),
+        ('captured', 'i8'),
+    ])
+
+
+def is_numpy_available():
+    """NumPy による集計が使えるか"""
+    return np is not None
+
+
+class FlowTable:
+    """
+    接続ごとの統計情報
+
+    キー: (送信元IP, 送信元ポート, 宛先IP, 宛先ポート, プロトコル)
+    値: [パケット数, 総バイト数, 最初のタイムスタンプ, 最後のタイムスタンプ]
+    (タイムスタンプのないパケットだけの接続ではタイムスタンプは None)
+    接続は最初のパケットが現れた順に並ぶ。
+    bucket_seconds を指定した場合は、バケットごとの値も timeline (Timeline) に集計する。
+    conversations を指定した場合は、双方向の会話ごとの値も conversations (ConversationTable) に集計する。
+    会話は TCP のシーケンス番号をパケットの順にたどるため、merge() では統合しない。
+    """
+
+    def __init__(self, bucket_seconds=None, conversations=False):
+        self.flows = {}
+        self.total_packets = 0
+        self.timeline = Timeline(bucket_seconds) if bucket_seconds else None
+        self.conversations = ConversationTable() if conversations else None
+
+    def add_packet(self, key, length, timestamp):
+        """1パケット分を加算する"""
+        self.add_flow(key, 1, length, timestamp, timestamp)
+        if self.timeline is not None and timestamp is not None:
+            self.timeline.add_packet(key, length, timestamp)
+
+    def add_flow(self, key, packets, bytes_count, first_timestamp, last_timestamp):
+        """集計済みの接続の統計を加算する"""
+        entry = self.flows.get(key)
+        if entry is None:
+            self.flows[key] = [packets, bytes_count, first_timestamp, last_timestamp]
+            return
+        entry[0] += packets
+        entry[1] += bytes_count
+        if first_timestamp is not None:
+            if entry[2] is None or first_timestamp < entry[2]:
+                entry[2] = first_timestamp
+            if entry[3] is None or last_timestamp > entry[3]:
+                entry[3] = last_timestamp
+
+    def merge(self, other):
+        """別の FlowTable の統計を加算する (other の接続は other での順番で追加される)"""
+        for key, (packets, bytes_count, first_timestamp, last_timestamp) in other.flows.items():
+            self.add_flow(key, packets, bytes_count, first_timestamp, last_timestamp)
+        self.total_packets += other.total_packets
+        if self.timeline is not None and other.timeline is not None:
+            self.timeline.merge(other.timeline)
+
+    def get_stats(self):
+        """
+        接続ごとの統計を辞書で返す
+
+        Returns:
+            {キー: {'packets': パケット数, 'bytes': 総バイト数,
+                    'first_timestamp': 最初のタイムスタンプ, 'last_timestamp': 最後のタイムスタンプ}}
+        """
+        return {key: {'packets': packets, 'bytes': bytes_count,
+                      'first_timestamp': first_timestamp, 'last_timestamp': last_timestamp}
+                for key, (packets, bytes_count, first_timestamp, last_timestamp) in self.flows.items()}
+
+
+def aggregate_capture(capture_file, use_numpy=True, workers=1, progress=None, bucket_seconds=None,
+                      conversations=False):
+    """
+    キャプチャファイルのパケットを接続ごとに集計する
+
+    workers が2以上の場合は、キャプチャをブロック境界でチャンクに分けてプロセスプールで集計し、
+    チャンクごとの FlowTable をチャンクの順に統合する (結果は逐次処理と同じになる)。
+
+    Args:
+        capture_file: .pcapng / .pcap ファイルのパス
+        use_numpy: False の場合は NumPy があっても1パケットずつ処理する
+        workers: 並列に集計するプロセス数
+        progress: 進捗を受け取る関数 progress(処理済みバイト数, ファイルのバイト数)
+        bucket_seconds: 指定した場合はこの秒数ごとのバケットの値も集計する (FlowTable.timeline)
+        conversations: True の場合は双方向の会話ごとの値も集計する (FlowTable.conversations)。
+            会話はパケットの順に処理する必要があるので、workers によらず逐次処理になる
+
+    Returns:
+        FlowTable
+    """
+    use_numpy = use_numpy and np is not None
+    with open(capture_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return FlowTable(bucket_seconds, conversations)
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if workers > 1 and not conversations:
+            chunk_size = max(MIN_PARALLEL_CHUNK_BYTES, -(-len(buffer) // (workers * CHUNKS_PER_WORKER)))
+            chunks = split_capture(buffer, chunk_size)
+            if len(chunks) > 1:
+                return _aggregate_parallel(capture_file, chunks, use_numpy, workers, progress, bucket_seconds)
+        return aggregate_range(buffer, None, use_numpy, progress, bucket_seconds, conversations)
+    finally:
+        buffer.close()
+
+
+def aggregate_range(buffer, chunk, use_numpy=True, progress=None, bucket_seconds=None, conversations=False):
+    """
+    メモリ上のキャプチャのパケットを接続ごとに集計する
+
+    Args:
+        buffer: キャプチャファイル全体の mmap / bytes
+        chunk: split_capture() が返したチャンク。None の場合はキャプチャ全体
+        use_numpy: NumPy で集計するか (NumPy がない場合は無視される)
+        progress: 進捗を受け取る関数 progress(処理済みバイト数, 範囲のバイト数)
+        bucket_seconds: 指定した場合はこの秒数ごとのバケットの値も集計する
+        conversations: True の場合は双方向の会話ごとの値も集計する
+
+    Returns:
+        FlowTable
+    """
+    start, end = (0, len(buffer)) if chunk is None else chunk[:2]
+    if use_numpy and np is not None:
+        table = _aggregate_buffer(buffer, chunk, start, end, progress, bucket_seconds, conversations)
+    else:
+        table = FlowTable(bucket_seconds, conversations)
+        view = memoryview(buffer)
+        for timestamp, length, linktype, offset, captured in scan_packets(buffer, chunk=chunk):
+            table.total_packets += 1
+            if table.conversations is None:
+                key = decode_flow(linktype, view[offset:offset + captured])
+            else:
+                segment = decode_segment(linktype, view[offset:offset + captured], length)
+                key = None if segment is None else segment[:5]
+                if segment is not None:
+                    table.conversations.add_packet(timestamp, length, segment)
+            if key is not None:
+                table.add_packet(key, length, timestamp)
+            if progress is not None and table.total_packets % CHUNK_PACKETS == 0:
+                progress(offset + captured - start, end - start)
+        view.release()
+    if progress is not None:
+        progress(end - start, end - start)
+    return table
+
+
+def _aggregate_parallel(capture_file, chunks, use_numpy, workers, progress, bucket_seconds):
+    """チャンクをプロセスプールで集計し、チャンクの順に統合する"""
+    tasks = [(capture_file, index, chunk, use_numpy, bucket_seconds) for index, chunk in enumerate(chunks)]
+    tables = [None] * len(chunks)
+    total = chunks[-1][1]
+    done = chunks[0][0]
+    with multiprocessing.Pool(processes=min(workers, len(chunks))) as pool:
+        # 終わったチャンクから受け取り、進捗は処理済みのチャンクのバイト数で通知する
+        for index, table in pool.imap_unordered(_aggregate_file_chunk, tasks):
+            tables[index] = table
+            start, end = chunks[index][:2]
+            done += end - start
+            if progress is not None:
+                progress(done, total)
+
+    # 接続の並びが逐次処理と同じになるよう、チャンクの順に統合する
+    result = FlowTable(bucket_seconds)
+    for table in tables:
+        result.merge(table)
+    return result
+
+
+def _aggregate_file_chunk(task):
+    """プロセスプールのワーカーで1チャンクを集計する"""
+    capture_file, index, chunk, use_numpy, bucket_seconds = task
+    with open(capture_file, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return index, aggregate_range(buffer, chunk, use_numpy, bucket_seconds=bucket_seconds)
+    finally:
+        buffer.close()
+
+
+def _aggregate_buffer(buffer, chunk, start, end, progress, bucket_seconds, conversations):
+    """メモリ上のキャプチャを CHUNK_PACKETS パケットずつ NumPy で集計する"""
+    table = FlowTable(bucket_seconds, conversations)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    scanner = scan_packets(buffer, no_timestamp=math.nan, chunk=chunk)
+    try:
+        while True:
+            records = list(islice(scanner, CHUNK_PACKETS))
+            if not records:
+                break
+            packets = np.array(records, dtype=PACKET_DTYPE)
+            table.merge(aggregate_packets(buffer, data, packets, bucket_seconds, table.conversations))
+            if progress is not None:
+                _timestamp, _length, _linktype, offset, captured = records[-1]
+                progress(offset + captured - start, end - start)
+    finally:
+        # mmap を閉じる前に配列からの参照をなくす
+        del data
+        scanner.close()
+    return table
+
+
+def aggregate_packets(buffer, data, packets, bucket_seconds=None, conversations=None, flow_ids=None):
+    """
+    構造化配列にまとめたパケットを集計する
+
+    Args:
+        buffer: キャプチャ全体の mmap / bytes
+        data: buffer を uint8 の配列として見たもの
+        packets: PACKET_DTYPE の構造化配列
+        bucket_seconds: 指定した場合はこの秒数ごとのバケットの値も集計する
+        conversations: 指定した場合は、この ConversationTable に会話ごとの値を加算する
+        flow_ids: 指定した場合は、この配列 (パケット数の長さ) にパケットごとの接続の番号
+            (戻り値の flows での位置、接続のないパケットは -1) を書き込む
+
+    Returns:
+        FlowTable
+    """
+    table = FlowTable(bucket_seconds)
+    table.total_packets = len(packets)
+    ethertype, l3 = _decode_link_layer(data, packets)
+    end = packets['offset'] + packets['captured']
+
+    # IPv4 (ヘッダーがすべてキャプチャされているもの) はベクトル演算で処理する
+    ipv4 = (ethertype == ETHERTYPE_IPV4) & (end >= l3 + 20)
+    # それ以外の IP らしいパケットは1パケットずつデコードする
+    undecided = np.isin(ethertype, (ETHERTYPE_IPV6, _ETHERTYPE_UNDECIDED) + ETHERTYPE_VLAN) | \
+        ((ethertype == ETHERTYPE_IPV4) & ~ipv4)
+
+    # チャンク内の接続: キー -> [最初のパケットの番号, パケット数, 総バイト数, 最初と最後のタイムスタンプ]
+    ipv4_packets = packets[ipv4]
+    chunk_flows, flow_keys, flow_indexes = _aggregate_ipv4(data, ipv4_packets, l3[ipv4], end[ipv4],
+                                                           np.flatnonzero(ipv4))
+    if table.timeline is not None:
+        aggregate_buckets(table.timeline, ipv4_packets, flow_keys, flow_indexes)
+    # 1パケットずつデコードしたパケットの会話の値: [(パケットの番号, decode_segment() の戻り値)]
+    segments = []
+    # 1パケットずつデコードしたパケットの接続: [(パケットの番号, キー)] (flow_ids を指定した場合のみ)
+    decoded = []
+
+    view = memoryview(buffer)
+    for index in np.flatnonzero(undecided).tolist():
+        timestamp, length, linktype, offset, captured = packets[index].tolist()
+        if conversations is None:
+            key = decode_flow(linktype, view[offset:offset + captured])
+        else:
+            segment = decode_segment(linktype, view[offset:offset + captured], length)
+            key = None if segment is None else segment[:5]
+            if segment is not None:
+                segments.append((index, segment))
+        if key is None:
+            continue
+        if flow_ids is not None:
+            decoded.append((index, key))
+        timestamp = None if math.isnan(timestamp) else timestamp
+        if table.timeline is not None and timestamp is not None:
+            table.timeline.add_packet(key, length, timestamp)
+        flow = chunk_flows.get(key)
+        if flow is None:
+            chunk_flows[key] = [index, 1, length, timestamp, timestamp]
+            continue
+        # ベクトル演算で集計した接続と同じキーのこともある
+        flow[0] = min(flow[0], index)
+        flow[1] += 1
+        flow[2] += length
+        if timestamp is not None:
+            if flow[3] is None or timestamp < flow[3]:
+                flow[3] = timestamp
+            if flow[4] is None or timestamp > flow[4]:
+                flow[4] = timestamp
+    view.release()
+
+    if conversations is not None:
+        _aggregate_conversations(conversations, data, packets, ipv4, l3[ipv4], end[ipv4],
+                                 flow_keys, flow_indexes, segments)
+
+    # 1パケットずつ処理した場合と同じ順番になるよう、最初に現れた順に追加する
+    for key, (_index, packet_count, bytes_count, first_timestamp, last_timestamp) in \
+            sorted(chunk_flows.items(), key=lambda item: item[1][0]):
+        table.add_flow(key, packet_count, bytes_count, first_timestamp, last_timestamp)
+
+    if flow_ids is not None:
+        numbers = {key: number for number, key in enumerate(table.flows)}
+        flow_ids.fill(-1)
+        if flow_keys:
+            flow_ids[ipv4] = np.array([numbers[key] for key in flow_keys])[flow_indexes]
+        for index, key in decoded:
+            flow_ids[index] = numbers[key]
+    return table
+
+
+def _gather(data, positions):
+    """positions の位置のバイトを取り出す (ファイル末尾を超える位置は0として扱う)"""
+    return data[np.minimum(positions, len(data) - 1)].astype(np.int64)
+
+
+def _decode_link_layer(data, packets):
+    """
+    リンク層のヘッダーをベクトル演算でデコードする
+
+    Returns:
+        (EtherType の配列, ネットワーク層の開始位置の配列)
+        EtherType は IP でない場合 -1、この場では判定しない場合は _ETHERTYPE_UNDECIDED
+    """
+    linktype = packets['linktype']
+    offset = packets['offset']
+    captured = packets['captured']
+    ethertype = np.full(len(packets), -1, dtype=np.int64)
+    l3 = offset.copy()
+
+    # Ethernet (VLAN タグ1つまで。多重タグは EtherType が VLAN のまま残り1パケットずつ処理される)
+    ethernet = (linktype == LINKTYPE_ETHERNET) & (captured >= 14)
+    outer = (_gather(data, offset + 12) << 8) | _gather(data, offset + 13)
+    ethertype[ethernet] = outer[ethernet]
+    l3[ethernet] += 14
+    vlan = ethernet & np.isin(outer, ETHERTYPE_VLAN) & (captured >= 18)
+    inner = (_gather(data, offset + 16) << 8) | _gather(data, offset + 17)
+    ethertype[vlan] = inner[vlan]
+    l3[vlan] += 4
+
+    # Linux cooked capture
+    sll = (linktype == LINKTYPE_LINUX_SLL) & (captured >= 16)
+    ethertype[sll] = ((_gather(data, offset + 14) << 8) | _gather(data, offset + 15))[sll]
+    l3[sll] += 16
+    sll2 = (linktype == LINKTYPE_LINUX_SLL2) & (captured >= 20)
+    ethertype[sll2] = ((_gather(data, offset) << 8) | _gather(data, offset + 1))[sll2]
+    l3[sll2] += 20
+
+    # NULL / LOOP (キャプチャしたホストのバイトオーダーなので、どちらの端の値でも判定する)
+    null = np.isin(linktype, (LINKTYPE_NULL, LINKTYPE_LOOP)) & (captured >= 4)
+    first_byte = _gather(data, offset)
+    family = np.where(first_byte != 0, first_byte, _gather(data, offset + 3))
+    ethertype[null] = np.where(family == NULL_FAMILY_IPV4, ETHERTYPE_IPV4, _ETHERTYPE_UNDECIDED)[null]
+    l3[null] += 4
+
+    # raw IP
+    raw = np.isin(linktype, (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6)) & (captured >= 1)
+    ethertype[raw] = np.where((first_byte >> 4) == 4, ETHERTYPE_IPV4, _ETHERTYPE_UNDECIDED)[raw]
+
+    return ethertype, l3
+
+
+def _aggregate_ipv4(data, packets, l3, end, indexes):
+    """
+    IPv4 パケットのヘッダーをデコードし、5タプルごとに集計する
+
+    Returns:
+        ({キー: [最初のパケットの番号, パケット数, 総バイト数, 最初と最後のタイムスタンプ]},
+         接続のキーのリスト, パケットごとの接続のキーのリストでの位置)
+    """
+    if len(packets) == 0:
+        return {}, [], np.empty(0, dtype=np.int64)
+    header_length = (_gather(data, l3) & 0x0F) * 4
+    fragment_offset = ((_gather(data, l3 + 6) & 0x1F) << 8) | _gather(data, l3 + 7)
+    protocol = _gather(data, l3 + 9)
+    src = _gather_u32(data, l3 + 12)
+    dst = _gather_u32(data, l3 + 16)
+    l4 = l3 + header_length
+    # 2番目以降のフラグメントやポートまでキャプチャされていないパケットはポートなし
+    has_ports = np.isin(protocol, (IP_PROTO_TCP, IP_PROTO_UDP)) & (fragment_offset == 0) & (end >= l4 + 4)
+    src_port = np.where(has_ports, (_gather(data, l4) << 8) | _gather(data, l4 + 1), 0)
+    dst_port = np.where(has_ports, (_gather(data, l4 + 2) << 8) | _gather(data, l4 + 3), 0)
+
+    # 5タプルを2つの64ビット整数にまとめてソートし、同じキーの範囲を1つの接続とする
+    addresses = (src.astype(np.uint64) << np.uint64(32)) | dst.astype(np.uint64)
+    ports = ((has_ports.astype(np.uint64) << np.uint64(40)) | (src_port.astype(np.uint64) << np.uint64(24))
+             | (dst_port.astype(np.uint64) << np.uint64(8)) | protocol.astype(np.uint64))
+    # 安定ソートなので、各範囲の先頭はその接続の最初のパケット
+    order = np.lexsort((ports, addresses))
+    sorted_addresses = addresses[order]
+    sorted_ports = ports[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (sorted_addresses[1:] != sorted_addresses[:-1]) | (sorted_ports[1:] != sorted_ports[:-1])
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.cumsum(starts) - 1
+    first_positions = order[starts]
+
+    flow_count = len(first_positions)
+    packet_counts = np.bincount(inverse, minlength=flow_count)
+    byte_counts = np.zeros(flow_count, dtype=np.uint64)
+    np.add.at(byte_counts, inverse, packets['length'])
+    # タイムスタンプのないパケット (NaN) は fmin / fmax で無視される
+    first_timestamps = np.full(flow_count, np.nan)
+    last_timestamps = np.full(flow_count, np.nan)
+    np.fmin.at(first_timestamps, inverse, packets['timestamp'])
+    np.fmax.at(last_timestamps, inverse, packets['timestamp'])
+
+    flows = {}
+    flow_keys = []
+    for addresses, ports, position, packet_count, bytes_count, first_timestamp, last_timestamp in zip(
+            sorted_addresses[starts].tolist(), sorted_ports[starts].tolist(), indexes[first_positions].tolist(),
+            packet_counts.tolist(), byte_counts.tolist(), first_timestamps.tolist(), last_timestamps.tolist()):
+        src_ip = format_address(socket.AF_INET, (addresses >> 32).to_bytes(4, 'big'))
+        dst_ip = format_address(socket.AF_INET, (addresses & 0xFFFFFFFF).to_bytes(4, 'big'))
+        protocol_number = ports & 0xFF
+        if ports >> 40:
+            key = (src_ip, (ports >> 24) & 0xFFFF, dst_ip, (ports >> 8) & 0xFFFF,
+                   'TCP' if protocol_number == IP_PROTO_TCP else 'UDP')
+        else:
+            key = (src_ip, '-', dst_ip, '-', str(protocol_number))
+        if math.isnan(first_timestamp):
+            first_timestamp = last_timestamp = None
+        flows[key] = [position, packet_count, bytes_count, first_timestamp, last_timestamp]
+        flow_keys.append(key)
+    return flows, flow_keys, inverse
+
+
+def aggregate_buckets(timeline, packets, flow_keys, flow_indexes):
+    """
+    パケットを (接続, バケット) ごとにまとめて timeline に加算する
+
+    Args:
+        timeline: 加算する Timeline
+        packets: 'timestamp' (ない場合は NaN) と 'length' の列を持つ構造化配列 (または配列の辞書)
+        flow_keys: 接続のキーのリスト
+        flow_indexes: パケットごとの接続のキーの flow_keys での位置
+    """
+    has_timestamp = ~np.isnan(packets['timestamp'])
+    if not has_timestamp.any():
+        return
+    # Timeline.add_packet() と同じ計算でバケット番号を求める
+    buckets = np.floor_divide(packets['timestamp'][has_timestamp], timeline.bucket_seconds).astype(np.int64)
+    flow_indexes = flow_indexes[has_timestamp]
+    first_bucket = int(buckets.min())
+    bucket_count = int(buckets.max()) - first_bucket + 1
+    pairs, pair_indexes = np.unique(flow_indexes * bucket_count + (buckets - first_bucket), return_inverse=True)
+    packet_counts = np.bincount(pair_indexes, minlength=len(pairs))
+    byte_counts = np.zeros(len(pairs), dtype=np.uint64)
+    np.add.at(byte_counts, pair_indexes, packets['length'][has_timestamp])
+    for pair, packet_count, bytes_count in zip(pairs.tolist(), packet_counts.tolist(), byte_counts.tolist()):
+        flow_index, bucket = divmod(pair, bucket_count)
+        timeline.add_bucket(flow_keys[flow_index], first_bucket + bucket, packet_count, bytes_count)
+
+
+def _aggregate_conversations(conversations, data, packets, ipv4, l3, end, flow_keys, flow_indexes, segments):
+    """
+    IPv4 パケットのヘッダー・ペイロードの内訳をベクトル演算で求め、
+    1パケットずつデコードしたパケットと合わせてパケットの順に会話に加算する
+    """
+    ipv4_packets = packets[ipv4]
+    length = ipv4_packets['length'].astype(np.int64)
+    header_length = (_gather(data, l3) & 0x0F) * 4
+    declared_length = (_gather(data, l3 + 2) << 8) | _gather(data, l3 + 3)
+    # IP パケットの長さ (0 の場合 (TSO など) やフレームを超える場合はフレームの残り全部)
+    frame_rest = np.maximum(length - (l3 - ipv4_packets['offset']), 0)
+    ip_length = np.where(declared_length > 0, np.minimum(declared_length, frame_rest), frame_rest)
+    l3_bytes = np.minimum(header_length, ip_length)
+    rest = ip_length - l3_bytes
+
+    # ポートがあるかどうかは接続のキーと同じ判定
+    has_ports = np.array([key[1] != '-' for key in flow_keys], dtype=bool)[flow_indexes]
+    protocol = _gather(data, l3 + 9)
+    l4 = l3 + header_length
+    udp = has_ports & (protocol == IP_PROTO_UDP)
+    tcp = has_ports & (protocol == IP_PROTO_TCP)
+    # データオフセットまでキャプチャされていない TCP は最小のヘッダー長とする
+    tcp_header = tcp & (end >= l4 + 14)
+    data_offset = (_gather(data, l4 + 12) >> 4) * 4
+    l4_bytes = np.where(udp, np.minimum(8, rest),
+                        np.where(tcp_header, np.minimum(data_offset, rest), np.where(tcp, np.minimum(20, rest), 0)))
+    seq = np.where(tcp_header, _gather_u32(data, l4 + 4), -1)
+    flags = np.where(tcp_header, _gather(data, l4 + 13), 0)
+
+    # 1パケットずつデコードしたパケットを後ろに加え、方向のキーの番号をそろえる
+    keys = list(flow_keys)
+    key_numbers = {key: number for number, key in enumerate(keys)}
+    extra_indexes = []
+    for _index, segment in segments:
+        key = segment[:5]
+        number = key_numbers.get(key)
+        if number is None:
+            number = key_numbers[key] = len(keys)
+            keys.append(key)
+        extra_indexes.append(number)
+    extra = np.array([segment[5:9] + (-1 if segment[9] is None else segment[9], segment[10])
+                      for _index, segment in segments], dtype=np.int64).reshape(-1, 6)
+    extra_positions = np.array([index for index, _segment in segments], dtype=np.int64)
+    extra_packets = packets[extra_positions]
+
+    # パケットの順に並べ替える
+    order = np.argsort(np.concatenate([np.flatnonzero(ipv4), extra_positions]), kind='stable')
+    columns = {
+        'timestamp': np.concatenate([ipv4_packets['timestamp'], extra_packets['timestamp']]),
+        'length': np.concatenate([length, extra_packets['length'].astype(np.int64)]),
+        'l2': np.concatenate([length - ip_length, extra[:, 0]]),
+        'l3': np.concatenate([l3_bytes, extra[:, 1]]),
+        'l4': np.concatenate([l4_bytes, extra[:, 2]]),
+        'payload': np.concatenate([rest - l4_bytes, extra[:, 3]]),
+        'seq': np.concatenate([seq, extra[:, 4]]),
+        'flags': np.concatenate([flags, extra[:, 5]]),
+    }
+    key_indexes = np.concatenate([flow_indexes, np.array(extra_indexes, dtype=np.int64)])[order]
+    conversations.add_batch(keys, key_indexes, {name: values[order] for name, values in columns.items()})
+
+
+def _gather_u32(data, positions):
+    """positions の位置からビッグエンディアンの32ビット整数を取り出す"""
+    return ((_gather(data, positions) << 24) | (_gather(data, positions + 1) << 16)
+            | (_gather(data, positions + 2) << 8) | _gather(data, positions + 3))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+往復時間 (RTT) などのナノ秒の値を記録する対数線形ヒストグラム
+
+値を2のべき乗ごとの区間に分け、各区間を SUB_BUCKETS 個の等幅のバケットに分ける。
+バケットの幅は値の 1/SUB_BUCKETS 以下なので、パーセンタイルの相対誤差は約 1.6% 以下。
+バケット数は固定なので、何回記録してもメモリ使用量は変わらず、
+同じ形のヒストグラムはバケットごとの足し算で統合できる (接続ごと・プロセスごとの結果の集計)。
+
+JSON に出力したヒストグラムを統合して表示する:
+    python latency_histogram.py client1.json client2.json
+"""
+
+import json
+import sys
+
+# 2のべき乗の区間あたりのバケット数のビット数 (SUB_BUCKETS = 2 ** (SUB_BUCKET_BITS - 1))
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << (SUB_BUCKET_BITS - 1)
+# 64ビットの値まで記録できるバケット数
+BUCKET_COUNT = (64 - SUB_BUCKET_BITS + 1) * SUB_BUCKETS + SUB_BUCKETS
+
+# 表示するパーセンタイル
+REPORT_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_index(value):
+    """値のバケット番号 (2 ** SUB_BUCKET_BITS 未満の値はそのままの番号)"""
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    if shift <= 0:
+        return value
+    return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+
+def bucket_range(index):
+    """バケットに入る値の範囲 (最小値, 最大値)"""
+    shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+    if shift <= 0:
+        return index, index
+    base = index - (shift << (SUB_BUCKET_BITS - 1))
+    return base << shift, ((base + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """
+    ナノ秒の値の対数線形ヒストグラム
+
+    件数・合計・最小値・最大値は正確な値を持ち、パーセンタイルはバケットから求める。
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        """
+        値 (ナノ秒, 0以上の整数) を1つ記録する
+
+        別スレッドから merge() されても count > 0 で min が None にならないよう、最小値・最大値を先に更新する
+        """
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.counts[bucket_index(value)] += 1
+        self.total += value
+        self.count += 1
+
+    def merge(self, other):
+        """別のヒストグラムの値を加える"""
+        if other.count == 0 or other.min is None:
+            return
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile):
+        """
+        パーセンタイルの値 (そのバケットの中央の値、最小値・最大値の範囲に収める)
+
+        記録がない場合は None
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, -(-self.count * percentile // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                low, high = bucket_range(index)
+                return min(max((low + high) // 2, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        """
+        集計結果を辞書で返す
+
+        Returns:
+            {'count': 件数, 'mean_ns': 平均, 'min_ns': 最小値, 'max_ns': 最大値,
+             'percentiles_ns': {'p50': 値, 'p90': 値, 'p99': 値, 'p99.9': 値}}
+        """
+        return {
+            'count': self.count,
+            'mean_ns': self.total / self.count if self.count else None,
+            'min_ns': self.min,
+            'max_ns': self.max if self.count else None,
+            'percentiles_ns': {f"p{percentile:g}": self.percentile(percentile) for percentile in REPORT_PERCENTILES},
+        }
+
+    def to_dict(self):
+        """JSON に出力できる辞書 (集計結果と、統合用の0でないバケット)"""
+        return {
+            'summary': self.summary(),
+            'total_ns': self.total,
+            'buckets': {str(index): count for index, count in enumerate(self.counts) if count},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """to_dict() の出力から復元する"""
+        histogram = cls()
+        for index, count in data['buckets'].items():
+            histogram.counts[int(index)] = count
+        summary = data['summary']
+        histogram.count = summary['count']
+        histogram.total = data['total_ns']
+        histogram.min = summary['min_ns']
+        histogram.max = summary['max_ns'] or 0
+        return histogram
+
+
+def format_latency(value_ns):
+    """ナノ秒の値をミリ秒の文字列にする"""
+    if value_ns is None:
+        return '-'
+    return f"{value_ns / 1e6:.3f}ms"
+
+
+def format_summary(histogram):
+    """パーセンタイルと最大値を1行の文字列にする"""
+    if histogram.count == 0:
+        return "記録なし"
+    percentiles = ' '.join(f"p{percentile:g}: {format_latency(histogram.percentile(percentile))}"
+                           for percentile in REPORT_PERCENTILES)
+    return f"{percentiles} max: {format_latency(histogram.max)}"
+
+
+def write_json(path, data):
+    """結果を JSON ファイルに出力する"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    """JSON に出力した結果の 'rtt' (全体) を統合して表示する"""
+    if len(sys.argv) < 2:
+        print("使用方法: python latency_histogram.py <結果のJSON> [<結果のJSON> ...]")
+        sys.exit(1)
+    merged = LatencyHistogram()
+    for path in sys.argv[1:]:
+        with open(path, encoding='utf-8') as f:
+            histogram = LatencyHistogram.from_dict(json.load(f)['rtt'])
+        print(f"{path}: {histogram.count:,} 件, {format_summary(histogram)}")
+        merged.merge(histogram)
+    print(f"\n統合: {merged.count:,} 件, {format_summary(merged)}")
+
+
+if __name__ == "__main__":
+    main()
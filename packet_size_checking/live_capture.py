@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+書き込み中のキャプチャ (dumpcap -w の出力ファイルやパイプ) を読みながら接続ごとに集計するモジュール
+
+ファイルは末尾に追いつくと、新しいデータが書き込まれるまで待って読み続ける (tail -f と同じ)。
+パイプ・標準入力はそのまま順に読む。
+
+メモリ使用量はキャプチャの長さによらず一定になるようにしている。
+- 接続ごとの累計は最大 max_flows 接続までで、超えた場合は最も長くパケットのない接続から捨てる
+  (捨てた接続の値は evicted_packets / evicted_bytes に加える)
+- 直近のレートはスロット (slot_seconds 秒ごと) の値をウィンドウの分だけ持つ
+
+レートの時刻はパケットのタイムスタンプで数えるため、既存のファイルを先頭から読んだ場合でも
+過去のパケットは直近のレートに入らない。最後のパケットからの経過時間は実時間で進める。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from pcap_reader import CaptureFormatError
+from pcap_reader import decode_flow
+from pcap_reader import read_packets_from
+
+
+# 末尾に追いついたときに新しいデータを待つ間隔 (秒)
+FOLLOW_POLL_INTERVAL = 0.1
+# 既定のレートのウィンドウ (秒)
+LIVE_WINDOW_SECONDS = 10.0
+# 既定のスロットの幅 (秒)
+LIVE_SLOT_SECONDS = 1.0
+# 累計を持つ最大の接続数
+MAX_LIVE_FLOWS = 10000
+
+
+class FollowReader:
+    """
+    ファイルの末尾に追いついても EOF にせず、データが書き込まれるまで待つファイルオブジェクト
+
+    stop() が呼ばれると、その時点までに読めたデータを返して EOF になる。
+    """
+
+    def __init__(self, f, poll_interval=FOLLOW_POLL_INTERVAL):
+        self.f = f
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def read(self, size):
+        """size バイトそろうまで待って読み込む"""
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            data = self.f.read(remaining)
+            if data:
+                chunks.append(data)
+                remaining -= len(data)
+            elif self._stopped.wait(self.poll_interval):
+                break
+        return b''.join(chunks)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class LiveFlowTable:
+    """
+    読みながら更新する接続ごとの統計情報
+
+    キー: (送信元IP, 送信元ポート, 宛先IP, 宛先ポート, プロトコル)
+    累計: [パケット数, 総バイト数, 最初のタイムスタンプ, 最後のタイムスタンプ] (FlowTable と同じ)
+    スロット: {スロット番号: {キー: [パケット数, バイト数]}}
+    更新と参照は別スレッドから行われるため、lock を取ってから使う。
+    """
+
+    def __init__(self, window_seconds=LIVE_WINDOW_SECONDS, slot_seconds=LIVE_SLOT_SECONDS,
+                 max_flows=MAX_LIVE_FLOWS, clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self.slot_seconds = slot_seconds
+        self.max_flows = max_flows
+        self.clock = clock
+        self.lock = threading.Lock()
+        # 最後にパケットがあった順 (古い順) に並ぶ
+        self.flows = OrderedDict()
+        self.slots = {}
+        self.total_packets = 0
+        self.total_bytes = 0
+        self.evicted_flows = 0
+        self.evicted_packets = 0
+        self.evicted_bytes = 0
+        # 最後のパケットのタイムスタンプと、それを読んだ実時間
+        self._last_timestamp = None
+        self._last_arrival = None
+
+    def add_packet(self, key, length, timestamp):
+        """
+        1パケット分を加算する
+
+        タイムスタンプがないパケットは、現在のキャプチャ時刻をレートのスロットを決めるためだけに使う
+        (累計の最初・最後のタイムスタンプは FlowTable と同じく変えない)
+        """
+        self.total_packets += 1
+        self.total_bytes += length
+        now = self.clock()
+        slot_time = self.get_capture_time(now) if timestamp is None else timestamp
+        if slot_time is not None and (self._last_timestamp is None or slot_time >= self._last_timestamp):
+            self._last_timestamp = slot_time
+            self._last_arrival = now
+
+        entry = self.flows.get(key)
+        if entry is None:
+            self.flows[key] = [1, length, timestamp, timestamp]
+            if len(self.flows) > self.max_flows:
+                self._evict()
+        else:
+            entry[0] += 1
+            entry[1] += length
+            if timestamp is not None:
+                if entry[2] is None or timestamp < entry[2]:
+                    entry[2] = timestamp
+                if entry[3] is None or timestamp > entry[3]:
+                    entry[3] = timestamp
+            self.flows.move_to_end(key)
+
+        if slot_time is None:
+            return
+        slot = int(slot_time // self.slot_seconds)
+        if slot < self._get_first_slot(self._last_timestamp):
+            return
+        flows = self.slots.get(slot)
+        if flows is None:
+            flows = self.slots[slot] = {}
+            self._expire_slots(self._last_timestamp)
+        counts = flows.get(key)
+        if counts is None:
+            flows[key] = [1, length]
+        else:
+            counts[0] += 1
+            counts[1] += length
+
+    def get_capture_time(self, now=None):
+        """
+        現在のキャプチャ上の時刻 (最後のパケットのタイムスタンプ + 読んでからの経過時間)
+
+        パケットがまだない場合は None
+        """
+        if self._last_timestamp is None:
+            return None
+        return self._last_timestamp + ((self.clock() if now is None else now) - self._last_arrival)
+
+    def get_rates(self):
+        """
+        直近のウィンドウのレートを返す
+
+        Returns:
+            (全体の (packets/sec, bytes/sec), {キー: (packets/sec, bytes/sec)})
+        """
+        capture_time = self.get_capture_time()
+        if capture_time is None:
+            return (0.0, 0.0), {}
+        self._expire_slots(capture_time)
+        window = self.window_seconds
+        packets_total = 0
+        bytes_total = 0
+        rates = {}
+        for flows in self.slots.values():
+            for key, (packets, bytes_count) in flows.items():
+                rate = rates.get(key)
+                if rate is None:
+                    rates[key] = [packets, bytes_count]
+                else:
+                    rate[0] += packets
+                    rate[1] += bytes_count
+                packets_total += packets
+                bytes_total += bytes_count
+        return (packets_total / window, bytes_total / window), \
+            {key: (packets / window, bytes_count / window) for key, (packets, bytes_count) in rates.items()}
+
+    def get_stats(self):
+        """接続ごとの累計を FlowTable.get_stats() と同じ形式で返す"""
+        return {key: {'packets': packets, 'bytes': bytes_count,
+                      'first_timestamp': first_timestamp, 'last_timestamp': last_timestamp}
+                for key, (packets, bytes_count, first_timestamp, last_timestamp) in self.flows.items()}
+
+    def _get_first_slot(self, capture_time):
+        """ウィンドウに入る最も古いスロットの番号"""
+        return int((capture_time - self.window_seconds) // self.slot_seconds) + 1
+
+    def _expire_slots(self, capture_time):
+        first_slot = self._get_first_slot(capture_time)
+        for slot in [slot for slot in self.slots if slot < first_slot]:
+            del self.slots[slot]
+
+    def _evict(self):
+        """最も長くパケットのない接続を捨てる"""
+        _key, (packets, bytes_count, _first, _last) = self.flows.popitem(last=False)
+        self.evicted_flows += 1
+        self.evicted_packets += packets
+        self.evicted_bytes += bytes_count
+
+
+class LiveCapture:
+    """
+    キャプチャをバックグラウンドのスレッドで読み、LiveFlowTable を更新する
+
+    Args:
+        f: キャプチャのバイナリファイルオブジェクト (ファイル・パイプ・標準入力)
+        follow: True の場合はファイルの末尾に追いついても書き込みを待って読み続ける
+        table: 更新する LiveFlowTable
+    """
+
+    def __init__(self, f, follow, table):
+        self.reader = FollowReader(f) if follow else f
+        self.table = table
+        self.error = None
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='live-capture', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """読み込みを止める (パイプ・標準入力の場合は次のデータが届くまで止まらないことがある)"""
+        self._stopping = True
+        if isinstance(self.reader, FollowReader):
+            self.reader.stop()
+        self._thread.join(timeout)
+
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        table = self.table
+        try:
+            for timestamp, length, linktype, data in read_packets_from(self.reader):
+                key = decode_flow(linktype, data)
+                with table.lock:
+                    if key is None:
+                        table.total_packets += 1
+                        table.total_bytes += length
+                    else:
+                        table.add_packet(key, length, timestamp)
+        except CaptureFormatError as e:
+            # 止めたときにブロックの途中で EOF になるのはエラーにしない
+            if not self._stopping:
+                self.error = e
+        except Exception as e:
+            self.error = e
@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+"""
+pcapng / pcap ファイルを読み込むモジュール
+
+tshark (pyshark) を使わずに struct でブロックを直接読み、
+Ethernet / IPv4 / IPv6 / TCP / UDP のヘッダーだけをデコードする。
+
+読み込み方は2通り:
+    read_packets():  ファイルからブロック (レコード) ごとに読み込む。ブロックごとに読み込んだ
+                     bytes へのコピーが発生し、パケットデータはその memoryview のスライスとして返す
+    scan_packets():  mmap などメモリ上のキャプチャ全体を走査し、パケットデータの位置だけを返す。
+                     コピーは発生しない (flow_aggregator はこちらでキャプチャを mmap して集計する)
+
+対応フォーマット:
+    pcapng: SHB / IDB / EPB / SPB (旧形式の PB も可)、リトルエンディアン・ビッグエンディアン両方
+    pcap:   マイクロ秒・ナノ秒精度、リトルエンディアン・ビッグエンディアン両方
+"""
+
+import socket
+import struct
+
+
+# ファイル読み込み時のバッファサイズ
+READ_BUFFER_SIZE = 1024 * 1024
+
+# pcapng のブロックタイプ
+BLOCK_TYPE_SHB = 0x0A0D0D0A
+BLOCK_TYPE_IDB = 0x00000001
+BLOCK_TYPE_PB = 0x00000002
+BLOCK_TYPE_SPB = 0x00000003
+BLOCK_TYPE_EPB = 0x00000006
+
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# split_capture() のチャンクの読み込み状態に入れるファイル形式
+FORMAT_PCAPNG = 'pcapng'
+FORMAT_PCAP = 'pcap'
+
+# IDB のオプションコード
+OPTION_END_OF_OPT = 0
+OPTION_IF_TSRESOL = 9
+OPTION_IF_TSOFFSET = 14
+
+# pcap のマジックナンバー (リトルエンディアンで読んだ値)
+PCAP_MAGIC_USEC = 0xA1B2C3D4
+PCAP_MAGIC_NSEC = 0xA1B23C4D
+PCAP_MAGIC_USEC_SWAPPED = 0xD4C3B2A1
+PCAP_MAGIC_NSEC_SWAPPED = 0x4D3CB2A1
+
+# リンクタイプ
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+# EtherType
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+
+# IPプロトコル番号
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+# IPv6 拡張ヘッダー (ホップバイホップ, ルーティング, 宛先オプション)
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT_HEADER = 44
+IPV6_AUTH_HEADER = 51
+
+# NULL / LOOP リンクタイプのアドレスファミリー (IPv6 の値は OS によって異なる)
+NULL_FAMILY_IPV4 = 2
+NULL_FAMILY_IPV6 = (10, 24, 28, 30)
+
+_U16_BE = struct.Struct('!H')
+_U32_BE = struct.Struct('!I')
+_PORTS = struct.Struct('!HH')
+_IPV4_ADDRS = struct.Struct('!4s4s')
+_IPV6_ADDRS = struct.Struct('!16s16s')
+
+# アドレス文字列のキャッシュ (同じアドレスが繰り返し現れるため)
+_ADDRESS_CACHE_SIZE = 65536
+_address_cache = {}
+
+
+class CaptureFormatError(ValueError):
+    """キャプチャファイルの形式が不正な場合の例外"""
+
+
+def read_packets(capture_file):
+    """
+    キャプチャファイルのパケットを先頭から順に返すジェネレーター
+
+    Args:
+        capture_file: .pcapng / .pcap ファイルのパス
+
+    Yields:
+        (タイムスタンプ(秒, 不明な場合は None), 元のフレーム長, リンクタイプ, パケットデータの memoryview)
+    """
+    with open(capture_file, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        yield from read_packets_from(f)
+
+
+def read_packets_from(f):
+    """
+    バイナリファイルオブジェクトからパケットを順に返すジェネレーター
+
+    先頭4バイトで pcapng と pcap を判別する。
+    """
+    magic = f.read(4)
+    if len(magic) < 4:
+        return
+    if int.from_bytes(magic, 'little') == BLOCK_TYPE_SHB:
+        yield from _read_pcapng(f, magic)
+    elif int.from_bytes(magic, 'little') in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC,
+                                              PCAP_MAGIC_USEC_SWAPPED, PCAP_MAGIC_NSEC_SWAPPED):
+        yield from _read_pcap(f, magic)
+    else:
+        raise CaptureFormatError(f"pcapng / pcap ファイルではありません (先頭バイト: {magic.hex()})")
+
+
+def _read_exactly(f, size, what):
+    """size バイトを読み込む。ファイルが途中で終わっている場合は例外"""
+    data = f.read(size)
+    if len(data) < size:
+        raise CaptureFormatError(f"{what}の途中でファイルが終わっています")
+    return data
+
+
+def _read_pcapng(f, first_bytes):
+    """pcapng のブロックを読み、パケットを返す"""
+    endian = '<'
+    block_header = struct.Struct('<II')
+    # インターフェースごとの (リンクタイプ, 1秒あたりのタイムスタンプ単位数, タイムスタンプオフセット)
+    interfaces = []
+    header = first_bytes + f.read(4)
+
+    while True:
+        if len(header) < 8:
+            if header:
+                raise CaptureFormatError("ブロックヘッダーの途中でファイルが終わっています")
+            return
+
+        if header[:4] == b'\x0a\x0d\x0d\x0a':
+            # SHB: バイトオーダーマジックでエンディアンを決める。SHB ごとにインターフェースはリセットされる
+            endian = _pcapng_endian(_read_exactly(f, 4, "SHB"), 0)
+            block_header = struct.Struct(endian + 'II')
+            block_length = block_header.unpack(header)[1]
+            if block_length < 28 or block_length % 4:
+                raise CaptureFormatError(f"SHB のブロック長が不正です: {block_length}")
+            _read_exactly(f, block_length - 12, "SHB")
+            interfaces = []
+            header = f.read(8)
+            continue
+
+        block_type, block_length = block_header.unpack(header)
+        if block_length < 12 or block_length % 4:
+            raise CaptureFormatError(f"ブロック長が不正です: {block_length}")
+        body = _read_exactly(f, block_length - 8, "ブロック")
+        # 末尾のブロック長 (4バイト) を除いた部分がブロック本体
+        view = memoryview(body)[:-4]
+
+        if block_type == BLOCK_TYPE_EPB:
+            interface_id, ts_high, ts_low, captured_length, original_length = \
+                struct.unpack_from(endian + 'IIIII', view)
+            linktype, units_per_second, ts_offset = _get_interface(interfaces, interface_id)
+            timestamp = ((ts_high << 32) | ts_low) / units_per_second + ts_offset
+            yield timestamp, original_length, linktype, view[20:20 + captured_length]
+
+        elif block_type == BLOCK_TYPE_SPB:
+            # SPB にはタイムスタンプがなく、インターフェースは常に0番
+            original_length = struct.unpack_from(endian + 'I', view)[0]
+            linktype = _get_interface(interfaces, 0)[0]
+            yield None, original_length, linktype, view[4:4 + original_length]
+
+        elif block_type == BLOCK_TYPE_PB:
+            interface_id, _drops, ts_high, ts_low, captured_length, original_length = \
+                struct.unpack_from(endian + 'HHIIII', view)
+            linktype, units_per_second, ts_offset = _get_interface(interfaces, interface_id)
+            timestamp = ((ts_high << 32) | ts_low) / units_per_second + ts_offset
+            yield timestamp, original_length, linktype, view[20:20 + captured_length]
+
+        elif block_type == BLOCK_TYPE_IDB:
+            interfaces.append(_parse_idb(view, endian))
+
+        # その他のブロック (NRB, ISB, DSB など) は読み飛ばす
+
+        header = f.read(8)
+
+
+def _get_interface(interfaces, interface_id):
+    if interface_id >= len(interfaces):
+        raise CaptureFormatError(f"未定義のインターフェースID: {interface_id}")
+    return interfaces[interface_id]
+
+
+def _parse_idb(view, endian):
+    """IDB からリンクタイプとタイムスタンプの分解能・オフセットを取り出す"""
+    linktype = struct.unpack_from(endian + 'H', view)[0]
+    # 既定の分解能はマイクロ秒
+    units_per_second = 1000000
+    ts_offset = 0
+    option_header = struct.Struct(endian + 'HH')
+    offset = 8
+    while offset + 4 <= len(view):
+        code, length = option_header.unpack_from(view, offset)
+        offset += 4
+        if code == OPTION_END_OF_OPT:
+            break
+        if code == OPTION_IF_TSRESOL and length >= 1:
+            tsresol = view[offset]
+            if tsresol & 0x80:
+                units_per_second = 2 ** (tsresol & 0x7F)
+            else:
+                units_per_second = 10 ** tsresol
+        elif code == OPTION_IF_TSOFFSET and length >= 8:
+            ts_offset = struct.unpack_from(endian + 'q', view, offset)[0]
+        # オプションの値は4バイト境界までパディングされる
+        offset += (length + 3) & ~3
+    return linktype, units_per_second, ts_offset
+
+
+def _read_pcap(f, magic):
+    """pcap (libpcap 形式) のレコードを読み、パケットを返す"""
+    endian, units_per_second, linktype = _parse_pcap_header(magic + _read_exactly(f, 20, "pcap ヘッダー"))
+
+    record_header = struct.Struct(endian + 'IIII')
+    while True:
+        header = f.read(16)
+        if len(header) < 16:
+            if header:
+                raise CaptureFormatError("レコードヘッダーの途中でファイルが終わっています")
+            return
+        ts_sec, ts_frac, captured_length, original_length = record_header.unpack(header)
+        data = _read_exactly(f, captured_length, "パケットデータ")
+        yield ts_sec + ts_frac / units_per_second, original_length, linktype, memoryview(data)
+
+
+def scan_packets(buffer, no_timestamp=None, chunk=None):
+    """
+    メモリ上のキャプチャ (mmap など) のパケットの位置を先頭から順に返すジェネレーター
+
+    read_packets() と違いパケットデータを切り出さないので、
+    呼び出し側でまとめて (NumPy などで) 処理できる。
+
+    Args:
+        buffer: キャプチャファイル全体の bytes / mmap
+        no_timestamp: タイムスタンプのないパケット (SPB) のタイムスタンプとして返す値
+        chunk: split_capture() が返したチャンク。指定した場合はその範囲のパケットだけを返す
+
+    Yields:
+        (タイムスタンプ(秒, 不明な場合は no_timestamp), 元のフレーム長, リンクタイプ, データの開始位置, キャプチャ長)
+    """
+    if chunk is None:
+        chunk = _whole_capture(buffer)
+        if chunk is None:
+            return
+    start, end, state = chunk
+    if state[0] == FORMAT_PCAPNG:
+        yield from _scan_pcapng(buffer, no_timestamp, start, end, state[1], list(state[2]))
+    else:
+        yield from _scan_pcap(buffer, start, end, *state[1:])
+
+
+def split_capture(buffer, chunk_size):
+    """
+    キャプチャをブロック (レコード) の境界で chunk_size バイト程度のチャンクに分ける
+
+    ブロックヘッダーだけをたどるので、パケットを読むよりずっと速い。
+    各チャンクには、その位置から読み始めるのに必要な情報
+    (エンディアン、それまでに定義されたインターフェースなど) が含まれる。
+
+    Args:
+        buffer: キャプチャファイル全体の bytes / mmap
+        chunk_size: 1チャンクのおおよそのバイト数
+
+    Returns:
+        [(開始位置, 終了位置, 読み込み状態)] のリスト。scan_packets() の chunk に渡す
+    """
+    chunk = _whole_capture(buffer)
+    if chunk is None:
+        return []
+    start, size, state = chunk
+    chunks = []
+    pos = start
+
+    if state[0] == FORMAT_PCAPNG:
+        endian = state[1]
+        interfaces = []
+        block_header = struct.Struct(endian + 'II')
+        while pos + 12 <= size:
+            block_type, block_length = block_header.unpack_from(buffer, pos)
+            if block_type == BLOCK_TYPE_SHB:
+                endian = _pcapng_endian(buffer, pos + 8)
+                block_header = struct.Struct(endian + 'II')
+                interfaces = []
+                block_length = block_header.unpack_from(buffer, pos)[1]
+            # 不正なブロックは scan_packets() で例外にする
+            if block_length < 12 or block_length % 4 or pos + block_length > size:
+                break
+            if block_type == BLOCK_TYPE_IDB:
+                interfaces.append(_parse_idb(memoryview(buffer)[pos + 8:pos + block_length - 4], endian))
+            pos += block_length
+            if pos - start >= chunk_size and pos < size:
+                chunks.append((start, pos, state))
+                start = pos
+                state = (FORMAT_PCAPNG, endian, tuple(interfaces))
+    else:
+        record_length = struct.Struct(state[1] + 'I')
+        while pos + 16 <= size:
+            pos += 16 + record_length.unpack_from(buffer, pos + 8)[0]
+            if pos - start >= chunk_size and pos < size:
+                chunks.append((start, pos, state))
+                start = pos
+
+    chunks.append((start, size, state))
+    return chunks
+
+
+def _whole_capture(buffer):
+    """キャプチャ全体を1つのチャンクとして返す。空のファイルの場合は None"""
+    size = len(buffer)
+    if size < 4:
+        return None
+    magic_value = struct.unpack_from('<I', buffer)[0]
+    if magic_value == BLOCK_TYPE_SHB:
+        # エンディアンは先頭の SHB で決まる
+        return 0, size, (FORMAT_PCAPNG, '<', ())
+    if magic_value in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC, PCAP_MAGIC_USEC_SWAPPED, PCAP_MAGIC_NSEC_SWAPPED):
+        if size < 24:
+            raise CaptureFormatError("pcap ヘッダーの途中でファイルが終わっています")
+        return 24, size, (FORMAT_PCAP,) + _parse_pcap_header(buffer)
+    raise CaptureFormatError(f"pcapng / pcap ファイルではありません (先頭バイト: {bytes(buffer[:4]).hex()})")
+
+
+def _scan_pcapng(buffer, no_timestamp, pos, end, endian, interfaces):
+    """メモリ上の pcapng のブロックを pos から end までたどり、パケットの位置を返す"""
+    size = len(buffer)
+    block_header = struct.Struct(endian + 'II')
+    epb_header = struct.Struct(endian + 'IIIII')
+
+    while pos < end:
+        if pos + 12 > size:
+            raise CaptureFormatError("ブロックヘッダーの途中でファイルが終わっています")
+
+        # SHB のブロックタイプはどちらのエンディアンで読んでも同じ値になる
+        block_type, block_length = block_header.unpack_from(buffer, pos)
+        if block_type == BLOCK_TYPE_SHB:
+            # SHB: バイトオーダーマジックでエンディアンを決める。SHB ごとにインターフェースはリセットされる
+            endian = _pcapng_endian(buffer, pos + 8)
+            block_header = struct.Struct(endian + 'II')
+            epb_header = struct.Struct(endian + 'IIIII')
+            interfaces = []
+            block_length = block_header.unpack_from(buffer, pos)[1]
+
+        if block_length < 12 or block_length % 4:
+            raise CaptureFormatError(f"ブロック長が不正です: {block_length}")
+        if pos + block_length > size:
+            raise CaptureFormatError("ブロックの途中でファイルが終わっています")
+        body = pos + 8
+
+        if block_type == BLOCK_TYPE_EPB:
+            interface_id, ts_high, ts_low, captured_length, original_length = epb_header.unpack_from(buffer, body)
+            if interface_id >= len(interfaces):
+                raise CaptureFormatError(f"未定義のインターフェースID: {interface_id}")
+            linktype, units_per_second, ts_offset = interfaces[interface_id]
+            timestamp = ((ts_high << 32) | ts_low) / units_per_second + ts_offset
+            yield timestamp, original_length, linktype, body + 20, captured_length
+
+        elif block_type == BLOCK_TYPE_SPB:
+            original_length = struct.unpack_from(endian + 'I', buffer, body)[0]
+            captured_length = min(original_length, block_length - 16)
+            yield no_timestamp, original_length, _get_interface(interfaces, 0)[0], body + 4, captured_length
+
+        elif block_type == BLOCK_TYPE_PB:
+            interface_id, _drops, ts_high, ts_low, captured_length, original_length = \
+                struct.unpack_from(endian + 'HHIIII', buffer, body)
+            linktype, units_per_second, ts_offset = _get_interface(interfaces, interface_id)
+            timestamp = ((ts_high << 32) | ts_low) / units_per_second + ts_offset
+            yield timestamp, original_length, linktype, body + 20, captured_length
+
+        elif block_type == BLOCK_TYPE_IDB:
+            interfaces.append(_parse_idb(memoryview(buffer)[body:pos + block_length - 4], endian))
+
+        pos += block_length
+
+
+def _scan_pcap(buffer, pos, end, endian, units_per_second, linktype):
+    """メモリ上の pcap のレコードを pos から end までたどり、パケットの位置を返す"""
+    size = len(buffer)
+    record_header = struct.Struct(endian + 'IIII')
+
+    while pos < end:
+        if pos + 16 > size:
+            raise CaptureFormatError("レコードヘッダーの途中でファイルが終わっています")
+        ts_sec, ts_frac, captured_length, original_length = record_header.unpack_from(buffer, pos)
+        pos += 16
+        if pos + captured_length > size:
+            raise CaptureFormatError("パケットデータの途中でファイルが終わっています")
+        yield ts_sec + ts_frac / units_per_second, original_length, linktype, pos, captured_length
+        pos += captured_length
+
+
+def _pcapng_endian(buffer, offset):
+    """SHB のバイトオーダーマジックからエンディアンを返す"""
+    if struct.unpack_from('<I', buffer, offset)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+        return '<'
+    if struct.unpack_from('>I', buffer, offset)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+        return '>'
+    raise CaptureFormatError("SHB のバイトオーダーマジックが不正です")
+
+
+def _parse_pcap_header(header):
+    """pcap ヘッダー (24バイト) からエンディアン、1秒あたりのタイムスタンプ単位数、リンクタイプを取り出す"""
+    magic_value = struct.unpack_from('<I', header)[0]
+    endian = '<' if magic_value in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC) else '>'
+    units_per_second = 1000000000 if magic_value in (PCAP_MAGIC_NSEC, PCAP_MAGIC_NSEC_SWAPPED) else 1000000
+    # 上位ビットには FCS の情報が入ることがあるので下位16ビットだけを使う
+    linktype = struct.unpack_from(endian + 'I', header, 20)[0] & 0xFFFF
+    return endian, units_per_second, linktype
+
+
+def decode_flow(linktype, data):
+    """
+    パケットデータのヘッダーをデコードして接続のキーを返す
+
+    Args:
+        linktype: リンクタイプ
+        data: パケットデータ (bytes または memoryview)
+
+    Returns:
+        (送信元IP, 送信元ポート, 宛先IP, 宛先ポート, プロトコル)。IPパケットでない場合は None
+        TCP/UDP 以外のパケットでは、ポートは '-'、プロトコルはプロトコル番号の文字列になる
+    """
+    ethertype, offset = _decode_link(linktype, data)
+    if ethertype == ETHERTYPE_IPV4:
+        return _decode_ipv4(data, offset)
+    if ethertype == ETHERTYPE_IPV6:
+        return _decode_ipv6(data, offset)
+    return None
+
+
+def decode_segment(linktype, data, length):
+    """
+    パケットデータのヘッダーをデコードして、接続のキーとヘッダー・ペイロードの内訳を返す
+
+    フレーム長 = L2 + L3 + L4 + ペイロード になるように分ける。
+    L2 にはリンク層のヘッダーに加えて、IP パケットの後ろのパディング・トレーラーも含まれる。
+
+    Args:
+        linktype: リンクタイプ
+        data: パケットデータ (bytes または memoryview)
+        length: 元のフレーム長
+
+    Returns:
+        (送信元IP, 送信元ポート, 宛先IP, 宛先ポート, プロトコル,
+         L2 バイト数, L3 (IP ヘッダー) バイト数, L4 (TCP/UDP ヘッダー) バイト数, ペイロードのバイト数,
+         TCP のシーケンス番号 (TCP 以外や読めない場合は None), TCP フラグ)
+        IPパケットでない場合は None
+    """
+    ethertype, offset = _decode_link(linktype, data)
+    if ethertype == ETHERTYPE_IPV4:
+        if len(data) < offset + 20:
+            return None
+        header_length = (data[offset] & 0x0F) * 4
+        declared_length = _U16_BE.unpack_from(data, offset + 2)[0]
+    elif ethertype == ETHERTYPE_IPV6:
+        if len(data) < offset + 40:
+            return None
+        header_length = None
+        payload_length = _U16_BE.unpack_from(data, offset + 4)[0]
+        declared_length = 40 + payload_length if payload_length else 0
+    else:
+        return None
+
+    key = _decode_ipv4(data, offset) if ethertype == ETHERTYPE_IPV4 else _decode_ipv6(data, offset)
+    if header_length is None:
+        header_length = _ipv6_header_length(data, offset)
+    # IP パケットの長さ (0 の場合 (TSO など) やフレームを超える場合はフレームの残り全部)
+    frame_rest = max(length - offset, 0)
+    ip_length = min(declared_length, frame_rest) if declared_length else frame_rest
+    l3_bytes = min(header_length, ip_length)
+    rest = ip_length - l3_bytes
+
+    l4_bytes = 0
+    seq = None
+    flags = 0
+    if key[1] != '-':
+        l4 = offset + header_length
+        if key[4] == 'UDP':
+            l4_bytes = min(8, rest)
+        elif len(data) >= l4 + 14:
+            seq = _U32_BE.unpack_from(data, l4 + 4)[0]
+            flags = data[l4 + 13]
+            l4_bytes = min((data[l4 + 12] >> 4) * 4, rest)
+        else:
+            # データオフセットまでキャプチャされていない場合は最小のヘッダー長とする
+            l4_bytes = min(20, rest)
+    return key + (length - ip_length, l3_bytes, l4_bytes, rest - l4_bytes, seq, flags)
+
+
+def _decode_link(linktype, data):
+    """
+    リンク層のヘッダーをデコードする
+
+    Returns:
+        (EtherType, ネットワーク層の開始位置)。IP でない場合は (None, None)
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None, None
+        ethertype = _U16_BE.unpack_from(data, 12)[0]
+        offset = 14
+        # VLAN タグ (多重タグも含む) を読み飛ばす
+        while ethertype in ETHERTYPE_VLAN and len(data) >= offset + 4:
+            ethertype = _U16_BE.unpack_from(data, offset + 2)[0]
+            offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16:
+            return None, None
+        ethertype = _U16_BE.unpack_from(data, 14)[0]
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(data) < 20:
+            return None, None
+        ethertype = _U16_BE.unpack_from(data, 0)[0]
+        offset = 20
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        if len(data) < 4:
+            return None, None
+        # NULL はキャプチャしたホストのバイトオーダーなので、どちらの端の値でも判定する
+        family = data[0] or data[3]
+        if family == NULL_FAMILY_IPV4:
+            ethertype = ETHERTYPE_IPV4
+        elif family in NULL_FAMILY_IPV6:
+            ethertype = ETHERTYPE_IPV6
+        else:
+            return None, None
+        offset = 4
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        if len(data) < 1:
+            return None, None
+        version = data[0] >> 4
+        ethertype = ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6 if version == 6 else None
+        offset = 0
+    else:
+        return None, None
+
+    return ethertype, offset
+
+
+def _decode_ipv4(data, offset):
+    if len(data) < offset + 20:
+        return None
+    header_length = (data[offset] & 0x0F) * 4
+    # フラグメントオフセットが0でない (2番目以降の) フラグメントにはポートがない
+    first_fragment = (_U16_BE.unpack_from(data, offset + 6)[0] & 0x1FFF) == 0
+    protocol = data[offset + 9]
+    src, dst = _IPV4_ADDRS.unpack_from(data, offset + 12)
+    return _decode_transport(data, offset + header_length, protocol, first_fragment,
+                             format_address(socket.AF_INET, src), format_address(socket.AF_INET, dst))
+
+
+def _decode_ipv6(data, offset):
+    if len(data) < offset + 40:
+        return None
+    next_header = data[offset + 6]
+    src, dst = _IPV6_ADDRS.unpack_from(data, offset + 8)
+    offset += 40
+    first_fragment = True
+    # 拡張ヘッダーをたどって上位プロトコルを探す
+    while len(data) >= offset + 8:
+        if next_header in IPV6_EXTENSION_HEADERS:
+            header_length = (data[offset + 1] + 1) * 8
+        elif next_header == IPV6_FRAGMENT_HEADER:
+            first_fragment = (_U16_BE.unpack_from(data, offset + 2)[0] & 0xFFF8) == 0
+            header_length = 8
+        elif next_header == IPV6_AUTH_HEADER:
+            header_length = (data[offset + 1] + 2) * 4
+        else:
+            break
+        next_header = data[offset]
+        offset += header_length
+    return _decode_transport(data, offset, next_header, first_fragment,
+                             format_address(socket.AF_INET6, src), format_address(socket.AF_INET6, dst))
+
+
+def _ipv6_header_length(data, offset):
+    """IPv6 ヘッダーと拡張ヘッダーの合計の長さ"""
+    next_header = data[offset + 6]
+    start = offset
+    offset += 40
+    while len(data) >= offset + 8:
+        if next_header in IPV6_EXTENSION_HEADERS:
+            header_length = (data[offset + 1] + 1) * 8
+        elif next_header == IPV6_FRAGMENT_HEADER:
+            header_length = 8
+        elif next_header == IPV6_AUTH_HEADER:
+            header_length = (data[offset + 1] + 2) * 4
+        else:
+            break
+        next_header = data[offset]
+        offset += header_length
+    return offset - start
+
+
+def _decode_transport(data, offset, protocol, first_fragment, src_ip, dst_ip):
+    if protocol in (IP_PROTO_TCP, IP_PROTO_UDP) and first_fragment and len(data) >= offset + 4:
+        src_port, dst_port = _PORTS.unpack_from(data, offset)
+        return src_ip, src_port, dst_ip, dst_port, 'TCP' if protocol == IP_PROTO_TCP else 'UDP'
+    return src_ip, '-', dst_ip, '-', str(protocol)
+
+
+def format_address(family, packed):
+    """パックされたアドレスを文字列にする (結果はキャッシュする)"""
+    address = _address_cache.get(packed)
+    if address is None:
+        if len(_address_cache) >= _ADDRESS_CACHE_SIZE:
+            _address_cache.clear()
+        address = socket.inet_ntop(family, packed)
+        _address_cache[packed] = address
+    return address
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+サーバー・クライアントの表示と記録をメッセージの処理から切り離すモジュール
+
+- IntervalReporter: 一定間隔で集計済みの値から1行を作って表示するバックグラウンドスレッド
+- TraceWriter: メッセージごとの記録を溜めておき、バックグラウンドスレッドでまとめて CSV に書き出す
+
+メッセージを処理するループでは数値を加算・追加するだけにし、文字列の組み立てや出力は行わない。
+"""
+
+import csv
+import threading
+from collections import deque
+
+# IntervalReporter の既定の表示間隔 (秒)
+REPORT_INTERVAL = 1.0
+# TraceWriter がファイルに書き出す間隔 (秒)
+TRACE_FLUSH_INTERVAL = 0.5
+# TraceWriter のファイルのバッファーサイズ
+TRACE_BUFFER_SIZE = 1024 * 1024
+
+
+class IntervalReporter:
+    """
+    interval 秒ごとに report() を呼び、返された文字列を表示する
+
+    Args:
+        interval: 表示間隔 (秒)
+        report: 表示する1行を返す関数 (None を返した場合は表示しない)
+    """
+
+    def __init__(self, interval, report):
+        self.interval = interval
+        self.report = report
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='interval-reporter', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            line = self.report()
+            if line is not None:
+                print(line, flush=True)
+
+
+class TraceWriter:
+    """
+    メッセージごとの記録を CSV ファイルに書き出す
+
+    record() は行をキューに追加するだけで、整形と書き込みはバックグラウンドのスレッドで
+    TRACE_FLUSH_INTERVAL 秒ごとにまとめて行う。
+
+    Args:
+        path: 出力先の CSV ファイル
+        columns: 列名
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self._file = open(path, 'w', newline='', encoding='utf-8', buffering=TRACE_BUFFER_SIZE)
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+        # deque の append / popleft はスレッドセーフ
+        self._rows = deque()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+        self._thread.start()
+
+    def record(self, *row):
+        """1メッセージ分の記録を追加する"""
+        self._rows.append(row)
+
+    def close(self):
+        """残りの記録を書き出してファイルを閉じる"""
+        self._stopped.set()
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        while not self._stopped.wait(TRACE_FLUSH_INTERVAL):
+            self._drain()
+        self._drain()
+
+    def _drain(self):
+        rows = self._rows
+        batch = [rows.popleft() for _ in range(len(rows))]
+        if batch:
+            self._writer.writerows(batch)
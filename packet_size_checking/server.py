@@ -1,111 +1,558 @@
+import argparse
+import selectors
 import socket
 import threading
 import time
+from collections import deque
 from datetime import datetime
 
+from latency_histogram import LatencyHistogram
+from latency_histogram import format_summary
+from reporting import REPORT_INTERVAL
+from reporting import IntervalReporter
+from reporting import TraceWriter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 HOST = '127.0.0.1'
 PORT = 12345
 
-class ServerStats:
+# メッセージの長さヘッダーのバイト数
+HEADER_SIZE = 4
+# 接続ごとの受信バッファーの初期サイズ (これより大きいメッセージを受信したときに広げる)
+RECV_BUFFER_SIZE = 16 * 1024
+# 受け付けるメッセージ本体の最大サイズ (長さヘッダーがこれを超える接続は切断する)
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+MODE_THREAD = 'thread'
+MODE_SELECTOR = 'selector'
+
+# 統計情報の表示間隔 (秒)
+STATS_INTERVAL = 10
+# 統計情報に表示するクライアント数 (受信量の多い順)
+STATS_TOP_CLIENTS = 5
+# 内訳を残しておく切断したクライアントの数
+MAX_CLOSED_CLIENTS = 1000
+
+# --trace で出力するメッセージごとの記録の列
+TRACE_COLUMNS = ('time_ns', 'client', 'received', 'sent', 'latency_ns')
+
+class StatsShard:
+    """
+    1スレッド分の統計情報
+
+    更新するのは持ち主のスレッドだけなので、メッセージごとの更新ではロックを取らない。
+    他のスレッドからは ServerStats を通して値を読むだけにする。
+
+    clients: クライアントごとの内訳 {クライアント ('IP:ポート'): [メッセージ数, 受信量, 送信量]}
+    """
     def __init__(self):
         self.total_received = 0
         self.total_sent = 0
         self.message_count = 0
+        # 受信し終えてから送り返し終えるまでの時間 (ナノ秒): 全体と、前回 take_window() 以降
+        self.latency = LatencyHistogram()
+        self.window_latency = LatencyHistogram()
+        # window_latency に記録している間は True (take_window() が入れ替え前の区間への記録を待つ)
+        self.recording = False
+        self.clients = {}
+
+    def add_stats(self, client, received, sent, latency_ns=None):
+        self.total_received += received
+        self.total_sent += sent
+        self.message_count += 1
+        counts = self.clients[client]
+        counts[0] += 1
+        counts[1] += received
+        counts[2] += sent
+        if latency_ns is not None:
+            self.latency.record(latency_ns)
+            # recording を立ててから区間を読むので、入れ替えの後に始まった記録は新しい区間に入る
+            self.recording = True
+            self.window_latency.record(latency_ns)
+            self.recording = False
+
+    def merge(self, other):
+        """別のシャードの値を加える (クライアントごとの内訳は加えない)"""
+        self.total_received += other.total_received
+        self.total_sent += other.total_sent
+        self.message_count += other.message_count
+        self.latency.merge(other.latency)
+        self.window_latency.merge(other.window_latency)
+
+class ServerStats:
+    """
+    サーバー全体の統計情報
+
+    値はスレッドごとのシャード (StatsShard) に分けて持ち、読み出すとき (get_stats() など) に合計する。
+    lock を取るのはシャードの登録・解放と接続・切断のときと、読み出すときだけ。
+    終了したスレッドのシャードと切断したクライアントの内訳は retired / closed_clients に移す。
+    """
+    def __init__(self):
+        self.shards = []
+        self.retired = StatsShard()
+        # 切断したクライアントの内訳 (新しいものから MAX_CLOSED_CLIENTS 件): (クライアント, メッセージ数, 受信量, 送信量)
+        self.closed_clients = deque(maxlen=MAX_CLOSED_CLIENTS)
+        self.connects = 0
+        self.disconnects = 0
         self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def get_shard(self):
+        """呼び出したスレッドのシャード (最初の呼び出しで作成して登録する)"""
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = StatsShard()
+            with self.lock:
+                self.shards.append(shard)
+        return shard
 
-    def add_stats(self, received, sent):
+    def release_shard(self):
+        """呼び出したスレッドのシャードを retired に移す (スレッドの終了時に呼ぶ)"""
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            return
+        del self._local.shard
         with self.lock:
-            self.total_received += received
-            self.total_sent += sent
-            self.message_count += 1
+            self.shards.remove(shard)
+            self.retired.merge(shard)
+
+    def add_connection(self, client):
+        """クライアントの接続を記録し、そのクライアントの統計を更新するシャードを返す"""
+        shard = self.get_shard()
+        shard.clients[client] = [0, 0, 0]
+        with self.lock:
+            self.connects += 1
+        return shard
+
+    def remove_connection(self, shard, client):
+        """クライアントの切断を記録する (接続を処理していたスレッドから呼ぶ)"""
+        counts = shard.clients.pop(client)
+        with self.lock:
+            self.disconnects += 1
+            self.closed_clients.append((client, *counts))
 
     def get_stats(self):
+        """(総受信量, 総送信量, メッセージ数)"""
+        with self.lock:
+            shards = list(self.shards)
+            received, sent, count = self.retired.total_received, self.retired.total_sent, self.retired.message_count
+        for shard in shards:
+            received += shard.total_received
+            sent += shard.total_sent
+            count += shard.message_count
+        return received, sent, count
+
+    def get_connections(self):
+        """(接続中のクライアント数, 接続の回数, 切断の回数)"""
+        with self.lock:
+            return self.connects - self.disconnects, self.connects, self.disconnects
+
+    def get_latency(self):
+        """全シャードの応答時間を統合したヒストグラム"""
+        total = LatencyHistogram()
         with self.lock:
-            return self.total_received, self.total_sent, self.message_count
+            shards = list(self.shards)
+            total.merge(self.retired.latency)
+        for shard in shards:
+            total.merge(shard.latency)
+        return total
+
+    def take_window(self):
+        """
+        前回呼び出してからの応答時間のヒストグラムを返し、次の区間を始める
+
+        シャードの区間を入れ替えた後、持ち主のスレッドが入れ替え前の区間に記録し終えるのを待ってから統合する。
+        """
+        window = LatencyHistogram()
+        windows = []
+        # release_shard() が入れ替え前の区間を retired に移さないよう、入れ替えは lock を取って行う
+        with self.lock:
+            shards = list(self.shards)
+            window, self.retired.window_latency = self.retired.window_latency, window
+            for shard in shards:
+                windows.append(shard.window_latency)
+                shard.window_latency = LatencyHistogram()
+        # 入れ替えの前から記録していたスレッドが記録し終えるのを待つ
+        for shard in shards:
+            while shard.recording:
+                time.sleep(0)
+        for shard_window in windows:
+            window.merge(shard_window)
+        return window
+
+    def get_clients(self):
+        """
+        クライアントごとの内訳 (接続中のクライアントと、切断した最近のクライアント)
+
+        Returns:
+            [(クライアント, メッセージ数, 受信量, 送信量, 接続中か)]
+        """
+        with self.lock:
+            shards = list(self.shards)
+            clients = [(client, messages, received, sent, False)
+                       for client, messages, received, sent in self.closed_clients]
+        for shard in shards:
+            # 持ち主のスレッドが追加・削除している間に反復しないよう、まとめて list にする
+            for client, (messages, received, sent) in list(shard.clients.items()):
+                clients.append((client, messages, received, sent, True))
+        return clients
+
+def print_top_clients(stats, indent=''):
+    """受信量の多いクライアントを STATS_TOP_CLIENTS 件まで表示する"""
+    clients = sorted(stats.get_clients(), key=lambda client: client[2], reverse=True)[:STATS_TOP_CLIENTS]
+    if not clients:
+        return
+    print(f"{indent}受信量の多いクライアント:")
+    for client, messages, received, sent, connected in clients:
+        print(f"{indent}  {client}: メッセージ数 {messages:,}, 受信 {received:,} バイト, 送信 {sent:,} バイト"
+              f"{'' if connected else ' (切断済み)'}")
 
-def handle_client(conn, addr, stats):
-    """クライアント接続を処理"""
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] クライアント接続: {addr}")
+def get_frame_size(header):
+    """長さヘッダーからメッセージ全体 (ヘッダーを含む) のサイズを求める (最大サイズを超える場合は ValueError)"""
+    message_size = int.from_bytes(header, 'big')
+    if message_size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"メッセージが大きすぎます: {message_size:,} バイト (最大: {MAX_MESSAGE_SIZE:,} バイト)")
+    return HEADER_SIZE + message_size
 
+def recv_exactly(conn, view):
+    """view の長さ分を受信する (途中で切断された場合は False)"""
+    received = 0
+    while received < len(view):
+        size = conn.recv_into(view[received:])
+        if size == 0:
+            return False
+        received += size
+    return True
+
+def handle_client(conn, addr, stats, trace=None, verbose=False):
+    """
+    クライアント接続を処理
+
+    メッセージごとの表示は verbose の場合だけ行い、trace を指定した場合はメッセージごとの記録を渡す
+    """
+    client = f"{addr[0]}:{addr[1]}"
+    shard = stats.add_connection(client)
+    if verbose:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] クライアント接続: {addr}")
+
+    # 長さヘッダーとメッセージ本体を同じバッファーに受信し、そのまま送り返す
+    buffer = bytearray(RECV_BUFFER_SIZE)
+    view = memoryview(buffer)
     try:
         while True:
             # メッセージの長さを受信 (4バイト)
-            length_data = conn.recv(4)
-            if not length_data:
+            if not recv_exactly(conn, view[:HEADER_SIZE]):
                 break
 
-            msg_length = int.from_bytes(length_data, 'big')
+            frame_size = get_frame_size(view[:HEADER_SIZE])
+            if frame_size > len(buffer):
+                view.release()
+                buffer.extend(bytes(frame_size - len(buffer)))
+                view = memoryview(buffer)
 
             # メッセージ本体を受信
-            data = b''
-            while len(data) < msg_length:
-                chunk = conn.recv(min(msg_length - len(data), 4096))
-                if not chunk:
-                    break
-                data += chunk
-
-            if not data:
+            if not recv_exactly(conn, view[HEADER_SIZE:frame_size]):
                 break
+            received_at = time.perf_counter_ns()
 
-            received_size = len(length_data) + len(data)
+            received_size = frame_size
 
             # 受信したデータをそのまま送り返す（エコー）
-            conn.sendall(length_data + data)
+            conn.sendall(view[:frame_size])
             sent_size = received_size
 
             # 統計情報を更新
-            stats.add_stats(received_size, sent_size)
-
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] {addr} - 受信: {received_size}バイト, 送信: {sent_size}バイト")
+            latency = time.perf_counter_ns() - received_at
+            shard.add_stats(client, received_size, sent_size, latency)
+            if trace is not None:
+                trace.record(time.time_ns(), client, received_size, sent_size, latency)
+            if verbose:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] {addr} - 受信: {received_size}バイト, 送信: {sent_size}バイト")
 
     except Exception as e:
         print(f"[{datetime.now().strftime('%H:%M:%S')}] エラー ({addr}): {e}")
     finally:
+        view.release()
         conn.close()
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] クライアント切断: {addr}")
+        stats.remove_connection(shard, client)
+        stats.release_shard()
+        if verbose:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] クライアント切断: {addr}")
+
+class EchoConnection:
+    """
+    イベントループで処理するクライアント接続
+
+    受信バッファーに溜まった完全なメッセージをまとめてそのまま送り返す。
+    送信しきれない間は受信を止める (送り返すまでクライアントからの受信を待たせる)。
+    """
+    def __init__(self, conn, addr, stats, trace=None, verbose=False):
+        self.conn = conn
+        self.addr = addr
+        self.client = f"{addr[0]}:{addr[1]}"
+        self.stats = stats
+        self.shard = stats.add_connection(self.client)
+        self.trace = trace
+        self.verbose = verbose
+        self.buffer = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        # 受信済みのバイト数
+        self.filled = 0
+        # 送り返す完全なメッセージの終わりの位置と、そのうち送信済みのバイト数
+        self.pending = 0
+        self.sent = 0
+        # 送り返すメッセージのサイズと、それらを受信し終えた時刻 (perf_counter_ns)
+        self.frames = []
+        self.received_at = 0
+
+    def on_readable(self):
+        """
+        受信して、完全なメッセージを送り返す
+
+        Returns:
+            接続を続けるか (切断された場合は False)
+
+        Raises:
+            ValueError: 長さヘッダーが MAX_MESSAGE_SIZE を超えている
+        """
+        try:
+            size = self.conn.recv_into(self.view[self.filled:])
+        except (BlockingIOError, InterruptedError):
+            return True
+        if size == 0:
+            return False
+        self.filled += size
+
+        # 完全なメッセージの終わりまでを送り返す (エコーなので受信したバイト列のまま)
+        position = 0
+        while self.filled - position >= HEADER_SIZE:
+            frame_size = get_frame_size(self.view[position:position + HEADER_SIZE])
+            if self.filled - position < frame_size:
+                if frame_size > len(self.buffer):
+                    self._grow(frame_size)
+                break
+            self.frames.append(frame_size)
+            position += frame_size
+        if self.frames:
+            self.received_at = time.perf_counter_ns()
+        self.pending = position
+        return True
+
+    def flush(self):
+        """
+        送り返すデータを送信し、送り終えたメッセージを統計情報に加える
+
+        Returns:
+            すべて送信できたか
+        """
+        while self.sent < self.pending:
+            try:
+                self.sent += self.conn.send(self.view[self.sent:self.pending])
+            except (BlockingIOError, InterruptedError):
+                return False
+        if self.frames:
+            latency = time.perf_counter_ns() - self.received_at
+            for frame_size in self.frames:
+                self.shard.add_stats(self.client, frame_size, frame_size, latency)
+            if self.trace is not None:
+                now = time.time_ns()
+                for frame_size in self.frames:
+                    self.trace.record(now, self.client, frame_size, frame_size, latency)
+            if self.verbose:
+                for frame_size in self.frames:
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] {self.addr} - 受信: {frame_size}バイト, 送信: {frame_size}バイト")
+            self.frames.clear()
+        # 途中まで受信したメッセージをバッファーの先頭に移す
+        rest = self.filled - self.pending
+        if rest and self.pending:
+            self.view[:rest] = self.buffer[self.pending:self.filled]
+        self.filled = rest
+        self.pending = self.sent = 0
+        return True
+
+    def close(self):
+        self.view.release()
+        self.conn.close()
+        self.stats.remove_connection(self.shard, self.client)
+
+    def _grow(self, size):
+        self.view.release()
+        self.buffer.extend(bytes(size - len(self.buffer)))
+        self.view = memoryview(self.buffer)
+
+def raise_file_limit():
+    """同時接続数の上限になるファイルディスクリプタ数の上限を引き上げる (可能な場合)"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+def serve_selector(server_socket, stats, trace=None, verbose=False):
+    """selectors のイベントループで全クライアントを1スレッドで処理"""
+    selector = selectors.DefaultSelector()
+    server_socket.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ, None)
+    try:
+        while True:
+            for key, events in selector.select():
+                connection = key.data
+                if connection is None:
+                    accept_clients(server_socket, selector, stats, trace, verbose)
+                    continue
+                try:
+                    if events & selectors.EVENT_READ:
+                        alive = connection.on_readable()
+                    else:
+                        alive = True
+                    if alive:
+                        # 送信しきれない間は受信を止めて書き込み可能になるのを待つ
+                        event = selectors.EVENT_READ if connection.flush() else selectors.EVENT_WRITE
+                        if event != key.events:
+                            selector.modify(connection.conn, event, connection)
+                except Exception as e:
+                    # 1つの接続のエラー (大きすぎるメッセージ、MemoryError など) で他の接続を止めない
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] エラー ({connection.addr}): {e}")
+                    alive = False
+                if not alive:
+                    selector.unregister(connection.conn)
+                    connection.close()
+                    if verbose:
+                        print(f"[{datetime.now().strftime('%H:%M:%S')}] クライアント切断: {connection.addr}")
+    finally:
+        for key in list(selector.get_map().values()):
+            if key.data is not None:
+                key.data.close()
+        selector.close()
+
+def accept_clients(server_socket, selector, stats, trace, verbose):
+    """接続待ちのクライアントをすべて受け付ける"""
+    while True:
+        try:
+            conn, addr = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # ファイルディスクリプタ不足などは次の接続で再試行する
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 接続受付エラー: {e}")
+            return
+        conn.setblocking(False)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        selector.register(conn, selectors.EVENT_READ, EchoConnection(conn, addr, stats, trace, verbose))
+        if verbose:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] クライアント接続: {addr}")
 
 def stats_monitor(stats):
-    """定期的に統計情報を表示"""
+    """定期的に統計情報を表示 (レートと応答時間は直近の区間の値)"""
     start_time = time.time()
+    previous_time = start_time
+    previous_received, previous_sent, previous_count = 0, 0, 0
 
     while True:
-        time.sleep(10)
+        time.sleep(STATS_INTERVAL)
         received, sent, count = stats.get_stats()
-        elapsed = time.time() - start_time
+        window_latency = stats.take_window()
+        now = time.time()
+        elapsed = now - start_time
+        interval = now - previous_time
 
         print(f"\n=== 統計情報 (稼働時間: {elapsed:.1f}秒) ===")
         print(f"メッセージ数: {count}")
         print(f"総受信量: {received:,} バイト ({received/1024:.2f} KB)")
         print(f"総送信量: {sent:,} バイト ({sent/1024:.2f} KB)")
-        print(f"平均レート: 受信 {received/elapsed:.1f} バイト/秒, 送信 {sent/elapsed:.1f} バイト/秒")
+        print(f"直近{interval:.0f}秒のレート: {(count - previous_count)/interval:.1f} メッセージ/秒, "
+              f"受信 {(received - previous_received)/interval:.1f} バイト/秒, "
+              f"送信 {(sent - previous_sent)/interval:.1f} バイト/秒")
+        print(f"直近{interval:.0f}秒の応答時間: {format_summary(window_latency)}")
+        print_top_clients(stats)
         print("=" * 50 + "\n")
+        previous_time = now
+        previous_received, previous_sent, previous_count = received, sent, count
+
+def make_report(stats):
+    """
+    IntervalReporter に渡す、前回の表示からの変化を1行にする関数を作る
+
+    メッセージも接続・切断もなかった区間は表示しない
+    """
+    previous_stats = stats.get_stats()
+    previous_connections = stats.get_connections()
+    previous_time = time.time()
+
+    def report():
+        nonlocal previous_stats, previous_connections, previous_time
+        received, sent, count = stats.get_stats()
+        active, connects, disconnects = stats.get_connections()
+        now = time.time()
+        previous_received, previous_sent, previous_count = previous_stats
+        _previous_active, previous_connects, previous_disconnects = previous_connections
+        interval = now - previous_time
+        previous_stats = received, sent, count
+        previous_connections = active, connects, disconnects
+        previous_time = now
+
+        if count == previous_count and connects == previous_connects and disconnects == previous_disconnects:
+            return None
+        messages = count - previous_count
+        return (f"[{datetime.now().strftime('%H:%M:%S')}] 接続中: {active} "
+                f"(+{connects - previous_connects}/-{disconnects - previous_disconnects}), "
+                f"メッセージ: {messages:,} ({messages / interval:,.1f}/秒), "
+                f"受信: {(received - previous_received) / 1024 / interval:,.1f} KB/秒, "
+                f"送信: {(sent - previous_sent) / 1024 / interval:,.1f} KB/秒")
+    return report
 
 def main():
+    parser = argparse.ArgumentParser(description="TCPエコーサーバー")
+    parser.add_argument('--host', default=HOST, help=f"待受アドレス (既定: {HOST})")
+    parser.add_argument('--port', type=int, default=PORT, help=f"待受ポート (既定: {PORT})")
+    parser.add_argument('--mode', choices=(MODE_THREAD, MODE_SELECTOR), default=MODE_THREAD,
+                        help="thread: 接続ごとにスレッド, selector: イベントループで多数の接続を1スレッドで処理")
+    parser.add_argument('--report-interval', type=float, default=REPORT_INTERVAL,
+                        help=f"メッセージ数・接続数の変化をまとめて表示する間隔 (秒, 既定: {REPORT_INTERVAL:g})")
+    parser.add_argument('--trace', help="メッセージごとの記録を出力する CSV ファイル")
+    parser.add_argument('-v', '--verbose', action='store_true', help="メッセージごと・接続ごとに表示する")
+    args = parser.parse_args()
+
     stats = ServerStats()
+    trace = TraceWriter(args.trace, TRACE_COLUMNS) if args.trace else None
 
     # 統計情報モニタースレッドを起動
     monitor_thread = threading.Thread(target=stats_monitor, args=(stats,), daemon=True)
     monitor_thread.start()
+    reporter = IntervalReporter(args.report_interval, make_report(stats))
+    reporter.start()
 
     # サーバーソケットを作成
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((HOST, PORT))
-        server_socket.listen(5)
+        server_socket.bind((args.host, args.port))
 
-        print(f"サーバー起動: {HOST}:{PORT}")
+        print(f"サーバー起動: {args.host}:{args.port} (モード: {args.mode})")
         print("クライアントからの接続を待機中...\n")
 
         try:
-            while True:
-                conn, addr = server_socket.accept()
-                # 各クライアント接続を別スレッドで処理
-                client_thread = threading.Thread(
-                    target=handle_client,
-                    args=(conn, addr, stats),
-                    daemon=True
-                )
-                client_thread.start()
+            if args.mode == MODE_SELECTOR:
+                raise_file_limit()
+                server_socket.listen(socket.SOMAXCONN)
+                serve_selector(server_socket, stats, trace, args.verbose)
+            else:
+                server_socket.listen(5)
+                while True:
+                    conn, addr = server_socket.accept()
+                    # 各クライアント接続を別スレッドで処理
+                    client_thread = threading.Thread(
+                        target=handle_client,
+                        args=(conn, addr, stats, trace, args.verbose),
+                        daemon=True
+                    )
+                    client_thread.start()
         except KeyboardInterrupt:
             print("\n\nサーバーを停止しています...")
             received, sent, count = stats.get_stats()
@@ -113,6 +560,13 @@ def main():
             print(f"  メッセージ数: {count}")
             print(f"  総受信量: {received:,} バイト")
             print(f"  総送信量: {sent:,} バイト")
+            print(f"  応答時間: {format_summary(stats.get_latency())}")
+            print_top_clients(stats, indent='  ')
+        finally:
+            reporter.stop()
+            if trace is not None:
+                trace.close()
+                print(f"  メッセージごとの記録: {args.trace}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""conversation のテスト (TCP の再送・重複の判定と、NumPy でのまとめての集計)"""
+
+import random
+
+import pytest
+
+from conversation import TCP_FLAG_ACK
+from conversation import TCP_FLAG_FIN
+from conversation import TCP_FLAG_SYN
+from conversation import ConversationTable
+from conversation import DirectionStats
+from flow_aggregator import is_numpy_available
+
+CLIENT = ('10.0.0.1', 1000, '10.0.0.2', 80, 'TCP')
+SERVER = ('10.0.0.2', 80, '10.0.0.1', 1000, 'TCP')
+
+
+def add_segments(direction, segments):
+    for seq, payload, flags in segments:
+        direction.add_segment(seq, payload, flags)
+    return direction
+
+
+def counts(direction):
+    return direction.retransmitted_segments, direction.duplicate_segments, direction.retransmitted_bytes
+
+
+def test_new_data_is_not_retransmitted():
+    direction = add_segments(DirectionStats(), [(100, 0, TCP_FLAG_SYN), (101, 10, TCP_FLAG_ACK),
+                                                (111, 10, TCP_FLAG_ACK), (121, 0, TCP_FLAG_FIN)])
+    assert counts(direction) == (0, 0, 0)
+    assert direction.highest_end == 122
+
+
+def test_retransmission_counts_overlapping_bytes():
+    """それまでに送られた範囲と重なったバイト数だけが再送バイト数になる"""
+    direction = add_segments(DirectionStats(), [(1, 10, TCP_FLAG_ACK), (11, 10, TCP_FLAG_ACK),
+                                                (6, 10, TCP_FLAG_ACK), (16, 10, TCP_FLAG_ACK)])
+    assert counts(direction) == (2, 0, 15)
+
+
+def test_same_segment_twice_is_duplicate():
+    """直前と同じシーケンス番号・長さのセグメントは重複"""
+    direction = add_segments(DirectionStats(), [(1, 10, TCP_FLAG_ACK), (1, 10, TCP_FLAG_ACK),
+                                                (11, 10, TCP_FLAG_ACK), (1, 10, TCP_FLAG_ACK)])
+    assert counts(direction) == (1, 1, 20)
+
+
+def test_sequence_number_wraps_around():
+    direction = add_segments(DirectionStats(), [(0xFFFFFFF0, 16, TCP_FLAG_ACK), (0, 16, TCP_FLAG_ACK),
+                                                (0xFFFFFFF8, 16, TCP_FLAG_ACK)])
+    assert counts(direction) == (1, 0, 16)
+
+
+def test_keepalives_are_not_retransmissions():
+    """最大値 - 1 の ACK だけのセグメントはキープアライブで、直前のセグメントとしても扱わない"""
+    direction = add_segments(DirectionStats(), [(1, 10, TCP_FLAG_ACK), (10, 1, TCP_FLAG_ACK), (10, 0, TCP_FLAG_ACK),
+                                                (1, 10, TCP_FLAG_ACK), (10, 1, TCP_FLAG_ACK | TCP_FLAG_FIN)])
+    assert (direction.keepalive_segments, direction.keepalive_bytes) == (2, 1)
+    # キープアライブを挟んでも、同じセグメントの2回目は重複
+    assert counts(direction) == (1, 1, 11)
+
+
+def test_keepalive_at_start_of_capture():
+    """キャプチャが1バイトのキープアライブから始まる場合も、次のキープアライブで数える"""
+    direction = DirectionStats()
+    direction.payload_bytes = 3
+    add_segments(direction, [(565, 1, TCP_FLAG_ACK), (565, 1, TCP_FLAG_ACK), (565, 1, TCP_FLAG_ACK),
+                             (566, 0, TCP_FLAG_ACK | TCP_FLAG_FIN)])
+    assert counts(direction) == (0, 0, 0)
+    assert (direction.keepalive_segments, direction.keepalive_bytes) == (3, 3)
+    assert direction.get_goodput_bytes() == 0
+    # 次がキープアライブでなければ、最初のセグメントはデータ
+    direction = add_segments(DirectionStats(), [(565, 1, TCP_FLAG_ACK), (566, 1, TCP_FLAG_ACK), (566, 1, TCP_FLAG_ACK)])
+    assert (direction.keepalive_segments, direction.keepalive_bytes) == (1, 1)
+
+
+def test_conversation_is_keyed_by_the_connecting_side():
+    """SYN+ACK が最初に見えた場合も、接続した側が会話の A になる"""
+    table = ConversationTable()
+    table.add_packet(1.0, 60, SERVER + (14, 20, 20, 0, 500, TCP_FLAG_SYN | TCP_FLAG_ACK))
+    table.add_packet(2.0, 70, CLIENT + (14, 20, 20, 10, 101, TCP_FLAG_ACK))
+    conversation, = table.conversations.values()
+    assert conversation.key == CLIENT
+    client, server = conversation.directions
+    assert (client.packets, client.payload_bytes, server.packets) == (1, 10, 1)
+    assert conversation.get_duration() == 1.0
+
+
+def random_segments(rng, count):
+    """
+    両方向の、再送・重複・キープアライブ・折り返しを含むセグメント [(キー, シーケンス番号, ペイロード, フラグ)]
+
+    キャプチャの途中から始まったように、キープアライブから始まる方向もある
+    """
+    next_seqs = {CLIENT: rng.choice([0xFFFFFF00, rng.randrange(1 << 32)]), SERVER: rng.randrange(1 << 32)}
+    sent = {CLIENT: [], SERVER: []}
+    segments = []
+    for key in (CLIENT, SERVER):
+        if rng.random() < 0.5:
+            for _ in range(rng.randint(1, 3)):
+                segments.append((key, next_seqs[key], 1, TCP_FLAG_ACK))
+            next_seqs[key] = (next_seqs[key] + 1) % (1 << 32)
+    for _ in range(count):
+        key = rng.choice([CLIENT, SERVER])
+        if rng.random() < 0.1:
+            segments.append((key, (next_seqs[key] - 1) % (1 << 32), rng.choice([0, 1]), TCP_FLAG_ACK))
+            continue
+        if sent[key] and rng.random() < 0.2:
+            seq, payload = rng.choice(sent[key][-5:])
+        else:
+            seq, payload = next_seqs[key], rng.choice([0, 0, 1, 100, 1460])
+            next_seqs[key] = (seq + payload) % (1 << 32)
+            sent[key].append((seq, payload))
+        segments.append((key, seq, payload, TCP_FLAG_ACK))
+    return segments
+
+
+@pytest.mark.skipif(not is_numpy_available(), reason="NumPy がインストールされていない")
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('batch_size', [1, 2, 97])
+def test_add_batch_matches_add_packet(seed, batch_size):
+    """add_batch() を何回かに分けて呼んでも add_packet() を順に呼んだのと同じになる"""
+    import numpy as np
+
+    rng = random.Random(seed)
+    segments = random_segments(rng, 400)
+    expected = ConversationTable()
+    for index, (key, seq, payload, flags) in enumerate(segments):
+        expected.add_packet(float(index), 54 + payload, key + (14, 20, 20, payload, seq, flags))
+
+    actual = ConversationTable()
+    keys = [CLIENT, SERVER]
+    for start in range(0, len(segments), batch_size):
+        batch = segments[start:start + batch_size]
+        payloads = np.array([payload for _, _, payload, _ in batch], dtype=np.int64)
+        columns = {
+            'timestamp': np.arange(start, start + len(batch), dtype=np.float64),
+            'length': 54 + payloads,
+            'l2': np.full(len(batch), 14), 'l3': np.full(len(batch), 20), 'l4': np.full(len(batch), 20),
+            'payload': payloads,
+            'seq': np.array([seq for _, seq, _, _ in batch], dtype=np.int64),
+            'flags': np.array([flags for _, _, _, flags in batch], dtype=np.int64),
+        }
+        actual.add_batch(keys, np.array([keys.index(key) for key, _, _, _ in batch]), columns)
+
+    assert list(actual.conversations) == list(expected.conversations)
+    for key, conversation in expected.conversations.items():
+        assert [vars(d) for d in actual.conversations[key].directions] == [vars(d) for d in conversation.directions]
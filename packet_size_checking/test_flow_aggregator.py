@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""flow_aggregator のテスト (NumPy と1パケットずつの集計、逐次と並列の集計が同じ結果になること)"""
+
+import os
+import random
+
+import pytest
+
+import flow_aggregator
+from flow_aggregator import aggregate_capture
+from test_pcap_reader import build_pcap
+from test_pcap_reader import build_pcapng
+from test_pcap_reader import tcp_packet
+from test_pcap_reader import udp_ipv6_packet
+
+SAMPLE_CAPTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'capture_sample.pcapng')
+
+requires_numpy = pytest.mark.skipif(not flow_aggregator.is_numpy_available(), reason="NumPy がインストールされていない")
+
+
+def generate_packets(seed=1, conversations=20, segments=100):
+    """再送・重複・シーケンス番号の折り返しを含む TCP と UDP のパケット [(タイムスタンプ, フレーム)]"""
+    rng = random.Random(seed)
+    packets = []
+    for index in range(conversations):
+        client = ('10.0.0.1', 1000 + index)
+        server = ('10.0.0.2', 80)
+        client_seq = rng.choice([0xFFFFFF00, rng.randrange(1 << 32)])
+        server_seq = rng.randrange(1 << 32)
+        flows = [(client, server, 0x02, client_seq, 0), (server, client, 0x12, server_seq, 0)]
+        client_seq += 1
+        server_seq += 1
+        sent = []
+        for _ in range(segments):
+            if rng.random() < 0.5:
+                size = rng.choice([0, 100, 1460])
+                flows.append((client, server, 0x10, client_seq, size))
+                sent.append((client_seq, size))
+                client_seq += size
+            else:
+                size = rng.choice([0, 500])
+                flows.append((server, client, 0x10, server_seq, size))
+                server_seq += size
+            if sent and rng.random() < 0.1:
+                flows.append((client, server, 0x10) + rng.choice(sent))
+            if sent and rng.random() < 0.05:
+                flows.append((client, server, 0x10) + sent[-1])
+        flows.append((client, server, 0x11, client_seq, 0))
+        for src, dst, flags, seq, size in flows:
+            packets.append(tcp_packet(src[0], dst[0], src[1], dst[1], seq, flags, b'x' * size))
+        packets.append(udp_ipv6_packet(5353, 53, b'q' * rng.randrange(64)))
+    rng.shuffle(packets)
+    return [(1700000000 + index * 0.01, frame) for index, frame in enumerate(packets)]
+
+
+@pytest.fixture(scope='module')
+def captures(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('captures')
+    packets = generate_packets()
+    paths = {'sample': SAMPLE_CAPTURE}
+    for name, data in [('generated.pcapng', build_pcapng(packets)), ('generated.pcap', build_pcap(packets, '>'))]:
+        path = directory / name
+        path.write_bytes(data)
+        paths[name] = str(path)
+    return paths
+
+
+def flow_table_state(table):
+    """
+    比較用に FlowTable の中身を取り出す
+
+    タイムラインは analyze_pcapng と同じく接続の順を指定して出力した行で比べる
+    (Timeline.flows の並びは集計の仕方によって変わる)
+    """
+    timeline = list(table.timeline.iter_rows(list(table.flows))) if table.timeline is not None else None
+    conversations = None
+    if table.conversations is not None:
+        conversations = {key: [vars(direction) for direction in conversation.directions]
+                         for key, conversation in table.conversations.conversations.items()}
+    return list(table.flows.items()), table.total_packets, timeline, conversations
+
+
+@requires_numpy
+@pytest.mark.parametrize('name', ['sample', 'generated.pcapng', 'generated.pcap'])
+@pytest.mark.parametrize('bucket_seconds, conversations', [(None, False), (0.5, False), (None, True)])
+def test_numpy_matches_pure_python(captures, name, bucket_seconds, conversations):
+    """NumPy での集計が1パケットずつの集計と同じになる"""
+    expected = aggregate_capture(captures[name], use_numpy=False, bucket_seconds=bucket_seconds,
+                                 conversations=conversations)
+    actual = aggregate_capture(captures[name], use_numpy=True, bucket_seconds=bucket_seconds,
+                               conversations=conversations)
+    assert flow_table_state(actual) == flow_table_state(expected)
+
+
+@pytest.mark.parametrize('use_numpy', [False, pytest.param(True, marks=requires_numpy)])
+@pytest.mark.parametrize('name', ['sample', 'generated.pcapng', 'generated.pcap'])
+def test_parallel_matches_serial(captures, monkeypatch, name, use_numpy):
+    """-j 4 の並列集計が逐次の集計と同じになる (小さいファイルでも複数のチャンクに分ける)"""
+    expected = aggregate_capture(captures[name], use_numpy=use_numpy, bucket_seconds=1)
+    monkeypatch.setattr(flow_aggregator, 'MIN_PARALLEL_CHUNK_BYTES', 4096)
+    progress = []
+    actual = aggregate_capture(captures[name], use_numpy=use_numpy, workers=4, bucket_seconds=1,
+                               progress=lambda done, total: progress.append((done, total)))
+    assert len(progress) > 1
+    assert progress[-1][0] == progress[-1][1]
+    assert flow_table_state(actual) == flow_table_state(expected)
+
+
+def test_empty_capture(tmp_path):
+    path = tmp_path / 'empty.pcapng'
+    path.write_bytes(b'')
+    table = aggregate_capture(str(path), workers=4)
+    assert table.flows == {}
+    assert table.total_packets == 0
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""latency_histogram のテスト"""
+
+import random
+
+import pytest
+
+from latency_histogram import SUB_BUCKETS
+from latency_histogram import LatencyHistogram
+from latency_histogram import bucket_index
+from latency_histogram import bucket_range
+
+
+def record_all(values):
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    return histogram
+
+
+def test_bucket_range_contains_value():
+    rng = random.Random(1)
+    for value in list(range(1000)) + [rng.randrange(1 << 63) for _ in range(1000)]:
+        low, high = bucket_range(bucket_index(value))
+        assert low <= value <= high
+        # バケットの幅は値の 1/SUB_BUCKETS 以下
+        assert high - low <= max(value, 1) / SUB_BUCKETS
+
+
+def test_merge_equals_recording_everything():
+    """分けて記録したヒストグラムを統合すると、全部を1つに記録したのと同じになる"""
+    rng = random.Random(2)
+    values = [int(rng.lognormvariate(13, 1.5)) for _ in range(5000)]
+    parts = [record_all(values[start:start + 1000]) for start in range(0, len(values), 1000)]
+    merged = LatencyHistogram()
+    for part in parts:
+        merged.merge(part)
+    expected = record_all(values)
+    assert merged.counts == expected.counts
+    assert merged.summary() == expected.summary()
+
+
+def test_merge_empty_histogram():
+    histogram = record_all([10, 20])
+    histogram.merge(LatencyHistogram())
+    assert histogram.summary() == record_all([10, 20]).summary()
+    empty = LatencyHistogram()
+    empty.merge(histogram)
+    assert empty.summary() == histogram.summary()
+
+
+def test_dict_round_trip():
+    histogram = record_all([1, 500, 123456789])
+    restored = LatencyHistogram.from_dict(histogram.to_dict())
+    assert restored.counts == histogram.counts
+    assert restored.summary() == histogram.summary()
+    assert LatencyHistogram.from_dict(LatencyHistogram().to_dict()).summary() == LatencyHistogram().summary()
+
+
+@pytest.mark.parametrize('percentile', [50, 90, 99, 99.9])
+def test_percentile_error(percentile):
+    """パーセンタイルの相対誤差は 1/SUB_BUCKETS 程度に収まる"""
+    rng = random.Random(3)
+    values = sorted(rng.randrange(1000, 10 ** 9) for _ in range(10000))
+    exact = values[int(max(1, -(-len(values) * percentile // 100))) - 1]
+    assert abs(record_all(values).percentile(percentile) - exact) <= exact / SUB_BUCKETS
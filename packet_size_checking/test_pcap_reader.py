@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""pcap_reader のテスト (pcapng / pcap のファイルはテストの中で組み立てる)"""
+
+import struct
+
+import pytest
+
+import pcap_reader
+from pcap_reader import CaptureFormatError
+from pcap_reader import decode_flow
+from pcap_reader import decode_segment
+from pcap_reader import read_packets
+from pcap_reader import scan_packets
+from pcap_reader import split_capture
+
+
+def tcp_packet(src, dst, src_port, dst_port, seq, flags, payload=b'', ethernet=True):
+    """Ethernet (省略可) + IPv4 + TCP のフレーム"""
+    tcp = struct.pack('!HHIIBBHHH', src_port, dst_port, seq % (1 << 32), 0, 5 << 4, flags, 65535, 0, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), 0, 0, 64, 6, 0,
+                     bytes(map(int, src.split('.'))), bytes(map(int, dst.split('.'))))
+    frame = ip + tcp + payload
+    if ethernet:
+        frame = b'\x00' * 12 + b'\x08\x00' + frame
+    return frame
+
+
+def udp_ipv6_packet(src_port, dst_port, payload=b''):
+    """Ethernet + VLAN + IPv6 (::1 → ::2) + UDP のフレーム"""
+    udp = struct.pack('!HHHH', src_port, dst_port, 8 + len(payload), 0) + payload
+    ip = struct.pack('!IHBB16s16s', 6 << 28, len(udp), 17, 64, b'\x00' * 15 + b'\x01', b'\x00' * 15 + b'\x02')
+    return b'\x00' * 12 + b'\x81\x00\x00\x01\x86\xdd' + ip + udp
+
+
+def _pcapng_block(endian, block_type, body):
+    body += b'\x00' * (-len(body) % 4)
+    length = 12 + len(body)
+    return struct.pack(endian + 'II', block_type, length) + body + struct.pack(endian + 'I', length)
+
+
+def build_pcapng(packets, endian='<', tsresol=None, simple=False, linktype=1):
+    """
+    packets [(タイムスタンプ(秒), フレーム)] の pcapng を返す
+
+    tsresol を指定した場合は IDB に if_tsresol を付ける。simple の場合は SPB にする
+    """
+    blocks = [_pcapng_block(endian, pcap_reader.BLOCK_TYPE_SHB,
+                            struct.pack(endian + 'IHHq', pcap_reader.PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1))]
+    options = b''
+    units_per_second = 1000000
+    if tsresol is not None:
+        options = struct.pack(endian + 'HHB3x', pcap_reader.OPTION_IF_TSRESOL, 1, tsresol)
+        options += struct.pack(endian + 'HH', pcap_reader.OPTION_END_OF_OPT, 0)
+        units_per_second = 2 ** (tsresol & 0x7F) if tsresol & 0x80 else 10 ** tsresol
+    blocks.append(_pcapng_block(endian, pcap_reader.BLOCK_TYPE_IDB,
+                                struct.pack(endian + 'HHI', linktype, 0, 65535) + options))
+    for timestamp, frame in packets:
+        if simple:
+            blocks.append(_pcapng_block(endian, pcap_reader.BLOCK_TYPE_SPB, struct.pack(endian + 'I', len(frame)) + frame))
+            continue
+        units = round(timestamp * units_per_second)
+        blocks.append(_pcapng_block(endian, pcap_reader.BLOCK_TYPE_EPB,
+                                    struct.pack(endian + 'IIIII', 0, units >> 32, units & 0xFFFFFFFF,
+                                                len(frame), len(frame)) + frame))
+    return b''.join(blocks)
+
+
+def build_pcap(packets, endian='<', nanoseconds=False, linktype=1):
+    """packets [(タイムスタンプ(秒), フレーム)] の pcap を返す"""
+    magic = pcap_reader.PCAP_MAGIC_NSEC if nanoseconds else pcap_reader.PCAP_MAGIC_USEC
+    units_per_second = 1000000000 if nanoseconds else 1000000
+    records = [struct.pack(endian + 'IHHiIII', magic, 2, 4, 0, 0, 65535, linktype)]
+    for timestamp, frame in packets:
+        seconds = int(timestamp)
+        fraction = round((timestamp - seconds) * units_per_second)
+        records.append(struct.pack(endian + 'IIII', seconds, fraction, len(frame), len(frame)) + frame)
+    return b''.join(records)
+
+
+SAMPLE_PACKETS = [
+    (1700000000.25, tcp_packet('10.0.0.1', '10.0.0.2', 1000, 80, 1, 0x02)),
+    (1700000000.5, udp_ipv6_packet(5353, 53, b'query')),
+    (1700000001.75, tcp_packet('10.0.0.2', '10.0.0.1', 80, 1000, 7, 0x18, b'hello')),
+]
+SAMPLE_KEYS = [
+    ('10.0.0.1', 1000, '10.0.0.2', 80, 'TCP'),
+    ('::1', 5353, '::2', 53, 'UDP'),
+    ('10.0.0.2', 80, '10.0.0.1', 1000, 'TCP'),
+]
+
+CAPTURES = {
+    'pcapng-le': lambda packets: build_pcapng(packets, '<'),
+    'pcapng-be': lambda packets: build_pcapng(packets, '>'),
+    'pcapng-ns': lambda packets: build_pcapng(packets, '<', tsresol=9),
+    'pcapng-2^-20': lambda packets: build_pcapng(packets, '>', tsresol=0x80 | 20),
+    'pcap-le': lambda packets: build_pcap(packets, '<'),
+    'pcap-be': lambda packets: build_pcap(packets, '>'),
+    'pcap-ns': lambda packets: build_pcap(packets, '>', nanoseconds=True),
+}
+
+
+@pytest.mark.parametrize('name', sorted(CAPTURES))
+def test_read_packets(tmp_path, name):
+    """ストリーミング読み込みでタイムスタンプ・長さ・データがそのまま返る"""
+    path = tmp_path / 'capture'
+    path.write_bytes(CAPTURES[name](SAMPLE_PACKETS))
+    packets = list(read_packets(str(path)))
+    assert len(packets) == len(SAMPLE_PACKETS)
+    for (timestamp, length, linktype, data), (expected_timestamp, frame), key in zip(packets, SAMPLE_PACKETS, SAMPLE_KEYS):
+        assert timestamp == pytest.approx(expected_timestamp, abs=1e-6)
+        assert length == len(frame)
+        assert linktype == 1
+        assert bytes(data) == frame
+        assert decode_flow(linktype, data) == key
+
+
+@pytest.mark.parametrize('name', sorted(CAPTURES))
+def test_scan_packets_matches_read_packets(tmp_path, name):
+    """メモリ上のキャプチャの走査がストリーミング読み込みと同じ結果になる"""
+    path = tmp_path / 'capture'
+    buffer = CAPTURES[name](SAMPLE_PACKETS)
+    path.write_bytes(buffer)
+    scanned = [(timestamp, length, linktype, buffer[offset:offset + captured])
+               for timestamp, length, linktype, offset, captured in scan_packets(buffer)]
+    read = [(timestamp, length, linktype, bytes(data)) for timestamp, length, linktype, data in read_packets(str(path))]
+    assert scanned == read
+
+
+@pytest.mark.parametrize('name', sorted(CAPTURES))
+@pytest.mark.parametrize('chunk_size', [1, 100, 1 << 20])
+def test_split_capture_covers_every_packet(name, chunk_size):
+    """チャンクごとに走査しても全体を走査したのと同じパケットが返る"""
+    buffer = CAPTURES[name](SAMPLE_PACKETS * 3)
+    chunks = split_capture(buffer, chunk_size)
+    if chunk_size == 1:
+        assert len(chunks) >= len(SAMPLE_PACKETS) * 3
+    packets = [packet for chunk in chunks for packet in scan_packets(buffer, chunk=chunk)]
+    assert packets == list(scan_packets(buffer))
+
+
+def test_simple_packet_blocks_have_no_timestamp(tmp_path):
+    """SPB のパケットはタイムスタンプなしで返る"""
+    path = tmp_path / 'capture.pcapng'
+    buffer = build_pcapng(SAMPLE_PACKETS, simple=True)
+    path.write_bytes(buffer)
+    assert [timestamp for timestamp, _, _, _ in read_packets(str(path))] == [None] * len(SAMPLE_PACKETS)
+    assert [packet[0] for packet in scan_packets(buffer, no_timestamp=-1)] == [-1] * len(SAMPLE_PACKETS)
+
+
+def test_raw_ip_linktype():
+    """リンク層のヘッダーがないキャプチャ"""
+    frame = tcp_packet('192.168.0.1', '192.168.0.2', 1, 2, 0, 0x10, ethernet=False)
+    buffer = build_pcap([(0.0, frame)], linktype=pcap_reader.LINKTYPE_RAW)
+    (_, length, linktype, offset, captured), = scan_packets(buffer)
+    assert decode_flow(linktype, buffer[offset:offset + captured]) == ('192.168.0.1', 1, '192.168.0.2', 2, 'TCP')
+
+
+def test_decode_segment_splits_headers_and_payload():
+    """フレーム長が L2 + L3 + L4 + ペイロードに分かれる"""
+    frame = tcp_packet('10.0.0.1', '10.0.0.2', 1000, 80, 1234, 0x18, b'x' * 10) + b'\x00' * 4
+    segment = decode_segment(1, frame, len(frame))
+    assert segment == ('10.0.0.1', 1000, '10.0.0.2', 80, 'TCP', 14 + 4, 20, 20, 10, 1234, 0x18)
+
+
+def test_truncated_capture_raises(tmp_path):
+    """途中で終わっているファイルは CaptureFormatError になる"""
+    path = tmp_path / 'capture.pcapng'
+    path.write_bytes(build_pcapng(SAMPLE_PACKETS)[:-10])
+    with pytest.raises(CaptureFormatError):
+        list(read_packets(str(path)))
+
+
+def test_not_a_capture(tmp_path):
+    path = tmp_path / 'capture.txt'
+    path.write_bytes(b'hello world')
+    with pytest.raises(CaptureFormatError):
+        list(read_packets(str(path)))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+一定の時間幅 (バケット) ごとのパケット数・バイト数を集計するモジュール
+
+合計と接続ごとに、パケットのあるバケットだけを辞書で持つため、
+メモリ使用量はパケット数ではなくバケット数に比例する。
+ピークレートとパーセンタイルの計算、CSV / Parquet への出力を行う。
+
+Parquet への出力 (任意):
+    pip install pyarrow
+"""
+
+import csv
+import math
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# 出力する列
+TIMELINE_COLUMNS = ('bucket_start', 'src_ip', 'src_port', 'dst_ip', 'dst_port', 'protocol',
+                    'packets', 'bytes', 'bytes_per_sec')
+
+# レポートに表示するパーセンタイル
+REPORT_PERCENTILES = (50, 90, 99)
+
+# バケット幅の単位
+_DURATION_UNITS = (('ms', 0.001), ('us', 0.000001), ('s', 1.0))
+
+
+def parse_bucket_size(text):
+    """
+    バケット幅の文字列を秒に変換する
+
+    Args:
+        text: '10ms', '1s', '500us', '0.5' (単位なしは秒)
+
+    Returns:
+        秒 (float)
+    """
+    value = text.strip().lower()
+    scale = 1.0
+    for unit, unit_scale in _DURATION_UNITS:
+        if value.endswith(unit):
+            value = value[:-len(unit)]
+            scale = unit_scale
+            break
+    try:
+        seconds = float(value) * scale
+    except ValueError:
+        raise ValueError(f"バケット幅が不正です: {text}")
+    if not seconds > 0:
+        raise ValueError(f"バケット幅は正の値にしてください: {text}")
+    return seconds
+
+
+def is_parquet_available():
+    """Parquet に出力できるか (pyarrow がインストールされているか)"""
+    return pyarrow is not None
+
+
+def format_bucket_size(seconds):
+    """バケット幅を表示用の文字列にする"""
+    if seconds < 1:
+        return f"{seconds * 1000:g} ms"
+    return f"{seconds:g} s"
+
+
+class Timeline:
+    """
+    バケットごとのパケット数・バイト数
+
+    バケット番号は タイムスタンプ // バケット幅 で、バケットの開始時刻は バケット番号 * バケット幅。
+    接続ごとの値: {キー: {バケット番号: [パケット数, バイト数]}}
+    """
+
+    def __init__(self, bucket_seconds):
+        self.bucket_seconds = bucket_seconds
+        self.flows = {}
+
+    def add_packet(self, key, length, timestamp):
+        """1パケット分を加算する"""
+        self.add_bucket(key, int(timestamp // self.bucket_seconds), 1, length)
+
+    def add_bucket(self, key, bucket, packets, bytes_count):
+        """集計済みのバケットの値を加算する"""
+        buckets = self.flows.get(key)
+        if buckets is None:
+            buckets = self.flows[key] = {}
+        entry = buckets.get(bucket)
+        if entry is None:
+            buckets[bucket] = [packets, bytes_count]
+        else:
+            entry[0] += packets
+            entry[1] += bytes_count
+
+    def merge(self, other):
+        """別の Timeline (同じバケット幅) の値を加算する"""
+        for key, buckets in other.flows.items():
+            for bucket, (packets, bytes_count) in buckets.items():
+                self.add_bucket(key, bucket, packets, bytes_count)
+
+    def get_total(self):
+        """全接続の合計のバケット {バケット番号: [パケット数, バイト数]} を返す"""
+        total = {}
+        for buckets in self.flows.values():
+            for bucket, (packets, bytes_count) in buckets.items():
+                entry = total.get(bucket)
+                if entry is None:
+                    total[bucket] = [packets, bytes_count]
+                else:
+                    entry[0] += packets
+                    entry[1] += bytes_count
+        return total
+
+    def summarize(self, buckets):
+        """
+        バケットの値からピークレートとパーセンタイルを計算する
+
+        最初と最後のバケットの間のパケットのないバケットは0として数える。
+
+        Args:
+            buckets: {バケット番号: [パケット数, バイト数]}
+
+        Returns:
+            {'buckets': 期間のバケット数, 'active_buckets': パケットのあるバケット数,
+             'peak_bytes_per_sec': ピークレート, 'peak_packets_per_sec': ピークのパケットレート,
+             'peak_at': ピークのバケットの開始時刻, 'mean_bytes_per_sec': 平均レート,
+             'percentiles': {パーセンタイル: バイト/秒}}
+            buckets が空の場合は None
+        """
+        if not buckets:
+            return None
+        span = max(buckets) - min(buckets) + 1
+        peak_bucket, (_packets, peak_bytes) = max(buckets.items(), key=lambda item: item[1][1])
+        byte_counts = sorted(bytes_count for _packets, bytes_count in buckets.values())
+        empty_buckets = span - len(byte_counts)
+        return {
+            'buckets': span,
+            'active_buckets': len(byte_counts),
+            'peak_bytes_per_sec': peak_bytes / self.bucket_seconds,
+            'peak_packets_per_sec': max(packets for packets, _bytes in buckets.values()) / self.bucket_seconds,
+            'peak_at': peak_bucket * self.bucket_seconds,
+            'mean_bytes_per_sec': sum(byte_counts) / (span * self.bucket_seconds),
+            'percentiles': {percentile: _percentile(byte_counts, empty_buckets, percentile) / self.bucket_seconds
+                            for percentile in REPORT_PERCENTILES},
+        }
+
+    def iter_rows(self, flow_order=None):
+        """
+        出力用の行 (TIMELINE_COLUMNS の順) を返すジェネレーター
+
+        最初に合計 (接続の列は空) をバケット順に、続けて接続ごとにバケット順に返す。
+
+        Args:
+            flow_order: 接続のキーを出力する順に並べたもの (省略時は集計した順)
+        """
+        for key, buckets in [(None, self.get_total())] + \
+                [(key, self.flows[key]) for key in (flow_order or self.flows) if key in self.flows]:
+            src_ip, src_port, dst_ip, dst_port, protocol = key or ('', '', '', '', '')
+            for bucket in sorted(buckets):
+                packets, bytes_count = buckets[bucket]
+                yield (round(bucket * self.bucket_seconds, 6), src_ip, str(src_port), dst_ip, str(dst_port), protocol,
+                       packets, bytes_count, bytes_count / self.bucket_seconds)
+
+    def write(self, path, flow_order=None):
+        """
+        CSV か Parquet (拡張子が .parquet の場合) に出力する
+
+        Args:
+            path: 出力先のファイルパス
+            flow_order: 接続のキーを出力する順に並べたもの
+        """
+        if path.lower().endswith('.parquet'):
+            self._write_parquet(path, flow_order)
+        else:
+            with open(path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(TIMELINE_COLUMNS)
+                writer.writerows(self.iter_rows(flow_order))
+
+    def _write_parquet(self, path, flow_order):
+        if pyarrow is None:
+            raise RuntimeError("Parquet への出力には pyarrow が必要です (pip install pyarrow)")
+        columns = list(zip(*self.iter_rows(flow_order))) or [()] * len(TIMELINE_COLUMNS)
+        table = pyarrow.table({name: list(values) for name, values in zip(TIMELINE_COLUMNS, columns)})
+        pyarrow.parquet.write_table(table, path)
+
+
+def _percentile(sorted_values, zero_count, percentile):
+    """0 が zero_count 個追加されたものとして、sorted_values の最近接順位法のパーセンタイルを返す"""
+    count = len(sorted_values) + zero_count
+    rank = max(1, math.ceil(percentile / 100 * count))
+    if rank <= zero_count:
+        return 0
+    return sorted_values[rank - zero_count - 1]